@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+""" Motion detection aggregator for the SmartThings camera scripts
+
+Cameras with 'offload' set to this machine's "host:port" keep a connection
+open to it and send it small gray JPEG frames. It keeps a background model
+for each camera - the same MotionDetector the camera scripts use, loaded
+from smartthings-mac.py - and sends back the regions that moved. Tracking,
+saving, uploads and the hubs all stay on the cameras, which go back to
+detecting motion themselves if this goes away.
+
+Frames are checked on a pool of worker threads, one frame per camera at a
+time. OpenCV releases the GIL while it works, so a dozen cameras spread
+over the cores.
+
+Dependencies: python-twisted, cv2, numpy, imutils (for the camera script)
+"""
+
+import argparse
+import importlib.util
+import logging
+import os
+import sys
+
+from time import time
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThreadPool
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python.threadpool import ThreadPool
+
+# setting up logging for this script
+_LEVEL = logging.INFO
+_FORMAT = "%(asctime)-15s [%(levelname)-8s] : %(lineno)d : %(name)s.%(funcName)s : %(message)s"
+logging.basicConfig(format=_FORMAT, level=_LEVEL)
+LOG = logging.getLogger()
+
+MAX_MESSAGE = 4 * 1024 * 1024
+
+
+def parse_args(args):
+    """ Parse the arguments passed to this script """
+    here = os.path.dirname(os.path.abspath(__file__))
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--port', type=int, default=8090, help="port the cameras connect to")
+    argp.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="threads checking frames")
+    argp.add_argument('--detector', default=os.path.join(here, 'smartthings-mac.py'),
+                      help="camera script to take the MotionDetector from")
+    argp.add_argument('--stats-interval', type=float, default=60, help="seconds between stats in the log")
+    return argp.parse_args(args)
+
+
+def load_detector(path):
+    """Load a camera script as a module for its MotionDetector, and the
+       vision modules it uses"""
+    spec = importlib.util.spec_from_file_location('camera', path)
+    camera = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(camera)
+    camera.load_camera_modules()
+    return camera
+
+
+class CameraSession(Int32StringReceiver):
+    """One camera's connection, with its own background model. Frames that
+       arrive while one is being checked replace each other, so only the
+       newest waits."""
+    MAX_LENGTH = MAX_MESSAGE
+
+    def connectionMade(self): # pylint: disable=invalid-name
+        self.name = str(self.transport.getPeer())
+        self.detector = None
+        self.busy = False
+        self.queued = None
+        self.frames = 0
+        self.seconds = 0.0
+        self.factory.sessions.add(self)
+        LOG.info("Camera connected from %s", self.name)
+
+    def connectionLost(self, reason=None): # pylint: disable=invalid-name
+        self.factory.sessions.discard(self)
+        LOG.info("Camera %s disconnected", self.name)
+
+    def stringReceived(self, string): # pylint: disable=invalid-name
+        camera = self.factory.camera
+        header, payload = camera.parse_offload_message(string)
+        if header.get('type') == 'configure':
+            self.name = header.get('camera', self.name)
+            if self.detector is None:
+                self.detector = camera.MotionDetector(header['conf'])
+            else:
+                self.detector.configure(header['conf'])
+            LOG.info("Camera %s configured", self.name)
+        elif header.get('type') == 'frame' and self.detector is not None:
+            if self.busy:
+                self.queued = (header, payload)
+            else:
+                self.check(header, payload)
+
+    def check(self, header, payload):
+        """Check a frame on the worker threads"""
+        self.busy = True
+        checking = deferToThreadPool(reactor, self.factory.pool, self.detect, payload, header.get('captured'))
+        checking.addCallbacks(self.answer, self.failed, callbackArgs=(header, time()))
+
+    def detect(self, payload, captured=None):
+        """Decode a frame and find the regions that moved, as of the time the
+           camera captured it (or now, for cameras that don't say). Runs on
+           a worker thread."""
+        camera = self.factory.camera
+        gray = camera.cv2.imdecode(camera.np.frombuffer(payload, camera.np.uint8), camera.cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError('the frame could not be decoded')
+        return self.detector.regions(self.detector.detect(self.detector.prepare(gray), captured))
+
+    def answer(self, regions, header, began):
+        """Send the regions back"""
+        self.frames += 1
+        self.seconds += time() - began
+        if regions is not None:
+            regions = [[area, x, y, w, h] for area, (x, y, w, h) in regions]
+        if self.transport.connected:
+            self.sendString(self.factory.camera.offload_message({'type': 'result', 'seq': header['seq'], 'regions': regions}))
+        self.next()
+
+    def failed(self, failure):
+        """Checking the frame threw an error - the camera times out and
+           checks its own frames for a while"""
+        LOG.error("ERROR: Checking a frame from %s: %s", self.name, failure.getErrorMessage())
+        self.next()
+
+    def next(self):
+        """Check the frame that came in meanwhile, if there is one"""
+        self.busy = False
+        if self.queued is not None and self.transport.connected:
+            queued, self.queued = self.queued, None
+            self.check(*queued)
+
+
+class Aggregator(Factory):
+    """Accepts camera connections and shares the worker threads between them"""
+    protocol = CameraSession
+
+    def __init__(self, camera, workers):
+        self.camera = camera
+        self.sessions = set()
+        self.pool = ThreadPool(minthreads=1, maxthreads=workers, name='aggregator')
+        self.pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop) # pylint: disable=no-member
+        self.reported = time()
+
+    def report(self):
+        """Log frames checked per camera since the last report"""
+        now = time()
+        for session in sorted(self.sessions, key=lambda session: session.name):
+            LOG.info("%s: %.1f frames/s, %.1fms each", session.name,
+                     session.frames / (now - self.reported),
+                     1000 * session.seconds / session.frames if session.frames else 0)
+            session.frames = 0
+            session.seconds = 0.0
+        self.reported = now
+
+
+def main():
+    """Main function to handle use from command line"""
+    args = parse_args(sys.argv[1:])
+
+    LOG.info("Loading the MotionDetector from %s", args.detector)
+    camera = load_detector(args.detector)
+
+    aggregator = Aggregator(camera, args.workers)
+    reactor.listenTCP(args.port, aggregator) # pylint: disable=no-member
+    if args.stats_interval > 0:
+        LoopingCall(aggregator.report).start(args.stats_interval, now=False)
+    LOG.info("Checking frames for cameras on port %d with %d workers", args.port, args.workers)
+    reactor.run() # pylint: disable=no-member
+    return True
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+
+""" Load test for the SmartThings camera scripts
+
+Runs smartthings-mac.py (or smartthings-pi.py) against a replayed video -
+read from the file, or served as MJPEG by a stand-in network camera - a
+local stand-in for S3 and a simulated SmartThings hub that floods SSDP
+searches, subscribes, polls /status from many clients and timestamps the
+notifications it gets back. Reports capture-to-notify latency, HTTP
+throughput and error rates.
+
+Needs cv2 and numpy to make the test video (unless --replay is given) and
+boto3 for the camera script's uploads.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time, sleep
+
+# setting up logging for this script
+_LEVEL = logging.INFO
+_FORMAT = "%(asctime)-15s [%(levelname)-8s] : %(lineno)d : %(name)s.%(funcName)s : %(message)s"
+logging.basicConfig(format=_FORMAT, level=_LEVEL)
+LOG = logging.getLogger()
+
+SSDP_PORT = 1900
+SSDP_ADDR = '239.255.255.250'
+MSEARCH = 'M-SEARCH * HTTP/1.1\r\nHOST:%s:%d\r\nMAN:"ssdp:discover"\r\nMX:1\r\nST:%s\r\n\r\n'
+DEVICE_TARGET = 'urn:schemas-upnp-org:device:RPi_Security_Camera:{}'
+S3_BUCKET = 'loadtest'
+STARTUP_TIMEOUT = 120
+HTTP_TIMEOUT = 5
+STOP_TIMEOUT = 30
+STREAM_BOUNDARY = 'frame'
+
+
+def parse_args(args):
+    """ Parse the arguments passed to this script """
+    here = os.path.dirname(os.path.abspath(__file__))
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--conf', default=os.path.join(here, 'conf-mac.json'), help="camera config to start from")
+    argp.add_argument('--script', default=os.path.join(here, 'smartthings-mac.py'), help="camera script to test")
+    argp.add_argument('--python', default=sys.executable, help="python to run the camera script with")
+    argp.add_argument('--replay', help="video or image sequence to replay (default: a generated one)")
+    argp.add_argument('--stream', action='store_true', help="serve the replay to the camera as an MJPEG stream")
+    argp.add_argument('--stream-drop', type=float, default=0,
+                      help="seconds between the stream dropping the camera's connection (0: never)")
+    argp.add_argument('--duration', type=float, default=60, help="seconds to run the load for")
+    argp.add_argument('--http-port', type=int, default=18080, help="port for the camera's status server")
+    argp.add_argument('--status-clients', type=int, default=20, help="clients polling /status")
+    argp.add_argument('--status-interval', type=float, default=0.0, help="seconds between polls per client")
+    argp.add_argument('--ssdp-rate', type=float, default=50, help="M-SEARCHes sent per second")
+    argp.add_argument('--ssdp-addr', default=SSDP_ADDR, help="where to send M-SEARCHes")
+    argp.add_argument('--subscribers', type=int, default=1, help="number of simulated hubs subscribing")
+    argp.add_argument('--json', help="also write the report to this file")
+    return argp.parse_args(args)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Nearest-rank percentiles of values, plus the max"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    result = {}
+    for point in points:
+        rank = max(0, int(round(point / 100.0 * len(ordered) + 0.5)) - 1)
+        result['p%d' % point] = ordered[min(rank, len(ordered) - 1)]
+    result['max'] = ordered[-1]
+    return result
+
+
+def make_replay(path, seconds=20, size=(640, 480), fps=15):
+    """Write a test video: a noisy still scene with something crossing it
+       for a few seconds every ten seconds"""
+    import cv2
+    import numpy as np
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+    if not writer.isOpened():
+        raise IOError('Unable to write %s' % path)
+    width, height = size
+    for index in range(int(seconds * fps)):
+        frame = np.full((height, width, 3), 90, np.uint8)
+        frame += np.random.randint(0, 4, frame.shape, dtype=np.uint8)
+        moment = (index / float(fps)) % 10
+        if 2 <= moment < 5:
+            x = int((moment - 2) / 3 * (width - width // 5))
+            frame[height // 4:height * 3 // 4, x:x + width // 5] = 230
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+class Recorder(object):
+    """Thread safe counters and timings shared by the load generators"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.timings = {}
+        self.notifications = []
+        self.hubs = {}
+        self.uploads = []
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def time(self, name, seconds):
+        with self.lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    def notified(self, hub, received, cmd):
+        with self.lock:
+            self.notifications.append((received, cmd))
+            self.hubs[hub] = self.hubs.get(hub, 0) + 1
+
+
+class HubHandler(BaseHTTPRequestHandler):
+    """Receives the camera's notifications like a SmartThings hub would, each
+       simulated hub on its own path"""
+
+    def do_POST(self): # pylint: disable=invalid-name
+        received = time()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8', 'replace')
+        match = re.search(r'<cmd>(.*?)</cmd>', body)
+        self.server.recorder.notified(self.path, received, match.group(1) if match else None)
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_NOTIFY = do_POST
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    """Just enough of S3's PutObject for the camera's uploads"""
+    # boto3 sends 'Expect: 100-continue' and waits for it
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self): # pylint: disable=invalid-name
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        size = int(self.headers.get('x-amz-decoded-content-length', length))
+        self.server.recorder.uploads.append((time(), self.path, size))
+        self.send_response(200)
+        self.send_header('ETag', '"loadtest"')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+
+class MjpegHandler(BaseHTTPRequestHandler):
+    """Serves the replay as MJPEG like a network camera, dropping the
+       connection every stream_drop seconds if that's set"""
+
+    def do_GET(self): # pylint: disable=invalid-name
+        self.server.recorder.count('stream_connections')
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=%s' % STREAM_BOUNDARY)
+        self.end_headers()
+        began = time()
+        next_frame = began
+        index = 0
+        frames = self.server.frames
+        while not self.server.stream_drop or time() - began < self.server.stream_drop:
+            jpeg = frames[index % len(frames)]
+            index += 1
+            try:
+                self.wfile.write(bytes('--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+                                       % (STREAM_BOUNDARY, len(jpeg)), 'ascii') + jpeg + b'\r\n')
+                self.wfile.flush()
+            except OSError:
+                return
+            self.server.recorder.count('stream_frames')
+            next_frame += self.server.interval
+            sleep(max(0, next_frame - time()))
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+
+def load_stream(path):
+    """The replay's frames as JPEGs and its frame interval, for the stream"""
+    import cv2
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError('Unable to open %s for the stream' % path)
+    interval = 1.0 / (capture.get(cv2.CAP_PROP_FPS) or 30.0)
+    frames = []
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        frames.append(cv2.imencode('.jpg', frame)[1].tobytes())
+    capture.release()
+    if not frames:
+        raise IOError('%s has no frames to stream' % path)
+    return frames, interval
+
+
+def serve(handler, recorder):
+    """Start a threaded HTTP server on a free local port"""
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    httpd.daemon_threads = True
+    httpd.recorder = recorder
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+def request(port, method, path, headers=None):
+    """Make one request to the camera, returns (status, headers, body)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=HTTP_TIMEOUT)
+    try:
+        conn.request(method, path, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        conn.close()
+
+
+def wait_for_camera(port, daemon):
+    """Wait until the camera answers /status, returns False if it died"""
+    deadline = time() + STARTUP_TIMEOUT
+    while time() < deadline:
+        if daemon.poll() is not None:
+            return False
+        try:
+            status, _, _ = request(port, 'GET', '/status')
+            if status == 200:
+                return True
+        except OSError:
+            pass
+        sleep(0.2)
+    return False
+
+
+def subscribe(port, callback, recorder):
+    """SUBSCRIBE like the hub does, returns the SID"""
+    began = time()
+    try:
+        status, headers, _ = request(port, 'SUBSCRIBE', '/', {'CALLBACK': '<%s>' % callback,
+                                                              'NT': 'upnp:event',
+                                                              'TIMEOUT': 'Second-3600'})
+    except OSError as error:
+        LOG.error("SUBSCRIBE failed: %s", error)
+        recorder.count('subscribe_errors')
+        return None
+    recorder.time('subscribe', time() - began)
+    if status != 200:
+        recorder.count('subscribe_errors')
+        return None
+    return headers.get('SID')
+
+
+def poll_status(port, until, interval, recorder):
+    """One hub client polling /status over a keep-alive connection"""
+    conn = None
+    while time() < until:
+        began = time()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=HTTP_TIMEOUT)
+            conn.request('GET', '/status')
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                recorder.count('status_ok')
+                recorder.time('status', time() - began)
+            else:
+                recorder.count('status_errors')
+        except (OSError, http.client.HTTPException):
+            recorder.count('status_errors')
+            if conn is not None:
+                conn.close()
+            conn = None
+        if interval:
+            sleep(interval)
+    if conn is not None:
+        conn.close()
+
+
+def flood_ssdp(addr, rate, search_target, until, recorder):
+    """Send M-SEARCHes at rate per second and count the replies"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    sock.settimeout(0.001)
+    message = bytes(MSEARCH % (SSDP_ADDR, SSDP_PORT, search_target), 'utf-8')
+    next_send = time()
+    while time() < until:
+        now = time()
+        if rate and now >= next_send:
+            sock.sendto(message, (addr, SSDP_PORT))
+            recorder.count('ssdp_sent')
+            next_send = max(next_send + 1.0 / rate, now)
+        try:
+            data, _ = sock.recvfrom(4096)
+            if data.startswith(b'HTTP/1.1 200 OK'):
+                recorder.count('ssdp_replies')
+        except socket.timeout:
+            pass
+    sock.close()
+
+
+def read_events(path, since):
+    """The camera's motion events since a time, read once it has stopped
+       so events still in progress at the end have been written out"""
+    events = []
+    if os.path.isfile(path):
+        with open(path) as events_file:
+            for line in events_file:
+                if line.strip():
+                    event = json.loads(line)
+                    if event['start'] >= since:
+                        events.append(event)
+    return sorted(events, key=lambda event: event['start'])
+
+
+def notify_latencies(notifications, events):
+    """Time from the capture of the frame that started each event to each
+       status-active notification the hubs got for it (the ones that arrived
+       before the next event started)"""
+    latencies = []
+    for index, event in enumerate(events):
+        following = events[index + 1]['start'] if index + 1 < len(events) else float('inf')
+        latencies += [received - event['start'] for received, cmd in notifications
+                      if cmd == 'status-active' and event['start'] <= received < following]
+    return latencies
+
+
+def build_conf(args, workdir, s3_port, replay, stream_port=None):
+    """The camera config for the test: the given one, pointed at the replay
+       (or the stream of it), the S3 stand-in and the work directory"""
+    with open(args.conf) as conf_file:
+        conf = json.load(conf_file)
+    os.makedirs(os.path.join(workdir, 'images'), exist_ok=True)
+    if stream_port is None:
+        conf['replay'] = replay
+    else:
+        conf.pop('replay', None)
+        conf['stream'] = 'http://127.0.0.1:%d/video.mjpg' % stream_port
+    conf.update({'camera_warmup_time': 0,
+                 'http_port': args.http_port,
+                 'basepath': os.path.join(workdir, 'images'),
+                 's3_endpoint': 'http://127.0.0.1:%d' % s3_port,
+                 's3bucket': S3_BUCKET,
+                 'subscription_file': os.path.join(workdir, 'subscriptions.json'),
+                 'events_file': os.path.join(workdir, 'events.jsonl'),
+                 'background_file': os.path.join(workdir, 'background.npz')})
+    path = os.path.join(workdir, 'conf.json')
+    with open(path, 'w') as conf_file:
+        json.dump(conf, conf_file, indent=4)
+    return path, conf
+
+
+def report(args, recorder, latencies, stats, elapsed):
+    """Summarize the run"""
+    status_total = recorder.counts.get('status_ok', 0) + recorder.counts.get('status_errors', 0)
+    result = {
+        'duration': round(elapsed, 1),
+        'notify_latency': {key: round(value, 3) for key, value in percentiles(latencies).items()},
+        'notifications': len(recorder.notifications),
+        'hubs_notified': len(recorder.hubs),
+        'notifications_per_hub': {'min': min(recorder.hubs.values(), default=0),
+                                  'max': max(recorder.hubs.values(), default=0)},
+        'uploads': len(recorder.uploads),
+        'status_requests': status_total,
+        'status_per_second': round(status_total / elapsed, 1) if elapsed else 0,
+        'status_error_rate': round(recorder.counts.get('status_errors', 0) / float(status_total), 4) if status_total else 0,
+        'status_latency': {key: round(value, 4) for key, value in percentiles(recorder.timings.get('status', [])).items()},
+        'subscribe_errors': recorder.counts.get('subscribe_errors', 0),
+        'ssdp_sent': recorder.counts.get('ssdp_sent', 0),
+        'ssdp_replies': recorder.counts.get('ssdp_replies', 0),
+        'stream_connections': recorder.counts.get('stream_connections', 0),
+        'stream_frames': recorder.counts.get('stream_frames', 0),
+        'camera_stats': stats,
+    }
+    LOG.info("Capture to notify latency: %s over %d notifications", result['notify_latency'], len(latencies))
+    LOG.info("Hubs: %d of %d notified, %d-%d notifications each", result['hubs_notified'], args.subscribers,
+             result['notifications_per_hub']['min'], result['notifications_per_hub']['max'])
+    LOG.info("/status: %d requests, %.1f/s, error rate %.2f%%, latency %s", status_total,
+             result['status_per_second'], result['status_error_rate'] * 100, result['status_latency'])
+    LOG.info("SSDP: %d M-SEARCHes sent, %d replies", result['ssdp_sent'], result['ssdp_replies'])
+    LOG.info("S3: %d uploads", result['uploads'])
+    if args.stream:
+        LOG.info("Stream: %d frames served over %d connections", result['stream_frames'], result['stream_connections'])
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(result, json_file, indent=4)
+    return result
+
+
+def main():
+    """Main function to handle use from command line"""
+
+    args = parse_args(sys.argv[1:])
+    recorder = Recorder()
+    workdir = tempfile.mkdtemp(prefix='camera-loadtest-')
+    s3 = serve(S3Handler, recorder)
+    hub = serve(HubHandler, recorder)
+    replay = args.replay or make_replay(os.path.join(workdir, 'replay.avi'))
+    stream = None
+    if args.stream:
+        stream = serve(MjpegHandler, recorder)
+        stream.frames, stream.interval = load_stream(replay)
+        stream.stream_drop = args.stream_drop
+    conf_path, conf = build_conf(args, workdir, s3.server_address[1], replay,
+                                 stream.server_address[1] if stream is not None else None)
+
+    # the S3 stand-in doesn't check credentials, but boto3 wants some
+    env = dict(os.environ, AWS_ACCESS_KEY_ID='loadtest', AWS_SECRET_ACCESS_KEY='loadtest',
+               AWS_DEFAULT_REGION='us-east-1', AWS_REQUEST_CHECKSUM_CALCULATION='when_required')
+    log_path = os.path.join(workdir, 'camera.log')
+    LOG.info("Starting %s, logging to %s", args.script, log_path)
+    with open(log_path, 'w') as log_file:
+        daemon = subprocess.Popen([args.python, args.script, '--conf', conf_path], env=env,
+                                  stdout=log_file, stderr=subprocess.STDOUT)
+    try:
+        if not wait_for_camera(args.http_port, daemon):
+            LOG.error("The camera didn't start, see %s", log_path)
+            return False
+
+        # the camera keeps one subscription per callback, so each hub has its own
+        for index in range(args.subscribers):
+            subscribe(args.http_port, 'http://127.0.0.1:%d/hub/%d' % (hub.server_address[1], index), recorder)
+
+        began = time()
+        until = began + args.duration
+        search_target = DEVICE_TARGET.format(conf['device_index'])
+        threads = [threading.Thread(target=flood_ssdp, args=(args.ssdp_addr, args.ssdp_rate, search_target, until, recorder))]
+        threads += [threading.Thread(target=poll_status, args=(args.http_port, until, args.status_interval, recorder))
+                    for _ in range(args.status_clients)]
+        for thread in threads:
+            thread.start()
+        LOG.info("Running load for %.0fs...", args.duration)
+        for thread in threads:
+            thread.join()
+        elapsed = time() - began
+
+        # give the last notification a moment to arrive
+        sleep(1)
+        _, _, body = request(args.http_port, 'GET', '/stats')
+        stats = json.loads(body.decode('utf-8'))
+    finally:
+        daemon.terminate()
+        try:
+            daemon.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            LOG.error("The camera didn't stop, killing it")
+            daemon.kill()
+            daemon.wait()
+        s3.shutdown()
+        hub.shutdown()
+        if stream is not None:
+            stream.shutdown()
+
+    latencies = notify_latencies(recorder.notifications, read_events(conf['events_file'], began))
+    report(args, recorder, latencies, stats, elapsed)
+    return True
+
+if __name__ == "__main__":
+    main()
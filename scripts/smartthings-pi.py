@@ -19,381 +19,4145 @@ specific language governing permissions and limitations under the License.
 """
 
 import argparse
+import base64
+import bisect
+import collections
+import ctypes
+import gc
+import heapq
+import hmac
+import http.client
+import io
 import logging
-import cv2
-import urllib
-import imutils
+import logging.handlers
 import json
+import math
 import os
+import queue
+import signal
+import socket
+import struct
 import sys
+import threading
 import uuid
-import boto3
 
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from datetime import datetime
+from resource import getrusage, RUSAGE_SELF
 from time import time, sleep
-from botocore.exceptions import BotoCoreError, ClientError
-from imutils.video import VideoStream
-from picamera.array import PiRGBArray
-from picamera import PiCamera
-from twisted.web import server, resource
-from twisted.internet import reactor
-from twisted.internet.defer import succeed
-from twisted.internet.protocol import DatagramProtocol
-from twisted.web.client import Agent
-from twisted.web.http_headers import Headers
-from twisted.web.iweb import IBodyProducer
-from twisted.web._newclient import ResponseFailed
-from zope.interface import implementer
+from urllib.parse import urlsplit
+
+# everything below is counted as startup time
+LAUNCH_TIME = time()
+
+from twisted.web import server, resource, static # pylint: disable=wrong-import-position
+from twisted.internet import reactor # pylint: disable=wrong-import-position
+from twisted.internet.defer import succeed, Deferred, DeferredList # pylint: disable=wrong-import-position
+from twisted.internet.error import CannotListenError # pylint: disable=wrong-import-position
+from twisted.internet.protocol import DatagramProtocol, ReconnectingClientFactory # pylint: disable=wrong-import-position
+from twisted.internet.task import LoopingCall, deferLater # pylint: disable=wrong-import-position
+from twisted.internet.threads import deferToThread, deferToThreadPool # pylint: disable=wrong-import-position
+from twisted.protocols.basic import Int32StringReceiver # pylint: disable=wrong-import-position
+from twisted.python.failure import Failure # pylint: disable=wrong-import-position
+from twisted.python.threadpool import ThreadPool # pylint: disable=wrong-import-position
+from twisted.web.client import Agent # pylint: disable=wrong-import-position
+from twisted.web.http_headers import Headers # pylint: disable=wrong-import-position
+from twisted.web.iweb import IBodyProducer # pylint: disable=wrong-import-position
+from twisted.web._newclient import ResponseFailed # pylint: disable=wrong-import-position
+from zope.interface import implementer # pylint: disable=wrong-import-position
+
+# cv2, imutils and picamera take seconds to import on a Pi Zero, so they are
+# loaded on a worker thread by load_camera_modules() once the servers are up
+cv2 = None
+imutils = None
+np = None
+PiCamera = None
+PiRGBArray = None
 
 # setting up logging for this script
 _LEVEL = logging.INFO
 _FORMAT = "%(asctime)-15s [%(levelname)-8s] : %(lineno)d : %(name)s.%(funcName)s : %(message)s"
 logging.basicConfig(format=_FORMAT, level=_LEVEL)
 LOG = logging.getLogger()
+# the busy parts of the script log under their own names so they can be
+# given their own levels with log_levels
+SSDP_LOG = logging.getLogger('camera.ssdp')
+HTTP_LOG = logging.getLogger('camera.http')
+MONITOR_LOG = logging.getLogger('camera.monitor')
+LOG_QUEUE_SIZE = 10000
+LOG_MAX_BYTES = 1024 * 1024
+
+SSDP_PORT = 1900
+SSDP_ADDR = '239.255.255.250'
+UUID = 'd1c58eb4-9220-11e4-96fa-123b93f75cba'
+SEARCH_RESPONSE = 'HTTP/1.1 200 OK\r\nCACHE-CONTROL:max-age=30\r\nEXT:\r\nLOCATION:%s\r\nSERVER:Linux, UPnP/1.0, Pi_Camera/1.0\r\nST:%s\r\nUSN:uuid:%s::%s\r\n'
+NOTIFY_MESSAGE = 'NOTIFY * HTTP/1.1\r\nHOST:%s:%d\r\nCACHE-CONTROL:max-age=%d\r\nLOCATION:%s\r\nNT:%s\r\nNTS:%s\r\nSERVER:Linux, UPnP/1.0, Pi_Camera/1.0\r\nUSN:uuid:%s::%s\r\n\r\n'
+SSDP_MAX_AGE = 1800
+SSDP_BURST = 5
+IP_CACHE_TTL = 300
+SUBSCRIPTION_TIMEOUT = 24 * 3600
+EVENT_INDEX = struct.Struct('<dQI')
+EVENT_QUERY_LIMIT = 100000
+BLUR_KERNEL = (21, 21)
+BACKGROUND_SCALE = 256.0
+CALIBRATE_MAX_DELTA = 64
+CALIBRATE_MIN_AREA = 0.0005
+CALIBRATE_MAX_AREA = 0.02
+# the 90th percentile of the absolute value of normal noise, in sigmas
+HALF_NORMAL_P90 = 1.645
+HEATMAP_DECAY_INTERVAL = 60
+HEATMAP_MIN_FRAMES = 300
+DHASH_SIZE = 16
+DIRECTIONS = {'up': (0, -1), 'down': (0, 1), 'left': (-1, 0), 'right': (1, 0)}
+FLOW_WINDOW = (15, 15)
+FLOW_LEVELS = 2
+FLOW_MIN_POINTS = 2
+SHEET_QUALITY = 85
+OFFLOAD_MAX_MESSAGE = 4 * 1024 * 1024
+OFFLOAD_MAX_DELAY = 10
+GRAB_RETRY = 0.1
+STREAM_TIMEOUT = 10
+STREAM_RETRY = 0.5
+STREAM_MAX_RETRY = 10
+STREAM_MAX_LINE = 64 * 1024
+STREAM_MAX_FRAME = 16 * 1024 * 1024
+JPEG_SCALES = (8, 4, 2)
+WATCHDOG_INTERVAL = 1.0
+GRAB_JOIN_TIMEOUT = 2.0
+# what to give up, in order, while frames take longer than latency_target
+SHED_STEPS = ('skip_stale', 'no_boxes', 'low_resolution', 'defer_writes')
+SHED_HOLD = 1.0
+MAX_PENDING_WRITES = 8
+# the pools whose budgets come from the frame size rather than a constant
+FRAME_POOLS = ('background', 'heatmap', 'frame')
+MEMORY_BUDGETS = {'pending_writes': 16 * 1024 * 1024, 'contact_sheet': 4 * 1024 * 1024}
+LOW_MEMORY_BUDGETS = {'pending_writes': 2 * 1024 * 1024, 'contact_sheet': 1024 * 1024}
+MEMORY_STEPS = ('contact_sheet', 'pending_writes', 'classifier', 'heatmap')
+MEMORY_CHECK_INTERVAL = 5
+MEMORY_RESTORE = 0.8
+MEMORY_HOLD = 60
+PROFILE_MAX_SECONDS = 120
+PROFILE_INTERVAL = 0.005
+PROFILE_SORTS = ('cumulative', 'tottime', 'calls', 'ncalls', 'time')
+TRACEMALLOC_FRAMES = 10
+ARMING_INTERVAL = 15
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+# admin endpoints that arm, disarm or go back to following arm_schedule
+ARMING_PATHS = {b'/admin/arm': True, b'/admin/disarm': False, b'/admin/schedule': None}
+ADMIN_PATHS = (b'/admin/reload', b'/admin/profile', b'/admin/memory') + tuple(ARMING_PATHS)
+MIN_UPLOAD_BUDGET = 16 * 1024
+UPLOAD_SCALE_STEP = 0.75
+CROP_MARGIN = 0.15
+HOG_WINDOW = (64, 128)
+DNN_INPUT_SIZE = (300, 300)
+DNN_SCALE = 0.007843
+DNN_MEAN = 127.5
+# class names for the MobileNet-SSD caffe model, in class id order
+MOBILENET_SSD_LABELS = ["background", "aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car", "cat",
+                        "chair", "cow", "diningtable", "dog", "horse", "motorbike", "person", "pottedplant",
+                        "sheep", "sofa", "train", "tvmonitor"]
+
+# config settings: (allowed types, required, component rebuilt when it changes
+# on reload - '' means it's picked up next time it's used, None means it only
+# takes effect after a restart)
+CONF_SCHEMA = {
+    "camera_warmup_time": ((int, float), True, ''),
+    "delta_thresh": ((int, float), True, 'detector'),
+    "blur_size": (int, False, 'detector'),
+    "resolution": (list, True, 'camera'),
+    "replay": (str, False, 'camera'),
+    "replay_fps": ((int, float), False, 'camera'),
+    "stream": (str, False, 'camera'),
+    "stream_timeout": ((int, float), False, 'camera'),
+    "stream_save_original": (bool, False, 'storage'),
+    "capture_timeout": ((int, float), False, 'detector'),
+    "capture_max_failures": (int, False, 'detector'),
+    "capture_max_backoff": ((int, float), False, 'detector'),
+    "min_area": ((int, float), True, 'detector'),
+    "calibrate": (bool, False, 'detector'),
+    "calibrate_frames": (int, False, 'detector'),
+    "calibrate_interval": ((int, float), False, 'detector'),
+    "calibrate_pixel_rate": ((int, float), False, 'detector'),
+    "calibrate_trigger_rate": ((int, float), False, 'detector'),
+    "calibrate_margin": ((int, float), False, 'detector'),
+    "lighting_threshold": ((int, float), False, 'detector'),
+    "lighting_settle_time": ((int, float), False, 'detector'),
+    "heatmap": (bool, False, 'detector'),
+    "heatmap_block": (int, False, 'detector'),
+    "heatmap_half_life": ((int, float), False, 'detector'),
+    "heatmap_auto_mask": (bool, False, 'detector'),
+    "heatmap_mask_threshold": ((int, float), False, 'detector'),
+    "draw_boxes": (bool, True, 'detector'),
+    "latency_target": ((int, float), False, 'detector'),
+    "tracking": (bool, False, 'detector'),
+    "track_max_distance": ((int, float), False, 'detector'),
+    "track_max_missing": (int, False, 'detector'),
+    "track_min_frames": (int, False, 'detector'),
+    "track_trigger_count": (int, False, 'detector'),
+    "classifier": (str, False, 'detector'),
+    "classifier_model": (str, False, 'detector'),
+    "classifier_config": (str, False, 'detector'),
+    "classifier_labels": (list, False, 'detector'),
+    "classifier_classes": (list, False, 'detector'),
+    "classifier_confidence": ((int, float), False, 'detector'),
+    "classifier_workers": (int, False, 'detector'),
+    "classifier_budget": ((int, float), False, 'detector'),
+    "classifier_interval": ((int, float), False, 'detector'),
+    "arm_schedule": (list, False, 'detector'),
+    "disarmed_mode": (str, False, 'detector'),
+    "disarmed_interval": ((int, float), False, 'detector'),
+    "dedup": (bool, False, 'detector'),
+    "dedup_distance": (int, False, 'detector'),
+    "dedup_recent": (int, False, 'detector'),
+    "tripwires": (list, False, 'detector'),
+    "tripwire_points": (int, False, 'detector'),
+    "tripwire_hold": ((int, float), False, 'detector'),
+    "tripwire_min_motion": ((int, float), False, 'detector'),
+    "offload": (str, False, 'detector'),
+    "offload_width": (int, False, 'detector'),
+    "offload_quality": (int, False, 'detector'),
+    "offload_timeout": ((int, float), False, 'detector'),
+    "contact_sheet": (bool, False, 'storage'),
+    "contact_sheet_frames": (int, False, 'storage'),
+    "contact_sheet_tile_width": (int, False, 'storage'),
+    "basepath": (str, True, 'storage'),
+    "s3bucket": (str, True, 'storage'),
+    "s3folder": (str, True, 'storage'),
+    "s3_endpoint": (str, False, None),
+    "upload_max_bytes": (int, False, 'storage'),
+    "upload_format": (str, False, 'storage'),
+    "upload_min_quality": (int, False, 'storage'),
+    "upload_max_quality": (int, False, 'storage'),
+    "upload_progressive": (bool, False, 'storage'),
+    "upload_optimize": (bool, False, 'storage'),
+    "upload_min_width": (int, False, 'storage'),
+    "upload_target_seconds": ((int, float), False, 'storage'),
+    "baseimageurl": (str, True, 'storage'),
+    "blankimage": (str, True, 'storage'),
+    "fileext": (str, True, 'storage'),
+    "http_port": (int, True, 'http'),
+    "admin_token": (str, False, 'http'),
+    "device_index": (int, True, None),
+    "subscription_file": (str, False, None),
+    "events_file": (str, False, None),
+    "background_file": (str, False, None),
+    "heatmap_file": (str, False, None),
+    "background_snapshot_interval": ((int, float), False, None),
+    "background_max_age": ((int, float), False, ''),
+    "ssdp_announce_interval": ((int, float), False, 'ssdp'),
+    "ssdp_rate_limit": ((int, float), False, 'ssdp'),
+    "debug": (bool, True, 'logging'),
+    "log_file": (str, False, 'logging'),
+    "log_max_bytes": (int, False, 'logging'),
+    "log_backups": (int, False, 'logging'),
+    "log_levels": (dict, False, 'logging'),
+    "log_rate": ((int, float), False, 'logging'),
+    "log_burst": (int, False, 'logging'),
+    "low_memory": (bool, False, 'detector'),
+    "capture_gray": (bool, False, 'camera'),
+    "memory_limit": ((int, float), False, 'detector'),
+    "memory_budgets": (dict, False, 'detector'),
+    "daysold": (int, False, ''),
+}
+
+S3 = None
+S3_LOCK = threading.Lock()
+# an S3 compatible endpoint to use instead of AWS, set from s3_endpoint
+S3_ENDPOINT = None
+
+
+def load_camera_modules(camera=True):
+    """Import the vision and camera modules, called from a worker thread.
+       picamera is left out when replaying, so tests can run off the Pi, or
+       streaming from a network camera."""
+    global cv2, imutils, np, PiCamera, PiRGBArray # pylint: disable=global-statement,invalid-name
+    import cv2
+    import imutils
+    import numpy as np
+    if camera:
+        from picamera import PiCamera
+        from picamera.array import PiRGBArray
+
+
+def get_s3():
+    """Create the S3 resource on first use - boto3 is slow to import, so
+       this is first called from a worker thread at startup"""
+    global S3 # pylint: disable=global-statement
+    with S3_LOCK:
+        if S3 is None:
+            try:
+                import boto3
+                if S3_ENDPOINT:
+                    from botocore.config import Config
+                    S3 = boto3.session.Session().resource('s3', endpoint_url=S3_ENDPOINT,
+                                                          config=Config(s3={'addressing_style': 'path'}))
+                else:
+                    S3 = boto3.session.Session().resource('s3')
+            except Exception as error: # pylint: disable=broad-except
+                LOG.error("ERROR: Unable to create AWS S3 resource, AWS returned an error.")
+                LOG.info("%s", error)
+    return S3
+
+
+def upload_to_s3(filename, bucket, key):
+    """Upload a local image to S3 as public-read, returns False if it failed"""
+    from botocore.exceptions import BotoCoreError, ClientError
+    s3 = get_s3()
+    if s3 is None:
+        return False
+    try:
+        s3.meta.client.upload_file(filename, bucket, key, ExtraArgs={'ACL': 'public-read', 'ContentType': 'image/jpeg'})
+    except (BotoCoreError, ClientError) as error:
+        LOG.error("ERROR: Unable to upload file, AWS returned an error.")
+        LOG.info("%s", error)
+        return False
+    return True
+
+
+def put_to_s3(data, bucket, key, content_type='image/jpeg'):
+    """Upload encoded image bytes to S3 as public-read, returns False if it failed"""
+    from botocore.exceptions import BotoCoreError, ClientError
+    s3 = get_s3()
+    if s3 is None:
+        return False
+    try:
+        s3.meta.client.put_object(Bucket=bucket, Key=key, Body=data, ACL='public-read', ContentType=content_type)
+    except (BotoCoreError, ClientError) as error:
+        LOG.error("ERROR: Unable to upload file, AWS returned an error.")
+        LOG.info("%s", error)
+        return False
+    return True
+
+
+class StartupTimer(object):
+    """Records when each startup phase began and how long it took. Phases
+       can run in parallel on different threads."""
+
+    def __init__(self, started=LAUNCH_TIME):
+        self.started = started
+        self.phases = []
+
+    def record(self, name, begin, end):
+        """Add a phase that has already finished"""
+        self.phases.append((name, begin - self.started, end - begin))
+
+    @contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as a phase"""
+        begin = time()
+        try:
+            yield
+        finally:
+            self.record(name, begin, time())
+
+    def timed(self, name, func, *args, **kwargs):
+        """Call func as a phase and return its result"""
+        with self.phase(name):
+            return func(*args, **kwargs)
+
+    def report(self, title='Startup'):
+        """Log every phase, in the order they started"""
+        for name, offset, duration in sorted(self.phases, key=lambda phase: phase[1]):
+            LOG.info('%s: %-16s started at %6.2fs and took %6.2fs', title, name, offset, duration)
+        LOG.info('%s: finished after %.2fs', title, time() - self.started)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through a burst of messages from any one line of code and then
+       'rate' a second, noting how many were dropped on the next one that
+       gets through. Errors always get through."""
+
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sites = {}
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.rate or record.levelno >= logging.ERROR:
+            return True
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            tokens, last, dropped = self.sites.get(key, (self.burst, record.created, 0))
+            tokens = min(self.burst, tokens + (record.created - last) * self.rate)
+            if tokens < 1:
+                self.sites[key] = (tokens, record.created, dropped + 1)
+                self.suppressed += 1
+                return False
+            self.sites[key] = (tokens - 1, record.created, 0)
+        if dropped:
+            record.msg = '%s (%d similar messages suppressed)' % (record.getMessage(), dropped)
+            record.args = None
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread, dropping them rather than
+       blocking if it has fallen a long way behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(object):
+    """Moves log output off the reactor and frame threads: records are
+       rate limited and queued by the thread that logs them and written by a
+       background thread, to a size-rotated file if log_file is set"""
+
+    def __init__(self):
+        self.listener = None
+        self.handler = None
+        self.limiter = None
+        self.levels = set()
+
+    def configure(self, conf):
+        """Set up (or redo, on reload) where and how much we log"""
+        if conf.get("log_file"):
+            try:
+                output = logging.handlers.RotatingFileHandler(conf["log_file"],
+                                                              maxBytes=conf.get("log_max_bytes", LOG_MAX_BYTES),
+                                                              backupCount=conf.get("log_backups", 3))
+            except OSError as error:
+                LOG.error("ERROR: Unable to open log file %s, logging to stderr: %s", conf["log_file"], error)
+                output = logging.StreamHandler()
+        else:
+            output = logging.StreamHandler()
+        output.setFormatter(logging.Formatter(_FORMAT))
+
+        root = logging.getLogger()
+        self.stop()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        self.limiter = RateLimitFilter(conf.get("log_rate", 5), conf.get("log_burst", 20))
+        self.handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        self.handler.addFilter(self.limiter)
+        root.addHandler(self.handler)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, output)
+        self.listener.start()
+
+        root.setLevel(logging.DEBUG if conf["debug"] else logging.INFO)
+        for name in self.levels - set(conf.get("log_levels", {})):
+            logging.getLogger(name).setLevel(logging.NOTSET)
+        for name, level in conf.get("log_levels", {}).items():
+            logging.getLogger(name).setLevel(level.upper())
+        self.levels = set(conf.get("log_levels", {}))
+
+    def stop(self):
+        """Write out whatever is queued and stop the writer thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            for output in self.listener.handlers:
+                output.close()
+            self.listener = None
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        return {'suppressed': self.limiter.suppressed if self.limiter is not None else 0,
+                'dropped': self.handler.dropped if self.handler is not None else 0}
+
+
+def validate_conf(conf):
+    """Check a loaded config against CONF_SCHEMA, returns a list of problems"""
+    errors = []
+    for key, (types, required, _) in sorted(CONF_SCHEMA.items()):
+        if key not in conf:
+            if required:
+                errors.append('%s is missing' % key)
+            continue
+        value = conf[key]
+        types = types if isinstance(types, tuple) else (types,)
+        # bool is an int as far as isinstance is concerned
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            errors.append('%s should be %s' % (key, ' or '.join(t.__name__ for t in types)))
+    if errors:
+        return errors
+
+    resolution = conf["resolution"]
+    if len(resolution) != 2 or not all(isinstance(x, int) and x > 0 for x in resolution):
+        errors.append('resolution should be [width, height]')
+    if not 0 < conf["http_port"] < 65536:
+        errors.append('http_port should be between 1 and 65535')
+    if not 0 < conf["delta_thresh"] < 256:
+        errors.append('delta_thresh should be between 1 and 255')
+    if conf.get("blur_size", BLUR_KERNEL[0]) < 1 or conf.get("blur_size", BLUR_KERNEL[0]) % 2 == 0:
+        errors.append('blur_size should be a positive odd number')
+    for key in ("min_area", "camera_warmup_time", "ssdp_announce_interval", "ssdp_rate_limit",
+                "background_snapshot_interval", "background_max_age", "lighting_settle_time",
+                "track_max_distance", "track_max_missing", "track_min_frames", "track_trigger_count",
+                "classifier_confidence", "classifier_budget", "classifier_interval", "latency_target",
+                "replay_fps", "log_max_bytes", "log_backups", "log_rate", "log_burst", "memory_limit",
+                "capture_timeout", "capture_max_failures", "capture_max_backoff",
+                "upload_max_bytes", "upload_min_width", "upload_target_seconds", "disarmed_interval",
+                "heatmap_half_life", "dedup_distance", "offload_timeout", "tripwire_hold",
+                "tripwire_min_motion"):
+        if conf.get(key, 0) < 0:
+            errors.append('%s should not be negative' % key)
+    if conf.get("stream") and urlsplit(conf["stream"]).scheme not in ('http', 'https', 'rtsp'):
+        errors.append('stream should be an http://, https:// or rtsp:// URL')
+    if conf.get("stream_timeout", STREAM_TIMEOUT) <= 0:
+        errors.append('stream_timeout should be positive')
+    offload = conf.get("offload", "")
+    if offload and not (':' in offload and offload.rsplit(':', 1)[1].isdigit()):
+        errors.append('offload should be the aggregator\'s "host:port"')
+    if conf.get("offload_width", 320) < 16 or not 1 <= conf.get("offload_quality", 70) <= 100:
+        errors.append('offload_width should be at least 16 and offload_quality 1 to 100')
+    for rule in conf.get("tripwires", []):
+        try:
+            parse_tripwire(rule, 0)
+        except (KeyError, TypeError, ValueError):
+            errors.append('tripwires entries should be like {"name": "driveway", "line": [[0, 300], [640, 260]], '
+                          '"direction": "up"} with a line, a direction of %s or both' % ', '.join(sorted(DIRECTIONS)))
+            break
+    if conf.get("tripwire_points", 40) < FLOW_MIN_POINTS:
+        errors.append('tripwire_points should be at least %d' % FLOW_MIN_POINTS)
+    if conf.get("calibrate_frames", 100) < 1 or conf.get("calibrate_interval", 600) < 0:
+        errors.append('calibrate_frames should be at least 1 and calibrate_interval not negative')
+    if not (0 < conf.get("calibrate_pixel_rate", 0.001) < 1 and 0 <= conf.get("calibrate_trigger_rate", 0.01) < 1):
+        errors.append('calibrate_pixel_rate and calibrate_trigger_rate should be fractions between 0 and 1')
+    if conf.get("calibrate_margin", 1.5) < 1:
+        errors.append('calibrate_margin should be at least 1')
+    for pool, budget in sorted(conf.get("memory_budgets", {}).items()):
+        if pool not in set(MEMORY_BUDGETS) | set(FRAME_POOLS) or not isinstance(budget, int) or isinstance(budget, bool) or budget < 0:
+            errors.append('memory_budgets should map %s to a number of bytes' %
+                          ' or '.join(sorted(set(MEMORY_BUDGETS) | set(FRAME_POOLS))))
+            break
+    if conf.get("dedup_recent", 8) < 1:
+        errors.append('dedup_recent should be at least 1')
+    if conf.get("contact_sheet_frames", 9) < 1 or conf.get("contact_sheet_tile_width", 320) < 16:
+        errors.append('contact_sheet_frames should be at least 1 and contact_sheet_tile_width at least 16')
+    if conf.get("heatmap_block", 16) < 1:
+        errors.append('heatmap_block should be at least 1')
+    if not 0 < conf.get("heatmap_mask_threshold", 0.5) <= 1:
+        errors.append('heatmap_mask_threshold should be a fraction of the frames between 0 and 1')
+    for window in conf.get("arm_schedule", []):
+        try:
+            parse_clock(window["start"])
+            parse_clock(window["end"])
+            if not set(window.get("days", DAY_NAMES)) <= set(DAY_NAMES):
+                raise ValueError
+        except (KeyError, TypeError, ValueError):
+            errors.append('arm_schedule entries should be like {"start": "22:30", "end": "07:00", "days": ["mon", "tue"]}')
+            break
+    if conf.get("disarmed_mode", "idle") not in ("idle", "closed"):
+        errors.append('disarmed_mode should be "idle" or "closed"')
+    if not 1 <= conf.get("upload_min_quality", 40) <= conf.get("upload_max_quality", 90) <= 100:
+        errors.append('upload_min_quality and upload_max_quality should be 1 to 100, min first')
+    if conf.get("upload_format", "jpeg") not in ("jpeg", "webp"):
+        errors.append('upload_format should be "jpeg" or "webp"')
+    if conf.get("classifier", "") not in ("", "hog", "dnn"):
+        errors.append('classifier should be "hog", "dnn" or ""')
+    if conf.get("classifier") == "dnn" and not conf.get("classifier_model"):
+        errors.append('classifier_model is needed for the dnn classifier')
+    if conf.get("classifier_workers", 1) < 1:
+        errors.append('classifier_workers should be at least 1')
+    for name, level in sorted(conf.get("log_levels", {}).items()):
+        if not isinstance(level, str) or not isinstance(logging.getLevelName(level.upper()), int):
+            errors.append('log_levels %s should be a level name like "WARNING"' % name)
+    if not 0 <= conf.get("lighting_threshold", 0) <= 1:
+        errors.append('lighting_threshold should be a fraction of the frame between 0 and 1')
+    for key in sorted(set(conf) - set(CONF_SCHEMA)):
+        LOG.warning('Ignoring unknown config setting %s', key)
+    return errors
+
+
+def load_conf(path):
+    """Load and validate the JSON config, raising ValueError if it's no good"""
+    with open(path) as conf_file:
+        conf = json.load(conf_file)
+    if not isinstance(conf, dict):
+        raise ValueError('configuration should be a JSON object')
+    errors = validate_conf(conf)
+    if errors:
+        raise ValueError('; '.join(errors))
+    return conf
+
+
+def parse_args(args):
+    """ Parse the arguments passed to this script """
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--conf', required=True, help="path to JSON config file")
+    return argp.parse_args(args)
+
+
+def determine_ip_for_host(host):
+    """Determine local IP address used to communicate with a particular host"""
+    # connecting a UDP socket sends nothing, it just asks the kernel for a route
+    test_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        test_sock.connect((host, SSDP_PORT))
+        my_ip = test_sock.getsockname()[0]
+    finally:
+        test_sock.close()
+    return my_ip
+
+
+class LocalIPCache(object):
+    """Remembers the local IP address used to reach each source network so
+       we don't need a route lookup for every M-SEARCH"""
+
+    def __init__(self, ttl=IP_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, host):
+        """Return the local IP used to talk to host, refreshing it once the
+           cached entry for its /24 network has expired"""
+        network = host.rsplit('.', 1)[0]
+        now = time()
+        entry = self.entries.get(network)
+        if entry is None or entry[1] < now:
+            entry = (determine_ip_for_host(host), now + self.ttl)
+            self.entries[network] = entry
+        return entry[0]
+
+    def clear(self):
+        """Forget all cached addresses"""
+        self.entries.clear()
+
+
+class SubscriptionRegistry(object):
+    """Hub subscriptions keyed by SID. Expirations are kept in a heap so only
+       the next one to expire needs a timer, and the registry is saved to disk
+       so notifications resume straight after a restart."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.subscriptions = {}
+        self.expiry = []
+        self.timer = None
+        self.load()
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def callbacks(self):
+        """Return the callback URLs of all live subscriptions"""
+        return [sub['callback'] for sub in self.subscriptions.values()]
+
+    def find(self, callback):
+        """Return the SID subscribed with callback, or None"""
+        for sid, sub in self.subscriptions.items():
+            if sub['callback'] == callback:
+                return sid
+        return None
+
+    def subscribe(self, callback, timeout=SUBSCRIPTION_TIMEOUT):
+        """Add a subscription (or refresh the one already using callback) and
+           return its SID"""
+        sid = self.find(callback)
+        if sid is None:
+            sid = 'uuid:%s' % uuid.uuid4()
+            self.subscriptions[sid] = {'callback': callback}
+            LOG.info('Added subscription %s (%s)', callback, sid)
+        else:
+            LOG.info('Refreshed subscription %s (%s)', callback, sid)
+        self.set_expiration(sid, timeout)
+        return sid
+
+    def renew(self, sid, timeout=SUBSCRIPTION_TIMEOUT):
+        """Extend an existing subscription, returns False if sid is unknown"""
+        if sid not in self.subscriptions:
+            return False
+        LOG.info('Renewed subscription %s', sid)
+        self.set_expiration(sid, timeout)
+        return True
+
+    def unsubscribe(self, sid):
+        """Remove a subscription, returns False if sid is unknown. Its heap
+           entry is left behind and skipped when it comes up."""
+        if self.subscriptions.pop(sid, None) is None:
+            return False
+        LOG.info('Removed subscription %s', sid)
+        self.save()
+        return True
+
+    def set_expiration(self, sid, timeout):
+        expiration = time() + timeout
+        self.subscriptions[sid]['expiration'] = expiration
+        heapq.heappush(self.expiry, (expiration, sid))
+        if len(self.expiry) > 2 * len(self.subscriptions) + 16:
+            # too many stale heap entries from renewals - rebuild it
+            self.expiry = [(sub['expiration'], key) for key, sub in self.subscriptions.items()]
+            heapq.heapify(self.expiry)
+        self.save()
+        self.schedule()
+
+    def expire(self):
+        """Drop every subscription whose expiration has passed"""
+        self.timer = None
+        now = time()
+        changed = False
+        while self.expiry and self.expiry[0][0] <= now:
+            expiration, sid = heapq.heappop(self.expiry)
+            sub = self.subscriptions.get(sid)
+            # skip entries left behind by renewals and unsubscribes
+            if sub is not None and sub['expiration'] == expiration:
+                LOG.info('Subscription %s (%s) expired', sub['callback'], sid)
+                del self.subscriptions[sid]
+                changed = True
+        if changed:
+            self.save()
+        self.schedule()
+
+    def schedule(self):
+        """Arm a single timer for the earliest expiration"""
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        if self.expiry:
+            delay = max(0, self.expiry[0][0] - time())
+            self.timer = reactor.callLater(delay, self.expire) # pylint: disable=no-member
+
+    def load(self):
+        """Reload saved subscriptions, dropping any that expired while we
+           were down"""
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as saved:
+                subscriptions = json.load(saved)
+        except (OSError, ValueError) as error:
+            LOG.error("ERROR: Unable to read subscriptions from %s: %s", self.path, error)
+            return
+        now = time()
+        for sid, sub in subscriptions.items():
+            if sub.get('expiration', 0) > now and sub.get('callback'):
+                self.subscriptions[sid] = sub
+                self.expiry.append((sub['expiration'], sid))
+        heapq.heapify(self.expiry)
+        LOG.info('Restored %d subscriptions from %s', len(self.subscriptions), self.path)
+        self.schedule()
+
+    def save(self):
+        """Write the subscriptions out atomically"""
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as saved:
+                json.dump(self.subscriptions, saved)
+            os.replace(tmp_path, self.path)
+        except OSError as error:
+            LOG.error("ERROR: Unable to save subscriptions to %s: %s", self.path, error)
+
+
+class EventLog(object):
+    """Append-only JSON lines file of motion events, one per line in start
+       order. A fixed-size (start, offset, length) index kept alongside it
+       lets a time range be served straight from the file without parsing."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.starts = []
+        self.offsets = []
+        self.size = 0
+        self.load()
+        self.events = open(self.path, 'ab')
+        self.index = open(self.index_path, 'ab')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def load(self):
+        """Read the index, rebuilding it from the events if they disagree"""
+        entries = []
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'rb') as index:
+                data = index.read()
+            usable = len(data) - len(data) % EVENT_INDEX.size
+            entries = [EVENT_INDEX.unpack_from(data, pos) for pos in range(0, usable, EVENT_INDEX.size)]
+        size = os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+        end = entries[-1][1] + entries[-1][2] if entries else 0
+        if end != size:
+            entries = self.rebuild()
+        self.starts = [entry[0] for entry in entries]
+        self.offsets = [entry[1] for entry in entries]
+        self.size = entries[-1][1] + entries[-1][2] if entries else 0
+        LOG.info('Loaded %d events from %s', len(entries), self.path)
+
+    def rebuild(self):
+        """Scan the events file and write a new index. A partial last line
+           (we were killed mid-write) is cut off."""
+        LOG.info('Rebuilding event index for %s', self.path)
+        entries = []
+        offset = 0
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as events:
+                for line in events:
+                    try:
+                        start = float(json.loads(line.decode())['start'])
+                    except (ValueError, KeyError, TypeError):
+                        break
+                    entries.append((start, offset, len(line)))
+                    offset += len(line)
+            with open(self.path, 'ab') as events:
+                events.truncate(offset)
+        with open(self.index_path, 'wb') as index:
+            for entry in entries:
+                index.write(EVENT_INDEX.pack(*entry))
+        return entries
+
+    def append(self, event):
+        """Add a finished event, giving it the next id"""
+        event['id'] = len(self.starts) + 1
+        line = bytes(json.dumps(event, sort_keys=True) + '\n', 'utf-8')
+        # the index has to stay sorted even if the clock steps backwards
+        start = max(event['start'], self.starts[-1]) if self.starts else event['start']
+        try:
+            self.events.write(line)
+            self.events.flush()
+            self.index.write(EVENT_INDEX.pack(start, self.size, len(line)))
+            self.index.flush()
+        except OSError as error:
+            LOG.error("ERROR: Unable to record event: %s", error)
+            return
+        self.starts.append(start)
+        self.offsets.append(self.size)
+        self.size += len(line)
+
+    def query(self, since, until, limit, skip=0):
+        """Find the events starting in [since, until), after the first skip of
+           them, at most limit of them. Returns (offset, size, count, next_page)
+           where next_page is the (since, skip) the next page starts at, or None
+           if this is the last page. The skip keeps events sharing a start time
+           from coming back on two pages."""
+        first = min(bisect.bisect_left(self.starts, since) + skip, len(self.starts))
+        last = max(bisect.bisect_left(self.starts, until), first)
+        next_page = None
+        if last - first > limit:
+            last = first + limit
+            next_since = self.starts[last]
+            next_page = (next_since, last - bisect.bisect_left(self.starts, next_since))
+        if first >= last:
+            return 0, 0, 0, next_page
+        end = self.offsets[last] if last < len(self.offsets) else self.size
+        return self.offsets[first], end - self.offsets[first], last - first, next_page
+
+
+def memory_budgets(conf, seen=None):
+    """The byte budget for each buffer pool - smaller with low_memory - with
+       any memory_budgets overrides. The background model, heatmap and the
+       newest frame are sized by the frames: seen is the (width, height)
+       they're checked at and the bytes of one as captured, once one has
+       come in, and until then it's what the resolution needs. Cameras keep
+       their own aspect ratio, so that can differ."""
+    low_memory = conf.get("low_memory", False)
+    budgets = dict(LOW_MEMORY_BUDGETS if low_memory else MEMORY_BUDGETS)
+    width, height = seen[0] if seen else conf["resolution"][:2]
+    block = conf.get("heatmap_block", 16)
+    budgets['background'] = width * height * (4 if low_memory else 8)
+    budgets['heatmap'] = max(1, height // block) * max(1, width // block) * 4
+    budgets['frame'] = seen[1] if seen else width * height * (1 if capture_gray(conf) else 3)
+    budgets.update(conf.get("memory_budgets", {}))
+    return budgets
+
+
+def saves_original(conf):
+    """Whether a network camera's own JPEGs are saved as they came"""
+    return conf.get("stream_save_original", True) and conf["fileext"].lower() in ('.jpg', '.jpeg')
+
+
+def capture_gray(conf):
+    """Whether frames are captured in gray: as capture_gray says, or if it
+       isn't set, with low_memory when nothing kept needs colour - the frames
+       saved are a network camera's own JPEGs, and there's no contact sheet
+       or re-encoded upload made from them"""
+    if "capture_gray" in conf:
+        return conf["capture_gray"]
+    return bool(conf.get("low_memory", False) and conf.get("stream") and saves_original(conf) and
+                not conf.get("contact_sheet", False) and not conf.get("upload_max_bytes", 0))
+
+
+def memory_usage():
+    """The (current, peak) resident memory in bytes. The current figure needs
+       /proc, elsewhere it's None."""
+    peak = getrusage(RUSAGE_SELF).ru_maxrss
+    # Linux counts in KB, macOS in bytes
+    peak *= 1 if sys.platform == 'darwin' else 1024
+    try:
+        with open('/proc/self/statm') as statm:
+            rss = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        rss = None
+    return rss, peak
+
+
+def release_memory():
+    """Collect garbage and hand freed heap back to the system, which glibc
+       doesn't do by itself for small allocations"""
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def parse_timeout(value):
+    """Parse a GENA TIMEOUT header (Second-N or Second-infinite)"""
+    if value:
+        value = value.decode(errors='replace').strip().lower()
+        if value.startswith('second-') and value[7:].isdigit():
+            return min(int(value[7:]), SUBSCRIPTION_TIMEOUT)
+    return SUBSCRIPTION_TIMEOUT
+
+
+def parse_clock(value):
+    """Minutes after midnight for a "HH:MM" time of day"""
+    hours, minutes = value.split(':')
+    if not (0 <= int(hours) < 24 and 0 <= int(minutes) < 60):
+        raise ValueError('%s is not a time of day' % value)
+    return int(hours) * 60 + int(minutes)
+
+
+def offload_message(header, payload=b''):
+    """A message to or from the aggregator: a line of JSON, then any
+       binary payload"""
+    return bytes(json.dumps(header), 'utf-8') + b'\n' + payload
+
+
+def parse_offload_message(data):
+    """Split an aggregator message into its header and payload"""
+    header, _, payload = data.partition(b'\n')
+    return json.loads(header.decode('utf-8')), payload
+
+
+@implementer(IBodyProducer)
+class StringProducer(object):
+    """Writes an in-memory string to a Twisted request"""
+
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer): # pylint: disable=invalid-name
+        """Start producing supplied string to the specified consumer"""
+        consumer.write(self.body)
+        return succeed(None)
+
+    def pauseProducing(self): # pylint: disable=invalid-name
+        """Pause producing - no op"""
+        pass
+
+    def stopProducing(self): # pylint: disable=invalid-name
+        """ Stop producing - no op"""
+        pass
+
+
+class Profiler(object):
+    """Profiles the running daemon when an admin asks. Nothing is imported,
+       hooked or traced until then, so it costs nothing the rest of the time."""
+
+    def __init__(self):
+        self.busy = False
+        self.baseline = None
+
+    def done(self, result):
+        """A profile finished (or failed)"""
+        self.busy = False
+        return result
+
+    def sample(self, seconds, limit):
+        """Sample every thread's stack - reactor, frame grabber and workers -
+           from a worker thread. Returns a Deferred text report."""
+        self.busy = True
+        sampled = deferToThread(self.sample_stacks, seconds)
+        sampled.addBoth(self.done)
+        sampled.addCallback(self.format_samples, seconds, limit)
+        return sampled
+
+    def sample_stacks(self, seconds): # pylint: disable=no-self-use
+        """Look at every other thread's stack every PROFILE_INTERVAL, counting
+           the functions on top (own time) and anywhere in it (total time)"""
+        me = threading.get_ident()
+        threads = {}
+        end = time() + seconds
+        while time() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items(): # pylint: disable=protected-access
+                if ident == me:
+                    continue
+                counts = threads.setdefault(names.get(ident, str(ident)), [0, collections.Counter(), collections.Counter()])
+                counts[0] += 1
+                own, total = counts[1], counts[2]
+                seen = set()
+                while frame is not None:
+                    code = frame.f_code
+                    function = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                    if not seen:
+                        own[function] += 1
+                    if function not in seen:
+                        total[function] += 1
+                        seen.add(function)
+                    frame = frame.f_back
+            sleep(PROFILE_INTERVAL)
+        return threads
+
+    def format_samples(self, threads, seconds, limit): # pylint: disable=no-self-use
+        """The busiest functions in each thread by the share of samples they
+           were running in"""
+        lines = ['Sampled every %.0fms for %.1fs' % (PROFILE_INTERVAL * 1000, seconds)]
+        for name, (samples, own, total) in sorted(threads.items()):
+            lines.append('')
+            lines.append('%s: %d samples' % (name, samples))
+            lines.append('%7s %7s  %s' % ('own%', 'total%', 'function'))
+            for function, count in own.most_common(limit):
+                lines.append('%7.1f %7.1f  %s' % (100.0 * count / samples, 100.0 * total[function] / samples, function))
+        return '\n'.join(lines) + '\n'
+
+    def trace(self, seconds, sort, limit):
+        """cProfile the reactor thread, where frames are analysed and
+           requests answered. Returns a Deferred text report."""
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        self.busy = True
+        traced = deferLater(reactor, seconds, self.format_trace, profiler, sort, limit)
+        traced.addBoth(self.done)
+        return traced
+
+    def format_trace(self, profiler, sort, limit): # pylint: disable=no-self-use
+        """Stop tracing and sort the stats"""
+        import pstats
+        profiler.disable()
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats(sort).print_stats(limit)
+        return report.getvalue()
+
+    def memory(self, action, limit):
+        """tracemalloc: 'start' tracing allocations, 'snapshot' the biggest
+           (compared with the last snapshot if there is one) or 'stop'.
+           Returns a text report, or None if we're not tracing."""
+        import tracemalloc
+        if action == 'start':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.baseline = None
+            return 'Tracing allocations\n'
+        if action == 'stop':
+            tracemalloc.stop()
+            self.baseline = None
+            return 'Stopped tracing allocations\n'
+        if not tracemalloc.is_tracing():
+            return None
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ['Traced memory: %d bytes, %d at peak' % (current, peak)]
+        if self.baseline is None:
+            lines.append('Biggest allocations:')
+            stats = snapshot.statistics('lineno')
+        else:
+            lines.append('Biggest changes since the last snapshot:')
+            stats = snapshot.compare_to(self.baseline, 'lineno')
+        lines += [str(stat) for stat in stats[:limit]]
+        self.baseline = snapshot
+        return '\n'.join(lines) + '\n'
+
+
+class ArmingSchedule(object):
+    """Decides whether we're armed (looking for motion) from arm_schedule, or
+       an arm/disarm request that holds until the schedule next changes, and
+       keeps the time spent in each mode to estimate battery life"""
+
+    def __init__(self, conf):
+        self.armed = True
+        self.since = time()
+        self.durations = collections.Counter()
+        self.changes = 0
+        self.override = None
+        self.override_scheduled = None
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Pick up the schedule, safe to call while running"""
+        self.windows = [(parse_clock(window["start"]), parse_clock(window["end"]),
+                         {DAY_NAMES.index(day) for day in window.get("days", DAY_NAMES)})
+                        for window in conf.get("arm_schedule", [])]
+
+    def scheduled(self, when):
+        """Whether the schedule arms us at datetime when - always with no
+           schedule. A window that ends before it starts runs past midnight,
+           one that ends when it starts lasts all day."""
+        if not self.windows:
+            return True
+        minute = when.hour * 60 + when.minute
+        today = when.weekday()
+        yesterday = (today - 1) % 7
+        for start, end, days in self.windows:
+            if start == end and today in days:
+                return True
+            if start < end and today in days and start <= minute < end:
+                return True
+            if start > end and ((today in days and minute >= start) or (yesterday in days and minute < end)):
+                return True
+        return False
+
+    def wanted(self, now):
+        """Whether we should be armed at unix time now"""
+        scheduled = self.scheduled(datetime.fromtimestamp(now))
+        if self.override is not None and scheduled != self.override_scheduled:
+            LOG.info("The schedule takes over from the %s request", 'arm' if self.override else 'disarm')
+            self.override = None
+        return scheduled if self.override is None else self.override
+
+    def request(self, armed, now):
+        """Arm (True), disarm (False) or go back to the schedule (None)"""
+        self.override = armed
+        self.override_scheduled = self.scheduled(datetime.fromtimestamp(now))
+
+    def change(self, armed, now):
+        """Note that we've armed or disarmed"""
+        self.durations['armed' if self.armed else 'disarmed'] += now - self.since
+        self.armed = armed
+        self.since = now
+        self.changes += 1
+
+    def stats(self):
+        """Time in each mode for the stats endpoint"""
+        durations = collections.Counter(self.durations)
+        durations['armed' if self.armed else 'disarmed'] += time() - self.since
+        total = sum(durations.values())
+        return {'armed': self.armed,
+                'by': 'schedule' if self.override is None else 'request',
+                'since': self.since,
+                'changes': self.changes,
+                'armed_seconds': round(durations['armed']),
+                'disarmed_seconds': round(durations['disarmed']),
+                'armed_fraction': round(durations['armed'] / total, 3) if total else 1.0}
+
+
+class OffloadProtocol(Int32StringReceiver):
+    """Length prefixed messages to and from the aggregator"""
+    MAX_LENGTH = OFFLOAD_MAX_MESSAGE
+
+    def connectionMade(self): # pylint: disable=invalid-name
+        self.factory.connected(self)
+
+    def connectionLost(self, reason=None): # pylint: disable=invalid-name
+        self.factory.lost(self)
+
+    def stringReceived(self, string): # pylint: disable=invalid-name
+        self.factory.received(string)
+
+
+class OffloadClient(ReconnectingClientFactory):
+    """Keeps a connection to a motion detection aggregator on the LAN (see
+       aggregator.py) and sends it small gray frames. It keeps the background
+       model and sends back the regions that moved. Reconnects by itself,
+       and frames are checked locally while it's away."""
+    protocol = OffloadProtocol
+    maxDelay = OFFLOAD_MAX_DELAY
+
+    def __init__(self, address, name, conf):
+        self.address = address
+        self.name = name
+        self.conn = None
+        self.reachable = True
+        self.pending = None
+        self.holdoff = 0
+        self.resume = 0
+        self.seq = 0
+        self.sent = 0
+        self.answered = 0
+        self.timeouts = 0
+        self.round_trip = 0.0
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Pick up offload settings and pass the detector settings on, safe
+           to call while running"""
+        self.width = conf.get("offload_width", 320)
+        self.quality = conf.get("offload_quality", 70)
+        self.timeout = conf.get("offload_timeout", 2)
+        self.settings = {key: value for key, value in conf.items()
+                         if key in CONF_SCHEMA and CONF_SCHEMA[key][2] == 'detector'}
+        self.send_settings()
+
+    def start(self):
+        """Connect, and keep reconnecting"""
+        host, port = self.address.rsplit(':', 1)
+        reactor.connectTCP(host, int(port), self) # pylint: disable=no-member
+
+    def stop(self):
+        """Disconnect for good"""
+        self.stopTrying()
+        if self.conn is not None:
+            self.conn.transport.loseConnection()
+
+    def buildProtocol(self, addr): # pylint: disable=invalid-name
+        self.resetDelay()
+        return ReconnectingClientFactory.buildProtocol(self, addr)
+
+    def clientConnectionFailed(self, connector, reason): # pylint: disable=invalid-name
+        if self.reachable:
+            self.reachable = False
+            LOG.info("ERROR: Can't reach the aggregator at %s (%s), detecting motion locally",
+                     self.address, reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+    def connected(self, conn):
+        """We're connected - tell the aggregator how to detect motion"""
+        LOG.info("Offloading motion detection to the aggregator at %s", self.address)
+        self.reachable = True
+        self.conn = conn
+        self.send_settings()
+
+    def lost(self, conn):
+        """The connection dropped - fail any frame it was checking"""
+        if self.conn is conn:
+            self.conn = None
+            LOG.info("ERROR: Lost the aggregator at %s, detecting motion locally", self.address)
+        self.fail(ConnectionError('Lost the aggregator at %s' % self.address))
+
+    def send_settings(self):
+        """Send our detector settings"""
+        if self.conn is not None:
+            self.conn.sendString(offload_message({'type': 'configure', 'camera': self.name, 'conf': self.settings}))
+
+    def ready(self):
+        """True if we're connected, not waiting for an answer and not
+           holding off after the aggregator stopped answering"""
+        return self.conn is not None and self.pending is None and time() >= self.resume
+
+    def detect(self, frame, captured):
+        """Send a frame shrunk to offload_width, gray and JPEG encoded, with
+           the time it was captured so the aggregator's lighting settle and
+           heatmap decay follow the camera's clock. Returns the gray frame
+           and a Deferred that fires with the regions that moved, scaled
+           back up to the frame (None if it couldn't be compared), or fails
+           if there's no answer in offload_timeout."""
+        height, width = frame.shape[:2]
+        scale = width / float(self.width)
+        small = cv2.resize(frame, (self.width, max(1, int(round(height / scale)))), interpolation=cv2.INTER_AREA)
+        gray = small if small.ndim == 2 else cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        data = cv2.imencode('.jpg', gray, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1].tobytes()
+        self.seq += 1
+        self.sent += 1
+        answer = Deferred()
+        timeout = reactor.callLater(self.timeout, self.timed_out) # pylint: disable=no-member
+        self.pending = (self.seq, answer, timeout, scale, time())
+        self.conn.sendString(offload_message({'type': 'frame', 'seq': self.seq, 'captured': captured}, data))
+        return gray, answer
+
+    def received(self, data):
+        """An answer from the aggregator"""
+        header, _ = parse_offload_message(data)
+        if header.get('type') != 'result' or self.pending is None or header.get('seq') != self.pending[0]:
+            return
+        _, answer, timeout, scale, sent = self.pending
+        self.pending = None
+        timeout.cancel()
+        self.answered += 1
+        self.holdoff = 0
+        self.round_trip = 0.8 * self.round_trip + 0.2 * (time() - sent)
+        regions = None
+        if header['regions'] is not None:
+            regions = [(area * scale * scale, (int(x * scale), int(y * scale), int(w * scale), int(h * scale)))
+                       for area, x, y, w, h in header['regions']]
+        answer.callback(regions)
+
+    def timed_out(self):
+        """No answer in time - reconnect, and since a stuck aggregator can
+           still accept connections, detect locally for a while longer each
+           time it happens"""
+        self.timeouts += 1
+        self.holdoff = min(OFFLOAD_MAX_DELAY, self.holdoff * 2 or 1)
+        self.resume = time() + self.holdoff
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            conn.transport.loseConnection()
+        self.fail(TimeoutError('No answer from the aggregator at %s in %.1fs' % (self.address, self.timeout)))
+
+    def fail(self, error):
+        """Fail the frame waiting for an answer, if there is one"""
+        if self.pending is None:
+            return
+        _, answer, timeout, _, _ = self.pending
+        self.pending = None
+        if timeout.active():
+            timeout.cancel()
+        answer.errback(Failure(error))
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        return {'address': self.address,
+                'connected': self.conn is not None,
+                'sent': self.sent,
+                'answered': self.answered,
+                'timeouts': self.timeouts,
+                'round_trip': round(self.round_trip, 4)}
+
+
+class SSDPServer(DatagramProtocol):
+    """Receive and response to M-SEARCH discovery requests from SmartThings hub"""
+
+    def __init__(self, interface='', status_port=0, device_target='', announce_interval=0, rate_limit=0): # pylint: disable=too-many-arguments
+        self.interface = interface
+        self.device_target = device_target
+        self.ip_cache = LocalIPCache()
+        self.replies = {}
+        self.buckets = {}
+        self.throttled = 0
+        self.announcer = None
+        self.port = reactor.listenMulticast(SSDP_PORT, self, listenMultiple=True) # pylint: disable=no-member
+        self.port.joinGroup(SSDP_ADDR, interface=interface)
+        self.configure(status_port, announce_interval, rate_limit)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop) # pylint: disable=no-member
+
+    def configure(self, status_port, announce_interval, rate_limit):
+        """Apply settings in place - used at startup and on config reload, so
+           we never have to rejoin the multicast group"""
+        self.status_port = status_port
+        self.rate_limit = rate_limit
+        self.replies.clear()
+        if self.announcer is not None and self.announcer.running:
+            self.announcer.stop()
+        self.announcer = None
+        if announce_interval > 0:
+            self.announcer = LoopingCall(self.announce, 'ssdp:alive')
+            self.announcer.start(announce_interval, now=True)
+
+    def datagramReceived(self, data, address):
+        # only M-SEARCH is of interest, so don't bother parsing anything else
+        if not data.startswith(b'M-SEARCH * '):
+            SSDP_LOG.debug('Ignored SSDP command %s', data[:data.find(b'\r\n')])
+            return
+        header, sep, _ = data.partition(b'\r\n\r\n')
+        if not sep:
+            return
+
+        # we only need the ST header, skip the rest without building a dict
+        search_target = ''
+        for line in header.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'st':
+                search_target = value.strip().decode(errors='replace')
+                break
+
+        if search_target not in self.device_target:
+            SSDP_LOG.debug('%s not in %s', search_target, self.device_target)
+            return
+
+        if not self.allow(address[0]):
+            self.throttled += 1
+            SSDP_LOG.debug('Throttled M-SEARCH for %s from %s:%d', search_target, address[0], address[1])
+            return
+
+        SSDP_LOG.info('Received M-SEARCH * for %s from %s:%d', search_target, address[0], address[1])
+        self.port.write(self.search_reply(search_target, address[0]), address)
+
+    def allow(self, host):
+        """Token bucket per source address - returns False if host has been
+           sending more than rate_limit searches per second"""
+        if self.rate_limit <= 0:
+            return True
+        now = time()
+        tokens, last = self.buckets.get(host, (SSDP_BURST, now))
+        tokens = min(SSDP_BURST, tokens + (now - last) * self.rate_limit)
+        if len(self.buckets) > 256:
+            # drop sources that have been quiet long enough to refill
+            refill = SSDP_BURST / self.rate_limit
+            self.buckets = dict((k, v) for k, v in self.buckets.items() if now - v[1] < refill)
+        if tokens < 1:
+            self.buckets[host] = (tokens, now)
+            return False
+        self.buckets[host] = (tokens - 1, now)
+        return True
+
+    def search_reply(self, search_target, host):
+        """Return the prebuilt M-SEARCH reply for a search target as seen
+           from host's network"""
+        my_ip = self.ip_cache.get(host)
+        key = (search_target, my_ip)
+        reply = self.replies.get(key)
+        if reply is None:
+            url = 'http://%s:%d/status' % (my_ip, self.status_port)
+            reply = bytes(SEARCH_RESPONSE % (url, search_target, UUID, self.device_target), 'utf-8')
+            self.replies[key] = reply
+        return reply
+
+    def announce(self, nts):
+        """Multicast a NOTIFY with the given NTS (ssdp:alive or ssdp:byebye)"""
+        try:
+            url = 'http://%s:%d/status' % (self.ip_cache.get(SSDP_ADDR), self.status_port)
+            msg = NOTIFY_MESSAGE % (SSDP_ADDR, SSDP_PORT, SSDP_MAX_AGE, url, self.device_target,
+                                    nts, UUID, self.device_target)
+            self.port.write(bytes(msg, 'utf-8'), (SSDP_ADDR, SSDP_PORT))
+            SSDP_LOG.debug('Sent %s for %s', nts, self.device_target)
+        except OSError as error:
+            SSDP_LOG.error("ERROR: Unable to send %s: %s", nts, error)
+
+    def stop(self):
+        """Say goodbye, leave multicast group and stop listening"""
+        if self.announcer is not None:
+            if self.announcer.running:
+                self.announcer.stop()
+            self.announce('ssdp:byebye')
+        self.port.leaveGroup(SSDP_ADDR, interface=self.interface)
+        self.port.stopListening()
+
+
+class StatusServer(resource.Resource):
+    """HTTP server that serves the status of the camera to the
+       SmartThings hub"""
+    isLeaf = True
+    def __init__(self, device_target, subscriptions, camera_status, camera_image, service=None, admin_token=None, events=None): # pylint: disable=too-many-arguments
+        self.device_target = device_target
+        self.subscriptions = subscriptions
+        self.camera_status = camera_status
+        self.camera_image = camera_image
+        self.events = events
+        self.service = service
+        self.admin_token = admin_token
+        self.profiler = Profiler()
+        resource.Resource.__init__(self)
+
+    def is_admin(self, request):
+        """Admin requests need 'Authorization: Bearer <admin_token>'. With no
+           admin_token configured the admin endpoints are disabled."""
+        if not self.admin_token:
+            return False
+        expected = bytes('Bearer %s' % self.admin_token, 'utf-8')
+        return hmac.compare_digest(request.getHeader(b'authorization') or b'', expected)
+
+    def render_POST(self, request): # pylint: disable=invalid-name
+        """Handle admin requests"""
+        if request.path in ADMIN_PATHS and self.service is not None:
+            if not self.is_admin(request):
+                HTTP_LOG.info("Refused admin request from %s for %s", request.getClientIP(), request.path)
+                request.setResponseCode(403)
+                return b''
+            if request.path == b'/admin/profile':
+                return self.render_profile(request)
+            if request.path == b'/admin/memory':
+                return self.render_memory(request)
+            if request.path in ARMING_PATHS:
+                result = self.service.set_armed(ARMING_PATHS[request.path])
+            else:
+                result = self.service.reload()
+            if 'errors' in result:
+                request.setResponseCode(400)
+            request.setHeader(b'Content-Type', b'application/json')
+            return bytes(json.dumps(result), 'utf-8')
+
+        HTTP_LOG.info("Received bogus request from %s for %s",
+                      request.getClientIP(),
+                      request.path)
+        request.setResponseCode(404)
+        return b''
+
+    def render_profile(self, request):
+        """Profile for ?seconds= and return the busiest functions as text.
+           mode=sample (the default) samples every thread's stack,
+           mode=cprofile traces the reactor thread sorted by ?sort=."""
+        try:
+            seconds = min(float(request.args.get(b'seconds', [10])[0]), PROFILE_MAX_SECONDS)
+            limit = int(request.args.get(b'limit', [40])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return b'seconds and limit should be numbers\n'
+        mode = request.args.get(b'mode', [b'sample'])[0].decode('utf-8', 'replace')
+        sort = request.args.get(b'sort', [b'cumulative'])[0].decode('utf-8', 'replace')
+        if mode not in ('sample', 'cprofile') or sort not in PROFILE_SORTS:
+            request.setResponseCode(400)
+            return bytes('mode should be sample or cprofile, sort one of %s\n' % ', '.join(PROFILE_SORTS), 'utf-8')
+        if self.profiler.busy:
+            request.setResponseCode(409)
+            return b'A profile is already running\n'
+
+        HTTP_LOG.info("Profiling (%s) for %.0fs for %s", mode, seconds, request.getClientIP())
+        if mode == 'sample':
+            report = self.profiler.sample(seconds, limit)
+        else:
+            report = self.profiler.trace(seconds, sort, limit)
+
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+        def finish(text):
+            if not gone:
+                request.setHeader(b'Content-Type', b'text/plain; charset=utf-8')
+                request.write(bytes(text, 'utf-8'))
+                request.finish()
+        def fail(failure):
+            HTTP_LOG.error("ERROR: Profiling failed: %s", failure.getErrorMessage())
+            if not gone:
+                request.setResponseCode(500)
+                request.finish()
+        report.addCallbacks(finish, fail)
+        return server.NOT_DONE_YET
+
+    def render_memory(self, request):
+        """?action=start|snapshot|stop tracemalloc, snapshots are reported
+           as text"""
+        action = request.args.get(b'action', [b'snapshot'])[0].decode('utf-8', 'replace')
+        try:
+            limit = int(request.args.get(b'limit', [25])[0])
+        except ValueError:
+            limit = -1
+        if action not in ('start', 'snapshot', 'stop') or limit < 0:
+            request.setResponseCode(400)
+            return b'action should be start, snapshot or stop and limit a number\n'
+        report = self.profiler.memory(action, limit)
+        if report is None:
+            request.setResponseCode(409)
+            return b'Not tracing allocations, start first\n'
+        request.setHeader(b'Content-Type', b'text/plain; charset=utf-8')
+        return bytes(report, 'utf-8')
+
+    def render_SUBSCRIBE(self, request): # pylint: disable=invalid-name
+        """Handle subscribe requests from ST hub - hub wants to be notified
+           of status updates"""
+        headers = request.getAllHeaders()
+        HTTP_LOG.info("SUBSCRIBE: %s", headers)
+        timeout = parse_timeout(headers.get(b'timeout'))
+        if b'callback' in headers:
+            # CALLBACK is one or more <url>s, we only use the first
+            cb_url = headers[b'callback'].decode().split('>')[0].lstrip('<').strip()
+            sid = self.subscriptions.subscribe(cb_url, timeout)
+        elif b'sid' in headers:
+            sid = headers[b'sid'].decode().strip()
+            if not self.subscriptions.renew(sid, timeout):
+                HTTP_LOG.info('Renewal for unknown subscription %s', sid)
+                request.setResponseCode(412)
+                return b''
+        else:
+            sid = None
+
+        if sid is not None:
+            request.setHeader(b'SID', bytes(sid, 'utf-8'))
+            request.setHeader(b'TIMEOUT', bytes('Second-%d' % timeout, 'utf-8'))
+
+        imageurl = self.camera_image['last_image']
+        if self.camera_status['last_state'] == 'inactive':
+            cmd = 'status-inactive'
+        else:
+            cmd = 'status-active'
+        msg = '<msg><cmd>%s</cmd><usn>uuid:%s::%s</usn><imageurl>%s</imageurl></msg>' % (cmd, UUID, self.device_target, imageurl)
+        return bytes(msg, 'utf-8')
+
+    def render_UNSUBSCRIBE(self, request): # pylint: disable=invalid-name
+        """Handle unsubscribe requests from ST hub"""
+        sid = request.getHeader(b'sid')
+        if sid is None or not self.subscriptions.unsubscribe(sid.decode().strip()):
+            HTTP_LOG.info("UNSUBSCRIBE for unknown subscription %s", sid)
+            request.setResponseCode(412)
+        return b''
+
+    def render_GET(self, request): # pylint: disable=invalid-name
+        """Handle polling requests from ST hub"""
+        HTTP_LOG.info("GET: %s", request.path)
+        if request.path == b'/status':
+            imageurl = self.camera_image['last_image']
+            if self.camera_status['last_state'] == 'inactive':
+                cmd = 'status-inactive'
+            else:
+                cmd = 'status-active'
+            msg = '<msg><cmd>%s</cmd><usn>uuid:%s::%s</usn><imageurl>%s</imageurl></msg>' % (cmd, UUID, self.device_target, imageurl)
+            HTTP_LOG.info("Polling request from %s for %s - returned %s (%s)",
+                          request.getClientIP(),
+                          request.path,
+                          cmd,
+                          imageurl)
+            return bytes(msg, 'utf-8')
+
+        if request.path == b'/events' and self.events is not None:
+            return self.render_events(request)
+
+        if request.path in (b'/health', b'/health/live', b'/health/ready') and self.service is not None:
+            health = self.service.health()
+            healthy = health['live'] if request.path == b'/health/live' else health['ready']
+            request.setResponseCode(200 if healthy else 503)
+            request.setHeader(b'Content-Type', b'application/json')
+            return bytes(json.dumps(health), 'utf-8')
+
+        if request.path in (b'/heatmap.png', b'/heatmap.npy', b'/heatmap/mask.png') and self.service is not None:
+            heatmap = self.service.heatmap(request.path.decode())
+            if heatmap is None:
+                request.setResponseCode(404)
+                return b'No heatmap yet\n'
+            content_type, body = heatmap
+            request.setHeader(b'Content-Type', content_type)
+            return body
+
+        if request.path == b'/stats' and self.service is not None:
+            request.setHeader(b'Content-Type', b'application/json')
+            return bytes(json.dumps(self.service.stats()), 'utf-8')
+
+        HTTP_LOG.info("Received bogus request from %s for %s",
+                      request.getClientIP(),
+                      request.path)
+        request.setResponseCode(404)
+        return b''
+
+
+    def render_events(self, request):
+        """Stream the events starting in [since, until) as JSON lines, straight
+           from the event log. If there are more than limit, X-Next-Since and
+           X-Next-Skip are the since and skip the next page starts at."""
+        try:
+            since = float(request.args.get(b'since', [0])[0])
+            until = float(request.args.get(b'until', [float('inf')])[0])
+            limit = min(int(request.args.get(b'limit', [1000])[0]), EVENT_QUERY_LIMIT)
+            skip = max(int(request.args.get(b'skip', [0])[0]), 0)
+        except ValueError:
+            request.setResponseCode(400)
+            return b'since and until should be unix times, limit and skip numbers\n'
+
+        offset, size, count, next_page = self.events.query(since, until, max(limit, 1), skip)
+        HTTP_LOG.info("Returning %d events to %s", count, request.getClientIP())
+        request.setHeader(b'Content-Type', b'application/x-ndjson')
+        request.setHeader(b'X-Event-Count', bytes(str(count), 'utf-8'))
+        if next_page is not None:
+            request.setHeader(b'X-Next-Since', bytes(repr(next_page[0]), 'utf-8'))
+            request.setHeader(b'X-Next-Skip', bytes(str(next_page[1]), 'utf-8'))
+        if size == 0:
+            return b''
+        request.setHeader(b'Content-Length', bytes(str(size), 'utf-8'))
+        producer = static.SingleRangeStaticProducer(request, open(self.events.path, 'rb'), offset, size)
+        producer.start()
+        return server.NOT_DONE_YET
+
+
+def normal_tail(rate):
+    """How many sigmas out normal noise has to be for only rate of it to be
+       further from zero"""
+    low, high = 0.0, 40.0
+    for _ in range(60):
+        middle = (low + high) / 2
+        if math.erfc(middle / math.sqrt(2)) > rate:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+def hist_percentile(hist, fraction):
+    """The value below which fraction of a 256 bin histogram lies, counting
+       each bin as covering [value, value + 1)"""
+    cumulative = np.cumsum(hist) / hist.sum()
+    value = min(int(np.searchsorted(cumulative, fraction)), len(hist) - 1)
+    below = cumulative[value - 1] if value else 0.0
+    return float(value + (fraction - below) / max(cumulative[value] - below, 1e-9))
+
+
+class NoiseCalibrator(object):
+    """Sets delta_thresh and min_area from the noise in quiet frames - ones
+       where no event is running - so IR grain at night doesn't trigger and
+       clear days aren't needlessly blunt. It collects calibrate_frames quiet
+       frames at startup and every calibrate_interval seconds after.
+
+       delta_thresh comes from the spread of the pixel differences: the 90th
+       percentile gives the noise's sigma without being thrown by something
+       moving in a corner, and the threshold is as many sigmas out as
+       calibrate_pixel_rate allows. min_area comes from the biggest blob in
+       each quiet frame: the one only calibrate_trigger_rate of them reach,
+       times calibrate_margin. The configured delta_thresh is the least it
+       can be. min_area is kept between 0.05% and 2% of the frame instead,
+       so it can come down from a configured value that's too blunt; the
+       configured one is used until the first calibration."""
+
+    def __init__(self, conf):
+        self.hist = None
+        self.areas = []
+        self.pending = None
+        self.next_window = 0
+        self.calibrated = None
+        self.noise = None
+        self.calibrations = 0
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Pick up calibration settings, safe to call while running"""
+        enabled = conf.get("calibrate", False)
+        if not enabled:
+            self.calibrated = None
+            self.hist = None
+            self.areas = []
+            self.pending = None
+        self.enabled = enabled
+        self.floor = (conf["delta_thresh"], conf["min_area"])
+        self.frames = conf.get("calibrate_frames", 100)
+        self.interval = conf.get("calibrate_interval", 600)
+        self.pixel_rate = conf.get("calibrate_pixel_rate", 0.001)
+        self.trigger_rate = conf.get("calibrate_trigger_rate", 0.01)
+        self.margin = conf.get("calibrate_margin", 1.5)
+
+    def thresholds(self):
+        """The (delta_thresh, min_area) to use"""
+        if self.calibrated is None:
+            return self.floor
+        return max(self.calibrated[0], self.floor[0]), self.calibrated[1]
+
+    def sampling(self, now):
+        """True if we want the next frame's differences"""
+        return self.enabled and self.pending is None and now >= self.next_window
+
+    def sample(self, delta, cnts):
+        """Hold a frame's differences until we know whether it was quiet"""
+        hist = cv2.calcHist([delta], [0], None, [256], [0, 256]).ravel()
+        biggest = max([cv2.contourArea(c) for c in cnts] or [0])
+        self.pending = (hist, biggest / float(delta.size))
+
+    def keep(self, quiet, now, pixels):
+        """Count the held frame if it was quiet, and calibrate once there are
+           enough. Returns the new thresholds if they were calibrated."""
+        pending, self.pending = self.pending, None
+        if pending is None or not quiet:
+            return None
+        hist, area = pending
+        self.hist = hist if self.hist is None else self.hist + hist
+        self.areas.append(area)
+        if len(self.areas) < self.frames:
+            return None
+        return self.calibrate(now, pixels)
+
+    def calibrate(self, now, pixels):
+        """Set the thresholds from the frames collected"""
+        hist, self.hist = self.hist, None
+        areas, self.areas = sorted(self.areas), []
+        self.next_window = now + self.interval
+        self.calibrations += 1
+
+        sigma = hist_percentile(hist, 0.9) / HALF_NORMAL_P90
+        tail = sigma * normal_tail(self.pixel_rate)
+        blob = areas[min(len(areas) - 1, int(math.ceil((1 - self.trigger_rate) * len(areas))) - 1)]
+        self.calibrated = (min(int(math.ceil(tail)), CALIBRATE_MAX_DELTA),
+                           int(min(max(blob * self.margin, CALIBRATE_MIN_AREA), CALIBRATE_MAX_AREA) * pixels))
+        self.noise = {'median': round(hist_percentile(hist, 0.5), 2),
+                      'sigma': round(sigma, 2),
+                      'tail': round(tail, 2),
+                      'blob': round(blob * pixels),
+                      'frames': len(areas),
+                      'at': now}
+        delta_thresh, min_area = self.thresholds()
+        LOG.info("Calibrated from %d quiet frames: noise sigma %.2f, biggest noise blob %d pixels - "
+                 "delta_thresh %d, min_area %d", len(areas), sigma, blob * pixels, delta_thresh, min_area)
+        return delta_thresh, min_area
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        delta_thresh, min_area = self.thresholds()
+        return {'enabled': self.enabled,
+                'delta_thresh': delta_thresh,
+                'min_area': min_area,
+                'noise': self.noise,
+                'calibrations': self.calibrations,
+                'collected': len(self.areas)}
+
+
+class MotionDetector(object):
+    """Keeps the background model and finds the contours that differ from it.
+       Knows nothing about cameras, files or hubs."""
+
+    def __init__(self, conf):
+        self.avg = None
+        self.settle_until = 0
+        self.lighting_changes = 0
+        self.suppressed_frames = 0
+        self.scratch = None
+        self.heatmap = MotionHeatmap(conf)
+        self.calibration = NoiseCalibrator(conf)
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Pick up detector settings, safe to call while running"""
+        self.calibration.configure(conf)
+        self.delta_thresh, self.min_area = self.calibration.thresholds()
+        # a float32 model is half the size and plenty precise for 0-255 pixels
+        self.dtype = 'float32' if conf.get("low_memory", False) else 'float'
+        if self.avg is not None and self.avg.dtype != self.dtype:
+            self.avg = self.avg.astype(self.dtype)
+        self.blur = (conf.get("blur_size", BLUR_KERNEL[0]),) * 2
+        self.lighting_threshold = conf.get("lighting_threshold", 0)
+        self.lighting_settle_time = conf.get("lighting_settle_time", 2.0)
+        self.heatmap.configure(conf)
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        return {'lighting_changes': self.lighting_changes,
+                'suppressed_frames': self.suppressed_frames,
+                'calibration': self.calibration.stats(),
+                'heatmap': self.heatmap.stats()}
+
+    def reset(self):
+        """Forget the background model, the next frame seeds a new one"""
+        self.avg = None
+
+    def prepare(self, frame):
+        """Convert a BGR (or already gray) frame to the blurred grayscale
+           image we compare"""
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(gray, self.blur, 0)
+
+    def regions(self, cnts, scale=1): # pylint: disable=no-self-use
+        """The (area, (x, y, w, h)) of each contour scaled up by scale, or
+           None if there are no contours because the frame couldn't be
+           compared"""
+        if cnts is None:
+            return None
+        return [(cv2.contourArea(c) * scale * scale, tuple(v * scale for v in cv2.boundingRect(c))) for c in cnts]
+
+    def detect(self, gray, now=None):
+        """Fold a prepared frame into the background model and return the
+           contours that differ from it, or None if the frame can't be
+           compared (it seeded a new model or the lighting is changing)"""
+        now = time() if now is None else now
+
+        # if the average frame is None (or the wrong size), initialize it
+        if self.avg is None or self.avg.shape != gray.shape:
+            LOG.info("Starting background model...")
+            self.avg = gray.astype(self.dtype)
+            return None
+
+        # accumulate the weighted average between the current frame and
+        # previous frames, then compute the difference between the current
+        # frame and running average, both in the same scratch buffer
+        cv2.accumulateWeighted(gray, self.avg, 0.5)
+        if self.scratch is None or self.scratch.shape != gray.shape:
+            self.scratch = np.empty_like(gray)
+        frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg, dst=self.scratch), dst=self.scratch)
+
+        # threshold the delta image, dilate the thresholded image to fill
+        # in holes, then find contours on thresholded image
+        thresh = cv2.threshold(frameDelta, self.delta_thresh, 255, cv2.THRESH_BINARY)[1]
+
+        # IR switching, a cloud or a porch light changes most of the frame at
+        # once - re-seed the model and ignore the frames until it settles
+        # instead of writing one giant contour per frame
+        if self.lighting_threshold > 0:
+            changed = cv2.countNonZero(thresh) / float(thresh.size)
+            if changed >= self.lighting_threshold:
+                if now >= self.settle_until:
+                    self.lighting_changes += 1
+                    LOG.info("Lighting change (%.0f%% of the frame), ignoring motion for %.1fs",
+                             changed * 100, self.lighting_settle_time)
+                self.settle_until = now + self.lighting_settle_time
+            if now < self.settle_until:
+                self.avg[...] = gray
+                self.suppressed_frames += 1
+                return None
+
+        # count where the motion is and ignore the blocks that never stop
+        if self.heatmap.enabled:
+            self.heatmap.add(thresh, now)
+            thresh = self.heatmap.apply(thresh)
+
+        # older OpenCVs scribble on the image they find contours in, which is
+        # fine as nothing else uses the dilated copy
+        thresh = cv2.dilate(thresh, None, iterations=2)
+        cnts = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # OpenCV 2 and 4 return (contours, hierarchy), OpenCV 3 puts the image first
+        cnts = cnts[0] if len(cnts) == 2 else cnts[1]
+        if self.calibration.sampling(now):
+            self.calibration.sample(frameDelta, cnts)
+        return cnts
+
+    def settle(self, quiet, now, pixels):
+        """Tell the calibration whether the frame just checked was quiet,
+           with the pixels in the full size frame, and pick up any new
+           thresholds"""
+        calibrated = self.calibration.keep(quiet, now, pixels)
+        if calibrated is not None:
+            self.delta_thresh, self.min_area = calibrated
+
+    def follow(self, gray):
+        """Fold a prepared frame into the background model and nothing else -
+           no contours, heatmap or calibration - to keep it current while
+           we're not looking for motion"""
+        if self.avg is None or self.avg.shape != gray.shape:
+            self.avg = gray.astype(self.dtype)
+            return
+        cv2.accumulateWeighted(gray, self.avg, 0.5)
+
+    def snapshot(self):
+        """Return a fixed point uint16 copy of the background model and the
+           settings it was built with, or None if there's no model yet. Call
+           this on the thread that runs detect()."""
+        if self.avg is None:
+            return None
+        model = np.clip(self.avg * BACKGROUND_SCALE, 0, 65535).astype(np.uint16)
+        meta = {'shape': list(model.shape),
+                'blur': list(self.blur),
+                'scale': BACKGROUND_SCALE,
+                'delta_thresh': self.delta_thresh,
+                'min_area': self.min_area,
+                'saved': time()}
+        return model, meta
+
+    def restore(self, path, max_age):
+        """Load a saved background model if it's recent enough and was built
+           the same way, returns True if it was used"""
+        if not os.path.isfile(path):
+            return False
+        try:
+            with np.load(path, allow_pickle=False) as saved:
+                model = saved['model']
+                meta = json.loads(str(saved['meta']))
+        except (OSError, ValueError, KeyError) as error:
+            LOG.error("ERROR: Unable to read background model from %s: %s", path, error)
+            return False
+
+        age = time() - meta.get('saved', 0)
+        if age > max_age:
+            LOG.info("Saved background model is %.0fs old, starting a new one", age)
+            return False
+        if meta.get('blur') != list(self.blur) or list(model.shape) != meta.get('shape'):
+            LOG.info("Saved background model was built differently, starting a new one")
+            return False
+
+        self.avg = model.astype(self.dtype) / meta.get('scale', BACKGROUND_SCALE)
+        LOG.info("Restored %dx%d background model saved %.0fs ago", model.shape[1], model.shape[0], age)
+        return True
+
+
+class MotionHeatmap(object):
+    """Counts how much of each block of the frame is moving, decaying old
+       counts so it follows the scene, and masks the blocks that are nearly
+       always moving (trees, a flag, a busy road) if asked to"""
+
+    def __init__(self, conf):
+        # per block: the decayed sum of its moving pixels (0-255 per frame)
+        self.counts = None
+        self.frames = 0.0
+        self.shape = None
+        self.decayed = time()
+        self.mask = None
+        self.keep = None
+        self.block = None
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Pick up heatmap settings, safe to call while running"""
+        block = conf.get("heatmap_block", 16)
+        if block != self.block:
+            self.counts = None
+            self.frames = 0.0
+            self.mask = None
+        self.block = block
+        self.enabled = conf.get("heatmap", False)
+        self.half_life = conf.get("heatmap_half_life", 86400)
+        self.auto_mask = conf.get("heatmap_auto_mask", False)
+        self.mask_threshold = conf.get("heatmap_mask_threshold", 0.5)
+        if self.auto_mask:
+            self.update_mask()
+        else:
+            self.mask = None
+        self.keep = None
+
+    def release(self):
+        """Stop counting and let go of the counts and mask, until configure
+           turns it back on"""
+        self.enabled = False
+        self.counts = None
+        self.frames = 0.0
+        self.mask = None
+        self.keep = None
+
+    def add(self, thresh, now):
+        """Count a thresholded frame"""
+        if self.counts is None:
+            grid = (max(1, thresh.shape[0] // self.block), max(1, thresh.shape[1] // self.block))
+            self.counts = np.zeros(grid, np.float32)
+        self.shape = thresh.shape
+        small = cv2.resize(thresh, (self.counts.shape[1], self.counts.shape[0]), interpolation=cv2.INTER_AREA)
+        cv2.accumulate(small, self.counts)
+        self.frames += 1
+        if now - self.decayed >= HEATMAP_DECAY_INTERVAL:
+            self.decay(now)
+            if self.auto_mask:
+                self.update_mask()
+
+    def decay(self, now):
+        """Halve the counts every half_life seconds"""
+        if self.half_life:
+            factor = 0.5 ** ((now - self.decayed) / self.half_life)
+            self.counts *= factor
+            self.frames *= factor
+        self.decayed = now
+
+    def activity(self):
+        """The fraction of each block that's been moving, on average, or
+           None if nothing's been counted"""
+        if self.counts is None or not self.frames:
+            return None
+        return self.counts / (255.0 * self.frames)
+
+    def suggestion(self):
+        """The blocks moving in more than heatmap_mask_threshold of frames,
+           or None until enough frames have been counted to tell"""
+        activity = self.activity()
+        if activity is None or self.frames < HEATMAP_MIN_FRAMES:
+            return None
+        return activity >= self.mask_threshold
+
+    def update_mask(self):
+        """Mask the suggested blocks. A masked block has to settle down to
+           half the threshold before it's unmasked so the mask doesn't flap."""
+        mask = self.suggestion()
+        if mask is None:
+            return
+        if self.mask is not None:
+            mask |= self.mask & (self.activity() >= self.mask_threshold / 2)
+        if self.mask is None or (mask != self.mask).any():
+            LOG.info("Masking %d of %d blocks of the frame that are nearly always moving", mask.sum(), mask.size)
+            self.mask = mask
+            self.keep = None
+
+    def apply(self, thresh):
+        """Blank the masked blocks of a thresholded frame"""
+        if self.mask is None or not self.mask.any():
+            return thresh
+        if self.keep is None or self.keep.shape != thresh.shape:
+            keep = np.where(self.mask, 0, 255).astype(np.uint8)
+            self.keep = cv2.resize(keep, (thresh.shape[1], thresh.shape[0]), interpolation=cv2.INTER_NEAREST)
+        return cv2.bitwise_and(thresh, self.keep)
+
+    def image(self, background=None):
+        """The heatmap as a PNG over the background model, masked (or
+           suggested, without heatmap_auto_mask) blocks outlined in white"""
+        activity = self.activity()
+        if activity is None:
+            return None
+        height, width = self.shape
+        scaled = np.uint8(255 * activity / max(float(activity.max()), 1e-6))
+        heat = cv2.resize(cv2.applyColorMap(scaled, cv2.COLORMAP_JET), (width, height), interpolation=cv2.INTER_NEAREST)
+        if background is not None and background.shape == self.shape:
+            gray = cv2.cvtColor(cv2.convertScaleAbs(background), cv2.COLOR_GRAY2BGR)
+            heat = cv2.addWeighted(heat, 0.5, gray, 0.5, 0)
+        mask = self.mask if self.mask is not None else self.suggestion()
+        if mask is not None:
+            block_h, block_w = height / float(mask.shape[0]), width / float(mask.shape[1])
+            for row, col in zip(*np.nonzero(mask)):
+                cv2.rectangle(heat, (int(col * block_w), int(row * block_h)),
+                              (int((col + 1) * block_w) - 1, int((row + 1) * block_h) - 1), (255, 255, 255), 1)
+        return cv2.imencode('.png', heat)[1].tobytes()
+
+    def mask_image(self):
+        """The mask (or the suggested one) as a frame sized PNG, white where
+           motion is ignored"""
+        mask = self.mask if self.mask is not None else self.suggestion()
+        if mask is None:
+            return None
+        image = cv2.resize(np.where(mask, 255, 0).astype(np.uint8), (self.shape[1], self.shape[0]),
+                           interpolation=cv2.INTER_NEAREST)
+        return cv2.imencode('.png', image)[1].tobytes()
+
+    def raw(self):
+        """The activity per block as a numpy .npy file"""
+        activity = self.activity()
+        if activity is None:
+            return None
+        saved = io.BytesIO()
+        np.save(saved, activity.astype(np.float32))
+        return saved.getvalue()
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        activity = self.activity()
+        return {'frames': round(self.frames),
+                'blocks': self.counts.size if self.counts is not None else 0,
+                'busiest': round(float(activity.max()), 3) if activity is not None else None,
+                'masked_blocks': int(self.mask.sum()) if self.mask is not None else 0}
+
+    def snapshot(self):
+        """A copy of the counts and what's needed to carry on from them, or
+           None if nothing's been counted"""
+        if self.counts is None:
+            return None
+        return self.counts.copy(), {'block': self.block,
+                                    'frames': self.frames,
+                                    'shape': list(self.shape),
+                                    'decayed': self.decayed,
+                                    'saved': time()}
+
+    def restore(self, path):
+        """Carry on from saved counts, which decay for the time they were
+           saved the next time a frame is counted. Returns True if they
+           were used."""
+        if not os.path.isfile(path):
+            return False
+        try:
+            with np.load(path, allow_pickle=False) as saved:
+                counts = saved['model']
+                meta = json.loads(str(saved['meta']))
+        except (OSError, ValueError, KeyError) as error:
+            LOG.error("ERROR: Unable to read the heatmap from %s: %s", path, error)
+            return False
+        if meta.get('block') != self.block:
+            LOG.info("Saved heatmap used a different heatmap_block, starting a new one")
+            return False
+        self.counts = counts.astype(np.float32)
+        self.frames = meta['frames']
+        self.shape = tuple(meta['shape'])
+        self.decayed = meta['decayed']
+        if self.auto_mask:
+            self.update_mask()
+        LOG.info("Restored the heatmap of %.0f frames", self.frames)
+        return True
+
+
+def write_background(path, snapshot, name='background model'):
+    """Save a (model, meta) snapshot of the background model or heatmap to
+       path atomically, safe to call from a worker thread"""
+    model, meta = snapshot
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as saved:
+            np.savez(saved, model=model, meta=np.array(json.dumps(meta)))
+        os.replace(tmp_path, path)
+    except OSError as error:
+        LOG.error("ERROR: Unable to save %s to %s: %s", name, path, error)
+
+
+class ImageEncoder(object):
+    """Encodes the images we upload to fit a byte budget: the highest quality
+       that fits, shrinking the image if even the lowest quality doesn't.
+       With upload_target_seconds the budget also shrinks to what the
+       measured upload speed can send in that time."""
+
+    def __init__(self, conf):
+        self.throughput = None
+        self.uploads = 0
+        self.bytes = 0
+        self.over_budget = 0
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Pick up encoding settings, safe to call while running"""
+        self.max_bytes = conf.get("upload_max_bytes", 0)
+        self.format = conf.get("upload_format", "jpeg")
+        self.min_quality = conf.get("upload_min_quality", 40)
+        self.max_quality = conf.get("upload_max_quality", 90)
+        self.progressive = conf.get("upload_progressive", False)
+        self.optimize = conf.get("upload_optimize", True)
+        self.min_width = conf.get("upload_min_width", 320)
+        self.target_seconds = conf.get("upload_target_seconds", 0)
+
+    def enabled(self):
+        """False if uploads should just be the frame as written to disk"""
+        return self.max_bytes > 0
+
+    def extension(self, fileext):
+        """File extension for uploads"""
+        return '.webp' if self.enabled() and self.format == 'webp' else fileext
+
+    def content_type(self):
+        """MIME type for uploads"""
+        return 'image/webp' if self.format == 'webp' else 'image/jpeg'
+
+    def budget(self):
+        """Bytes we can spend on the next image"""
+        if self.target_seconds and self.throughput:
+            return int(max(MIN_UPLOAD_BUDGET, min(self.max_bytes, self.throughput * self.target_seconds)))
+        return self.max_bytes
+
+    def encode_at(self, image, quality):
+        """Encode at one quality setting"""
+        if self.format == 'webp':
+            ext, params = '.webp', [cv2.IMWRITE_WEBP_QUALITY, quality]
+        else:
+            ext, params = '.jpg', [cv2.IMWRITE_JPEG_QUALITY, quality,
+                                   cv2.IMWRITE_JPEG_PROGRESSIVE, int(self.progressive),
+                                   cv2.IMWRITE_JPEG_OPTIMIZE, int(self.optimize)]
+        encoded, data = cv2.imencode(ext, image, params)
+        if not encoded:
+            raise ValueError('Unable to encode the image as %s' % self.format)
+        return data.tobytes()
+
+    def search(self, image, budget):
+        """Binary search for the highest quality that fits the budget, returns
+           (data, quality) or (None, None) if even the lowest is too big"""
+        data = self.encode_at(image, self.max_quality)
+        if len(data) <= budget:
+            return data, self.max_quality
+        best = (None, None)
+        low, high = self.min_quality, self.max_quality - 1
+        while low <= high:
+            quality = (low + high) // 2
+            data = self.encode_at(image, quality)
+            if len(data) <= budget:
+                best = (data, quality)
+                low = quality + 1
+            else:
+                high = quality - 1
+        return best
+
+    def encode(self, frame):
+        """Encode a frame for upload, runs on a worker thread. Returns the
+           image bytes and the settings that were chosen."""
+        began = time()
+        budget = self.budget()
+        scale = 1.0
+        image = frame
+        data, quality = self.search(image, budget)
+        while data is None and frame.shape[1] * scale * UPLOAD_SCALE_STEP >= self.min_width:
+            scale *= UPLOAD_SCALE_STEP
+            size = (int(frame.shape[1] * scale), int(frame.shape[0] * scale))
+            image = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            data, quality = self.search(image, budget)
+        over = data is None
+        if over:
+            # as small as we're allowed to go, send it anyway
+            self.over_budget += 1
+            quality = self.min_quality
+            data = self.encode_at(image, quality)
+
+        settings = {'format': self.format,
+                    'quality': quality,
+                    'width': image.shape[1],
+                    'height': image.shape[0],
+                    'bytes': len(data),
+                    'budget': budget,
+                    'over_budget': over,
+                    'encode_seconds': round(time() - began, 3)}
+        if self.format == 'jpeg':
+            settings.update({'progressive': self.progressive, 'optimize': self.optimize})
+        return data, settings
+
+    def record(self, size, seconds):
+        """Fold an upload's speed into the throughput estimate"""
+        self.uploads += 1
+        self.bytes += size
+        if seconds > 0:
+            rate = size / seconds
+            self.throughput = rate if self.throughput is None else 0.7 * self.throughput + 0.3 * rate
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        return {'uploads': self.uploads,
+                'bytes': self.bytes,
+                'over_budget': self.over_budget,
+                'throughput': round(self.throughput) if self.throughput else None,
+                'budget': self.budget() if self.enabled() else None}
+
+
+class MemoryGuard(object):
+    """Watches resident memory against memory_limit (in MB) and, while we're
+       over it, gives up features one step of MEMORY_STEPS at a time instead
+       of growing into swap - taking them back once there's room. Also holds
+       the byte budget of each buffer pool and reports what they use."""
+
+    def __init__(self, conf):
+        self.level = 0
+        self.changed = 0
+        self.rss = None
+        self.peak = 0
+        self.pools = {}
+        self.over = set()
+        self.seen = None
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Pick up the limit and budgets, safe to call while running"""
+        self.conf = conf
+        self.limit = conf.get("memory_limit", 0) * 1024 * 1024
+        self.budgets = memory_budgets(conf, self.seen)
+        if not self.limit:
+            self.level = 0
+
+    def frame_seen(self, shape, captured):
+        """Size the frame-sized budgets from a frame that came in, checked at
+           shape and captured in that many bytes"""
+        seen = ((shape[1], shape[0]), captured)
+        if seen != self.seen:
+            self.seen = seen
+            self.budgets = memory_budgets(self.conf, seen)
+
+    def budget(self, pool):
+        """The bytes pool may hold"""
+        return self.budgets[pool]
+
+    def track(self, pool, used):
+        """Report the bytes used() returns for pool in the stats"""
+        self.pools[pool] = used
+
+    def degraded(self, step):
+        """True if step of MEMORY_STEPS has been given up"""
+        return self.level > MEMORY_STEPS.index(step)
+
+    def check(self, now):
+        """Measure the memory, returns True if a step was given up or taken
+           back. Steps are given up one check apart, so what the last one
+           freed shows first, and taken back after MEMORY_HOLD seconds well
+           under the limit."""
+        self.check_pools()
+        self.rss, peak = memory_usage()
+        self.peak = max(self.peak, peak, self.rss or 0)
+        if not self.limit or self.rss is None:
+            return False
+        if self.rss > self.limit and self.level < len(MEMORY_STEPS):
+            self.level += 1
+            self.changed = now
+            return True
+        if self.rss < self.limit * MEMORY_RESTORE and self.level and now - self.changed >= MEMORY_HOLD:
+            self.level -= 1
+            self.changed = now
+            return True
+        return False
+
+    def check_pools(self):
+        """Warn once when a pool goes over its budget"""
+        over = set(pool for pool, used in self.pools.items() if used() > self.budgets.get(pool, float('inf')))
+        for pool in sorted(over - self.over):
+            LOG.warning("The %s buffers use %d bytes, over their budget of %d", pool, self.pools[pool](), self.budgets[pool])
+        self.over = over
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        return {'rss': self.rss,
+                'peak_rss': self.peak,
+                'limit': self.limit or None,
+                'degraded': list(MEMORY_STEPS[:self.level]),
+                'over_budget': sorted(self.over),
+                'pools': {pool: {'used': used(), 'budget': self.budgets.get(pool)}
+                          for pool, used in sorted(self.pools.items())}}
+
+
+class FrameDeduplicator(object):
+    """Spots frames that look like one kept recently in the same event - a
+       parked car with a flickering headlight - by a difference hash of the
+       gray frame, so they aren't written again"""
+
+    def __init__(self, conf):
+        self.recent = collections.deque()
+        self.checked = 0
+        self.duplicates = 0
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Pick up dedup settings, safe to call while running"""
+        self.enabled = conf.get("dedup", False)
+        self.distance = conf.get("dedup_distance", 6)
+        self.recent = collections.deque(self.recent, maxlen=conf.get("dedup_recent", 8))
+
+    def reset(self):
+        """A new event - forget the frames kept for the last one"""
+        self.recent.clear()
+
+    def frame_hash(self, gray): # pylint: disable=no-self-use
+        """A 256 bit difference hash: whether each of a 16x16 grid of averaged
+           pixels is brighter than the one to its left"""
+        small = cv2.resize(gray, (DHASH_SIZE + 1, DHASH_SIZE), interpolation=cv2.INTER_AREA)
+        bits = small[:, 1:] > small[:, :-1]
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+    def duplicate(self, gray):
+        """True if gray is within dedup_distance bits of a frame kept
+           recently, otherwise it's remembered as kept"""
+        if not self.enabled:
+            return False
+        self.checked += 1
+        value = self.frame_hash(gray)
+        for kept in self.recent:
+            if bin(value ^ kept).count('1') <= self.distance:
+                self.duplicates += 1
+                return True
+        self.recent.append(value)
+        return False
+
+    def written(self, filename):
+        """Note the size of a frame that was written, to estimate the bytes
+           that skipping the duplicates saved"""
+        try:
+            self.bytes_written += os.path.getsize(filename)
+            self.frames_written += 1
+        except OSError:
+            pass
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        average = self.bytes_written / self.frames_written if self.frames_written else 0
+        return {'checked': self.checked,
+                'duplicates': self.duplicates,
+                'hit_rate': round(self.duplicates / float(self.checked), 3) if self.checked else 0.0,
+                'bytes_saved': int(self.duplicates * average)}
+
+
+class ContactSheet(object):
+    """Builds a montage of up to contact_sheet_frames frames from an event
+       while it runs, each labelled with its time and motion boxes, in
+       preallocated tiles. Once the tiles are full every other one is dropped
+       and only every other frame is taken from then on, so the frames stay
+       spread over the whole event however long it runs. There are only as
+       many tiles as fit in the contact_sheet memory budget."""
+
+    def __init__(self, conf):
+        self.tiles = None
+        self.count = 0
+        self.offered = 0
+        self.stride = 1
+        self.built = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Pick up contact sheet settings, safe to call while running"""
+        settings = (conf.get("contact_sheet_frames", 9), conf.get("contact_sheet_tile_width", 320),
+                    memory_budgets(conf)['contact_sheet'])
+        if self.tiles is not None and settings != (self.size, self.tile_width, self.budget):
+            self.tiles = None
+            self.count = 0
+        self.enabled = conf.get("contact_sheet", False)
+        self.size, self.tile_width, self.budget = settings
+
+    def release(self):
+        """Stop taking frames and let go of the tiles, until configure turns
+           it back on"""
+        self.enabled = False
+        self.tiles = None
+        self.count = 0
+
+    def start(self):
+        """A new event - start a new sheet"""
+        self.count = 0
+        self.offered = 0
+        self.stride = 1
+
+    def add(self, frame, boxes, timestamp):
+        """Offer a frame kept for the event, with its motion boxes"""
+        if not self.enabled:
+            return
+        self.offered += 1
+        if (self.offered - 1) % self.stride:
+            return
+        if self.tiles is not None and self.count == len(self.tiles):
+            # the tiles are full - keep every other one, take half as many
+            kept = (self.count + 1) // 2
+            for index in range(1, kept):
+                self.tiles[index] = self.tiles[2 * index]
+            self.count = kept
+            self.stride *= 2
+            if (self.offered - 1) % self.stride:
+                return
+
+        height, width = frame.shape[:2]
+        tile_height = max(1, int(round(self.tile_width * height / float(width))))
+        if self.tiles is None or self.tiles.shape[1] != tile_height:
+            size = min(self.size, self.budget // (tile_height * self.tile_width * 3))
+            if size < 2:
+                return
+            self.tiles = np.zeros((size, tile_height, self.tile_width, 3), np.uint8)
+            self.count = 0
+        tile = self.tiles[self.count]
+        if frame.ndim == 2:
+            cv2.cvtColor(cv2.resize(frame, (self.tile_width, tile_height), interpolation=cv2.INTER_AREA),
+                         cv2.COLOR_GRAY2BGR, dst=tile)
+        else:
+            cv2.resize(frame, (self.tile_width, tile_height), dst=tile, interpolation=cv2.INTER_AREA)
+        scale = self.tile_width / float(width)
+        for (x, y, w, h) in boxes:
+            cv2.rectangle(tile, (int(x * scale), int(y * scale)), (int((x + w) * scale), int((y + h) * scale)), (0, 255, 0), 1)
+        cv2.putText(tile, timestamp.strftime("%H:%M:%S"), (4, 14), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 255), 1)
+        self.count += 1
+
+    def build(self):
+        """The sheet as one image, or None if there aren't at least two
+           frames on it - the notify upload already shows one"""
+        if not self.enabled or self.tiles is None or self.count < 2:
+            return None
+        tile_height = self.tiles.shape[1]
+        per_row = int(math.ceil(len(self.tiles) ** 0.5))
+        rows = (self.count + per_row - 1) // per_row
+        columns = min(self.count, per_row)
+        sheet = np.zeros((rows * tile_height, columns * self.tile_width, 3), np.uint8)
+        for index in range(self.count):
+            row, column = divmod(index, per_row)
+            sheet[row * tile_height:(row + 1) * tile_height,
+                  column * self.tile_width:(column + 1) * self.tile_width] = self.tiles[index]
+        self.built += 1
+        return sheet
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        return {'built': self.built, 'uploaded': self.uploaded, 'failed': self.failed}
+
+
+def parse_tripwire(rule, index):
+    """Check a tripwires entry, returns it as {'name', 'line', 'direction'}
+       with the line as two (x, y) points and the direction as a unit (dx, dy)
+       in image coordinates, either of which may be None"""
+    line = rule.get("line")
+    if line is not None:
+        (ax, ay), (bx, by) = line
+        line = ((float(ax), float(ay)), (float(bx), float(by)))
+        if line[0] == line[1]:
+            raise ValueError('the line has no length')
+    direction = rule.get("direction", "any")
+    direction = None if direction == "any" else DIRECTIONS[direction]
+    if line is None and direction is None:
+        raise ValueError('a tripwire needs a line or a direction')
+    return {'name': str(rule.get("name", "tripwire %d" % (index + 1))), 'line': line, 'direction': direction}
+
+
+class TripwireFilter(object):
+    """Lets motion trigger only once something crosses a tripwire line or
+       heads the right way. Corners found inside the last frame's motion boxes
+       are followed into this frame with sparse optical flow, so the cost is
+       set by tripwire_points rather than the frame size, and it's only paid
+       while motion is waiting to trigger."""
+
+    def __init__(self, conf):
+        self.previous = None
+        self.boxes = []
+        self.crossed = {}
+        self.checked = 0
+        self.points = 0
+        self.crossings = 0
+        self.seconds = 0.0
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Pick up tripwire settings, safe to call while running"""
+        self.rules = [parse_tripwire(rule, index) for index, rule in enumerate(conf.get("tripwires", []))]
+        self.max_points = conf.get("tripwire_points", 40)
+        self.hold = conf.get("tripwire_hold", 3)
+        self.min_motion = conf.get("tripwire_min_motion", 2)
+
+    def prepare(self, frame): # pylint: disable=no-self-use
+        """The gray frame to follow points in, taken before anything is drawn
+           on the frame"""
+        return frame.copy() if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    def features(self, gray, boxes):
+        """Corners to follow in each box, sharing tripwire_points between
+           the biggest boxes. Returns the points and the box each came from."""
+        boxes = sorted(boxes, key=lambda box: box[2] * box[3], reverse=True)[:self.max_points // FLOW_MIN_POINTS]
+        per_box = self.max_points // len(boxes)
+        points = []
+        owners = []
+        for owner, (x, y, w, h) in enumerate(boxes):
+            corners = cv2.goodFeaturesToTrack(gray[y:y + h, x:x + w], maxCorners=per_box, qualityLevel=0.01, minDistance=5)
+            if corners is None:
+                continue
+            corners = corners.reshape(-1, 2) + (x, y)
+            points.append(corners)
+            owners.extend([owner] * len(corners))
+        if not points:
+            return None, None
+        return np.concatenate(points).astype(np.float32).reshape(-1, 1, 2), np.array(owners)
+
+    def update(self, gray, boxes, now):
+        """Follow the points in the last frame's boxes into gray, noting the
+           tripwires they matched. Pass gray None when there's nothing to
+           check, which forgets the last frame."""
+        if gray is None or not boxes:
+            self.previous = None
+            self.boxes = []
+            return
+        if self.previous is not None and self.previous.shape == gray.shape:
+            started = time()
+            points, owners = self.features(self.previous, self.boxes)
+            if points is not None:
+                moved, status, _ = cv2.calcOpticalFlowPyrLK(self.previous, gray, points, None,
+                                                            winSize=FLOW_WINDOW, maxLevel=FLOW_LEVELS)
+                found = status.reshape(-1) == 1
+                start = points.reshape(-1, 2)[found]
+                end = moved.reshape(-1, 2)[found]
+                owners = owners[found]
+                self.checked += 1
+                self.points += len(start)
+                for rule in self.rules:
+                    if self.matches(rule, start, end, owners):
+                        self.crossed[rule['name']] = now
+                        self.crossings += 1
+            self.seconds += time() - started
+        self.previous = gray
+        self.boxes = list(boxes)
+
+    def matches(self, rule, start, end, owners):
+        """True if enough points crossed the rule's line (going its way, if
+           it has a direction), or with no line if most of the points in a
+           box moved its way"""
+        motion = end - start
+        if rule['direction'] is not None:
+            dx, dy = rule['direction']
+            along = motion[:, 0] * dx + motion[:, 1] * dy
+            # within 45 degrees of the direction and far enough to not be noise
+            heading = (along >= self.min_motion) & (along >= 0.7071 * np.linalg.norm(motion, axis=1))
+        else:
+            heading = np.ones(len(motion), dtype=bool)
+        if rule['line'] is None:
+            return any(FLOW_MIN_POINTS <= heading[owners == owner].sum() >= 0.5 * (owners == owner).sum()
+                       for owner in np.unique(owners))
+        # a point crossed if its start and end are either side of the line
+        # and the line's ends are either side of its path
+        (ax, ay), (bx, by) = rule['line']
+        before = (bx - ax) * (start[:, 1] - ay) - (by - ay) * (start[:, 0] - ax)
+        after = (bx - ax) * (end[:, 1] - ay) - (by - ay) * (end[:, 0] - ax)
+        first = motion[:, 0] * (ay - start[:, 1]) - motion[:, 1] * (ax - start[:, 0])
+        second = motion[:, 0] * (by - start[:, 1]) - motion[:, 1] * (bx - start[:, 0])
+        crossed = (before * after < 0) & (first * second <= 0) & heading
+        return crossed.sum() >= FLOW_MIN_POINTS
+
+    def recent(self, now):
+        """Names of the tripwires matched in the last tripwire_hold seconds"""
+        return sorted(name for name, when in self.crossed.items() if now - when <= self.hold)
+
+    def draw(self, frame):
+        """Draw the tripwire lines on the frame"""
+        for rule in self.rules:
+            if rule['line'] is not None:
+                (ax, ay), (bx, by) = rule['line']
+                cv2.line(frame, (int(ax), int(ay)), (int(bx), int(by)), (255, 0, 0), 2)
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        return {'rules': len(self.rules),
+                'checked': self.checked,
+                'points': round(self.points / float(self.checked), 1) if self.checked else 0.0,
+                'crossings': self.crossings,
+                'ms': round(1000 * self.seconds / self.checked, 2) if self.checked else 0.0,
+                'recent': self.recent(time())}
+
+
+class CentroidTracker(object):
+    """Follows motion boxes from frame to frame by matching centroids, so an
+       object keeps the same track id while it moves through the scene"""
+
+    def __init__(self, conf):
+        self.tracks = {}
+        self.next_id = 1
+        self.configure(conf)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def configure(self, conf):
+        """Pick up tracker settings, safe to call while running"""
+        self.max_distance = conf.get("track_max_distance", 100)
+        self.max_missing = conf.get("track_max_missing", 10)
+        self.min_frames = conf.get("track_min_frames", 2)
+
+    def update(self, boxes, now):
+        """Match this frame's boxes to the existing tracks, closest pairs
+           first. Unmatched boxes start new tracks and tracks unmatched for
+           more than max_missing frames are dropped."""
+        centroids = np.array([(x + w / 2.0, y + h / 2.0) for (x, y, w, h) in boxes], dtype=np.float32).reshape(-1, 2)
+        ids = list(self.tracks)
+        matched_tracks = set()
+        matched_boxes = set()
+
+        if ids and len(boxes):
+            previous = np.array([self.tracks[track_id]['centroid'] for track_id in ids], dtype=np.float32)
+            distances = np.linalg.norm(previous[:, np.newaxis, :] - centroids[np.newaxis, :, :], axis=2)
+            rows, cols = np.unravel_index(np.argsort(distances, axis=None), distances.shape)
+            for row, col in zip(rows.tolist(), cols.tolist()):
+                if distances[row, col] > self.max_distance:
+                    break
+                if row in matched_tracks or col in matched_boxes:
+                    continue
+                matched_tracks.add(row)
+                matched_boxes.add(col)
+                self.follow(self.tracks[ids[row]], centroids[col], boxes[col], now)
+                if len(matched_tracks) == len(ids) or len(matched_boxes) == len(boxes):
+                    break
+
+        for row, track_id in enumerate(ids):
+            if row not in matched_tracks:
+                track = self.tracks[track_id]
+                track['missing'] += 1
+                if track['missing'] > self.max_missing:
+                    del self.tracks[track_id]
+
+        for col, box in enumerate(boxes):
+            if col not in matched_boxes:
+                self.tracks[self.next_id] = {'id': self.next_id,
+                                             'centroid': tuple(centroids[col].tolist()),
+                                             'box': tuple(box),
+                                             'first_seen': now,
+                                             'last_seen': now,
+                                             'frames': 1,
+                                             'missing': 0,
+                                             'speed': 0.0,
+                                             'path': collections.deque([tuple(centroids[col].tolist())], maxlen=32)}
+                self.next_id += 1
+
+    def follow(self, track, centroid, box, now): # pylint: disable=no-self-use
+        """Move a track to its matched box, smoothing its speed in pixels/s"""
+        centroid = tuple(centroid.tolist())
+        elapsed = now - track['last_seen']
+        if elapsed > 0:
+            moved = ((centroid[0] - track['centroid'][0]) ** 2 + (centroid[1] - track['centroid'][1]) ** 2) ** 0.5
+            track['speed'] = 0.5 * track['speed'] + 0.5 * moved / elapsed
+        track['centroid'] = centroid
+        track['box'] = tuple(box)
+        track['last_seen'] = now
+        track['frames'] += 1
+        track['missing'] = 0
+        track['path'].append(centroid)
+
+    def confirmed(self):
+        """Tracks seen in this frame that have been followed long enough to
+           count as a real object"""
+        return [track for track in self.tracks.values()
+                if track['missing'] == 0 and track['frames'] >= self.min_frames]
+
+    def summary(self, track): # pylint: disable=no-self-use
+        """JSON friendly description of a track"""
+        return {'id': track['id'],
+                'age': round(track['last_seen'] - track['first_seen'], 2),
+                'frames': track['frames'],
+                'speed': round(track['speed'], 1),
+                'path': [[round(x), round(y)] for (x, y) in track['path']]}
+
+
+class ObjectClassifier(object):
+    """Decides whether motion is a person or vehicle by running a small CPU
+       model (OpenCV's HOG people detector or a DNN such as MobileNet-SSD) on
+       just the cropped motion boxes. Crops are classified in a bounded pool of
+       worker threads so the frame loop never waits for a result."""
+
+    def __init__(self, conf):
+        self.local = threading.local()
+        self.in_flight = 0
+        self.next_job = 0
+        self.found = None
+        self.counts = collections.Counter()
+        self.last_error = None
+        self.configure(conf)
+        self.pool = ThreadPool(0, self.workers, name='classifier')
+        self.pool.start()
+        self.shutdown_trigger = reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop) # pylint: disable=no-member
+
+    def configure(self, conf):
+        """Pick up classifier settings, safe to call while running - a new
+           model is loaded by each worker the next time it's used"""
+        self.method = conf.get("classifier", "hog")
+        self.model_path = conf.get("classifier_model", "")
+        self.config_path = conf.get("classifier_config", "")
+        self.labels = conf.get("classifier_labels", MOBILENET_SSD_LABELS)
+        self.classes = set(conf.get("classifier_classes", ["person", "car", "bus", "motorbike", "bicycle"]))
+        self.confidence = conf.get("classifier_confidence", 0.5)
+        self.workers = conf.get("classifier_workers", 1)
+        self.budget = conf.get("classifier_budget", 1.0)
+        self.interval = conf.get("classifier_interval", 0.5)
+        if hasattr(self, 'pool'):
+            self.pool.adjustPoolsize(maxthreads=self.workers)
+
+    def close(self):
+        """Stop the worker threads without blocking the reactor"""
+        reactor.removeSystemEventTrigger(self.shutdown_trigger) # pylint: disable=no-member
+        return deferToThread(self.pool.stop)
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        stats = dict(self.counts)
+        stats['in_flight'] = self.in_flight
+        return stats
+
+    def crop(self, frame, box): # pylint: disable=no-self-use
+        """Copy a motion box out of the frame with a margin around it, the
+           frame is drawn on and reused once the loop moves on"""
+        (x, y, w, h) = box
+        dx = int(w * CROP_MARGIN)
+        dy = int(h * CROP_MARGIN)
+        return frame[max(0, y - dy):y + h + dy, max(0, x - dx):x + w + dx].copy()
+
+    def check(self, crops, now):
+        """Called from the frame loop when motion would trigger. Returns the
+           classes that make it count - what a recent classification found,
+           or ['motion'] if the pool can't keep up - or [] to hold off. Queues
+           the crops for classification at most once every interval."""
+        if self.found is not None and now - self.found[0] <= self.budget + self.interval:
+            classes, self.found = self.found[1], None
+            return classes
+        if self.in_flight >= 2 * self.workers:
+            # the queue is full, don't let a slow model blind the camera
+            self.counts['saturated'] += 1
+            return ['motion']
+        if now >= self.next_job and crops:
+            self.next_job = now + self.interval
+            self.in_flight += 1
+            self.counts['jobs'] += 1
+            # largest boxes first, they're the most likely to be something
+            crops = sorted(crops, key=lambda crop: crop.shape[0] * crop.shape[1], reverse=True)
+            job = deferToThreadPool(reactor, self.pool, self.classify, crops, now)
+            job.addCallbacks(self.handle_result, self.handle_failure)
+        return []
+
+    def model(self):
+        """This worker's model, loading it on first use (or after the
+           settings change). Returns the model and whether it was just loaded."""
+        key = (self.method, self.model_path, self.config_path)
+        if getattr(self.local, 'key', None) == key:
+            return self.local.model, False
+        LOG.info("Loading %s classifier %s", self.method, self.model_path)
+        if self.method == "dnn":
+            model = cv2.dnn.readNet(self.model_path, self.config_path)
+            model.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+            model.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        else:
+            model = cv2.HOGDescriptor()
+            model.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+        self.local.model = model
+        self.local.key = key
+        return model, True
+
+    def classify(self, crops, submitted):
+        """Classify crops until one holds a class we want or the frame's time
+           budget runs out, runs on a worker thread. Returns the classes found
+           and whether every crop was checked."""
+        model, loaded = self.model()
+        # loading the model doesn't count against the budget
+        deadline = (time() if loaded else submitted) + self.budget
+        for crop in crops:
+            if time() > deadline:
+                return [], False
+            if self.method == "dnn":
+                found = self.classify_dnn(model, crop)
+            else:
+                found = self.classify_hog(model, crop)
+            if found:
+                return sorted(found), True
+        return [], True
+
+    def classify_hog(self, model, crop):
+        """Look for people in a crop with the HOG detector"""
+        h, w = crop.shape[:2]
+        scale = max(1.0, HOG_WINDOW[0] / float(w), HOG_WINDOW[1] / float(h))
+        if scale > 1.0:
+            crop = cv2.resize(crop, (int(w * scale + 0.5), int(h * scale + 0.5)))
+        _, weights = model.detectMultiScale(crop, winStride=(8, 8), padding=(8, 8), scale=1.05)
+        if len(weights) and float(np.max(weights)) >= self.confidence:
+            return {'person'}
+        return set()
+
+    def classify_dnn(self, model, crop):
+        """Run an SSD style detector over a crop and return the wanted classes
+           it's confident about"""
+        crop = cv2.resize(crop, DNN_INPUT_SIZE)
+        if crop.ndim == 2:
+            crop = cv2.cvtColor(crop, cv2.COLOR_GRAY2BGR)
+        blob = cv2.dnn.blobFromImage(crop, DNN_SCALE, DNN_INPUT_SIZE, DNN_MEAN)
+        model.setInput(blob)
+        found = set()
+        for detection in model.forward().reshape(-1, 7):
+            class_id = int(detection[1])
+            if float(detection[2]) >= self.confidence and 0 <= class_id < len(self.labels):
+                if self.labels[class_id] in self.classes:
+                    found.add(self.labels[class_id])
+        return found
+
+    def handle_result(self, result):
+        """A job finished - remember what it found for the frame loop"""
+        self.in_flight -= 1
+        classes, complete = result
+        if classes:
+            self.counts['found'] += 1
+            self.found = (time(), classes)
+        elif not complete:
+            # ran out of time, fall back to plain motion
+            self.counts['over_budget'] += 1
+            self.found = (time(), ['motion'])
+        else:
+            self.counts['rejected'] += 1
+
+    def handle_failure(self, failure):
+        """A job blew up - treat it as plain motion rather than go blind"""
+        self.in_flight -= 1
+        self.counts['errors'] += 1
+        # a missing or broken model fails every job, only say so once
+        if failure.getErrorMessage() != self.last_error:
+            self.last_error = failure.getErrorMessage()
+            LOG.error("ERROR: Classifying motion threw an error: %s", self.last_error)
+        self.found = (time(), ['motion'])
+
 
-SSDP_PORT = 1900
-SSDP_ADDR = '239.255.255.250'
-UUID = 'd1c58eb4-9220-11e4-96fa-123b93f75cba'
-SEARCH_RESPONSE = 'HTTP/1.1 200 OK\r\nCACHE-CONTROL:max-age=30\r\nEXT:\r\nLOCATION:%s\r\nSERVER:Linux, UPnP/1.0, Pi_Camera/1.0\r\nST:%s\r\nUSN:uuid:%s::%s\r\n'
+class PiCameraSource(object):
+    """The Pi camera module, captured through the video port. Gray frames
+       are the Y plane of a YUV capture into a buffer that's reused, a third
+       of the size of a BGR frame and without PiRGBArray's copies."""
 
-try:
-    SESSION = boto3.session.Session()
-    S3 = SESSION.resource('s3')
-except:
-    LOG.error("ERROR: Unable to create AWS S3 resource, AWS returned an error.")
+    def __init__(self, resolution, gray=False):
+        self.camera = PiCamera()
+        self.camera.resolution = tuple(resolution)
+        self.camera.framerate = 30.0
+        self.camera.video_stabilization = True
+        self.size = tuple(resolution)
+        self.raw_capture = None
+        self.yuv = None
+        if gray:
+            # YUV captures are padded to a multiple of 32 wide and 16 high
+            width, height = self.size
+            self.padded = ((width + 31) // 32 * 32, (height + 15) // 16 * 16)
+            self.yuv = np.empty(self.padded[0] * self.padded[1] * 3 // 2, np.uint8)
+        else:
+            self.raw_capture = PiRGBArray(self.camera, size=self.size)
 
+    def read(self):
+        """Capture a frame"""
+        if self.yuv is not None:
+            self.camera.capture(self.yuv, format="yuv", use_video_port=True)
+            padded_width, padded_height = self.padded
+            luma = self.yuv[:padded_width * padded_height].reshape(padded_height, padded_width)
+            return luma[:self.size[1], :self.size[0]].copy()
+        self.camera.capture(self.raw_capture, format="bgr", use_video_port=True)
+        frame = self.raw_capture.array
+        self.raw_capture.truncate(0)
+        return frame
 
-def parse_args(args):
-    """ Parse the arguments passed to this script """
-    argp = argparse.ArgumentParser()
-    argp.add_argument('--conf', required=True, help="path to JSON config file")
-    return argp.parse_args(args)
+    def original(self): # pylint: disable=no-self-use
+        """The camera's frames are saved as they're drawn on"""
+        return None
 
+    def annotate(self, text):
+        """Have the camera draw text on the frames"""
+        self.camera.annotate_text = text
 
-def determine_ip_for_host(host):
-    """Determine local IP address used to communicate with a particular host"""
-    test_sock = DatagramProtocol()
-    test_sock_listener = reactor.listenUDP(0, test_sock) # pylint: disable=no-member
-    test_sock.transport.connect(host, 1900)
-    my_ip = test_sock.transport.getHost().host
-    test_sock_listener.stopListening()
-    return my_ip
+    def close(self):
+        """Release the camera"""
+        if self.raw_capture is not None:
+            self.raw_capture.close()
+        self.camera.close()
 
 
-@implementer(IBodyProducer)
-class StringProducer(object):
-    """Writes an in-memory string to a Twisted request"""
+class ReplaySource(object):
+    """Plays a video file or image sequence (like frames/%04d.jpg) over and
+       over at its own frame rate, standing in for the camera in load tests"""
 
-    def __init__(self, body):
-        self.body = body
-        self.length = len(body)
+    def __init__(self, path, fps=0, gray=False):
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise IOError('Unable to open %s for replay' % path)
+        self.interval = 1.0 / (fps or self.capture.get(cv2.CAP_PROP_FPS) or 30.0)
+        self.next_frame = time()
+        self.gray = gray
 
-    def startProducing(self, consumer): # pylint: disable=invalid-name
-        """Start producing supplied string to the specified consumer"""
-        consumer.write(self.body)
-        return succeed(None)
+    def read(self):
+        """The next frame, once it's due"""
+        delay = self.next_frame - time()
+        if delay > 0:
+            sleep(delay)
+        # if we're late carry on from now rather than catching up in a burst
+        self.next_frame = max(self.next_frame + self.interval, time())
+        ret, frame = self.capture.read()
+        if not ret:
+            # start again from the top
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.capture.read()
+        if ret and self.gray:
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame if ret else None
 
-    def pauseProducing(self): # pylint: disable=invalid-name
-        """Pause producing - no op"""
-        pass
+    def original(self): # pylint: disable=no-self-use
+        """Replayed frames are saved as they're drawn on"""
+        return None
 
-    def stopProducing(self): # pylint: disable=invalid-name
-        """ Stop producing - no op"""
-        pass
+    def annotate(self, text):
+        """Replayed frames aren't annotated"""
 
+    def close(self):
+        """Let go of the file"""
+        self.capture.release()
 
-class SSDPServer(DatagramProtocol):
-    """Receive and response to M-SEARCH discovery requests from SmartThings hub"""
 
-    def __init__(self, interface='', status_port=0, device_target=''):
-        self.interface = interface
-        self.device_target = device_target
-        self.status_port = status_port
-        self.port = reactor.listenMulticast(SSDP_PORT, self, listenMultiple=True) # pylint: disable=no-member
-        self.port.joinGroup(SSDP_ADDR, interface=interface)
-        reactor.addSystemEventTrigger('before', 'shutdown', self.stop) # pylint: disable=no-member
+def jpeg_size(data):
+    """The (width, height) in a JPEG's frame header, or None if it hasn't
+       got one we can find"""
+    index = 2
+    while index + 9 <= len(data):
+        if data[index] != 0xFF:
+            return None
+        marker = data[index + 1]
+        if marker == 0xFF:
+            # padding before a marker
+            index += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[index + 5:index + 9])
+            return width, height
+        index += 2 + struct.unpack('>H', data[index + 2:index + 4])[0]
+    return None
 
-    def datagramReceived(self, data, address):
-        try:
-            header, _ = data.decode().split('\r\n\r\n')[:2]
-        except ValueError:
-            return
-        lines = header.split('\r\n')
-        cmd = lines.pop(0).split(' ')
-        lines = [x.replace(': ', ':', 1) for x in lines]
-        lines = [x for x in lines if len(x) > 0]
-        headers = [x.split(':', 1) for x in lines]
-        headers = dict([(x[0].lower(), x[1]) for x in headers])
 
-        LOG.debug('SSDP command %s %s - from %s:%d with headers %s', cmd[0], cmd[1], address[0], address[1], headers)
+def jpeg_scale(data, width):
+    """The largest reduction (1/8, 1/4 or 1/2) a JPEG can be decoded at and
+       still be at least width wide, 1 if none"""
+    size = jpeg_size(data)
+    if size is None:
+        return 1
+    for scale in JPEG_SCALES:
+        if size[0] // scale >= width:
+            return scale
+    return 1
 
-        search_target = ''
-        if 'st' in headers:
-            search_target = headers['st']
-
-        if cmd[0] == 'M-SEARCH' and cmd[1] == '*':
-            if search_target in self.device_target:
-                LOG.info('SSDP command %s %s - from %s:%d with headers %s', cmd[0], cmd[1], address[0], address[1], headers)
-                LOG.info('Received %s %s for %s from %s:%d', cmd[0], cmd[1], search_target, address[0], address[1])
-                url = 'http://%s:%d/status' % (determine_ip_for_host(address[0]), self.status_port)
-                response = SEARCH_RESPONSE % (url, search_target, UUID, self.device_target)
-                self.port.write(bytes(response, 'utf-8'), address)
-            else:
-                LOG.debug('%s not in %s', search_target, self.device_target)
+
+def decode_jpeg(data, scale=1, gray=False):
+    """Decode a JPEG, at 1/scale of its size - libjpeg skips most of the work
+       for the pixels it drops, so this is much faster than decoding it whole
+       and resizing"""
+    if scale > 1:
+        flags = getattr(cv2, 'IMREAD_REDUCED_%s_%d' % ('GRAYSCALE' if gray else 'COLOR', scale))
+    else:
+        flags = cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR
+    return cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+
+
+class NetworkSource(object):
+    """A network camera. MJPEG over HTTP (or a snapshot URL) is read from one
+       connection kept open between frames, and each JPEG is decoded at the
+       smallest scale that's still as wide as we look at, keeping the JPEG
+       it came in to save. RTSP goes through OpenCV and is decoded whole.
+       Either way a dropped stream is reconnected, backing off while the
+       camera doesn't answer."""
+
+    def __init__(self, url, width, gray=False, timeout=STREAM_TIMEOUT):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https', 'rtsp'):
+            raise ValueError('Unable to stream from %s: only http, https and rtsp are supported' % url)
+        self.url = url
+        self.parts = parts
+        # the camera as it's logged, without a password
+        self.name = '%s://%s%s' % (parts.scheme, parts.hostname, ':%d' % parts.port if parts.port else '')
+        self.width = width
+        self.gray = gray
+        self.timeout = timeout
+        self.connection = None
+        self.response = None
+        self.boundary = None
+        self.capture = None
+        self.jpeg = None
+        self.scale = None
+        self.retry_at = 0
+        self.backoff = 0
+        self.frames = 0
+        self.bytes = 0
+        self.reconnects = 0
+        self.last_error = None
+
+    def connect(self):
+        """Open the connection and start the stream"""
+        parts = self.parts
+        if parts.scheme == 'https':
+            self.connection = http.client.HTTPSConnection(parts.hostname, parts.port, timeout=self.timeout)
         else:
-            LOG.debug('Ignored SSDP command %s %s', cmd[0], cmd[1])
+            self.connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=self.timeout)
+        self.request()
+        # a camera that's been restarted may send a new resolution
+        self.scale = None
+        MONITOR_LOG.info("Streaming from %s", self.name)
+
+    def request(self):
+        """Ask for the stream, or the next snapshot"""
+        parts = self.parts
+        headers = {}
+        if parts.username:
+            credentials = '%s:%s' % (parts.username, parts.password or '')
+            headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        self.connection.request('GET', path, headers=headers)
+        self.response = self.connection.getresponse()
+        if self.response.status != 200:
+            raise ValueError('the camera answered %d %s' % (self.response.status, self.response.reason))
+        content_type = self.response.getheader('Content-Type', '')
+        self.boundary = None
+        if content_type.lower().startswith('multipart/'):
+            for param in content_type.split(';')[1:]:
+                name, _, value = param.strip().partition('=')
+                if name.lower() == 'boundary':
+                    boundary = value.strip('"').encode('latin-1')
+                    self.boundary = boundary if boundary.startswith(b'--') else b'--' + boundary
+            if self.boundary is None:
+                raise ValueError('the stream has no multipart boundary')
+
+    def read_part(self):
+        """The next JPEG in the multipart stream"""
+        length = None
+        headers = False
+        while True:
+            line = self.response.readline(STREAM_MAX_LINE)
+            if not line:
+                raise ValueError('the stream ended')
+            line = line.strip()
+            if not line:
+                if headers:
+                    break
+            elif line.startswith(self.boundary):
+                headers = False
+            else:
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = int(value)
+                headers = True
+        if length is not None:
+            if length > STREAM_MAX_FRAME:
+                raise ValueError('a %d byte frame is too big' % length)
+            data = self.response.read(length)
+            if len(data) < length:
+                raise ValueError('the stream ended')
+            return data
+        # without a length, read up to the next boundary
+        data = []
+        size = 0
+        while True:
+            line = self.response.readline(STREAM_MAX_LINE)
+            if not line:
+                raise ValueError('the stream ended')
+            if line.startswith(self.boundary):
+                return b''.join(data).rstrip(b'\r\n')
+            data.append(line)
+            size += len(line)
+            if size > STREAM_MAX_FRAME:
+                raise ValueError('a frame is too big')
+
+    def read_snapshot(self):
+        """A single JPEG - the next is asked for on the same connection"""
+        data = self.response.read(STREAM_MAX_FRAME)
+        self.response.close()
+        self.response = None
+        return data
+
+    def read(self):
+        """Read a frame, None if the stream dropped or the camera can't be
+           reached yet"""
+        if self.parts.scheme == 'rtsp':
+            return self.read_rtsp()
+        if time() < self.retry_at:
+            return None
+        try:
+            if self.connection is None:
+                self.connect()
+            elif self.response is None:
+                self.request()
+            data = self.read_part() if self.boundary is not None else self.read_snapshot()
+        except (OSError, http.client.HTTPException, ValueError) as error:
+            self.disconnect(error)
+            return None
+        if self.scale is None:
+            self.scale = jpeg_scale(data, self.width)
+            MONITOR_LOG.info("Decoding frames from %s at 1/%d scale", self.name, self.scale)
+        frame = decode_jpeg(data, self.scale, self.gray)
+        if frame is None:
+            # a corrupt frame - the stream itself is still fine
+            self.last_error = 'a frame could not be decoded'
+            return None
+        self.jpeg = data
+        self.frames += 1
+        self.bytes += len(data)
+        self.backoff = 0
+        return frame
+
+    def read_rtsp(self):
+        """Read a frame from an RTSP stream"""
+        if self.capture is None:
+            if time() < self.retry_at:
+                return None
+            self.capture = cv2.VideoCapture(self.url)
+            if not self.capture.isOpened():
+                self.disconnect('unable to open the stream')
+                return None
+            MONITOR_LOG.info("Streaming from %s", self.name)
+        ret, frame = self.capture.read()
+        if not ret:
+            self.disconnect('the stream ended')
+            return None
+        self.frames += 1
+        self.backoff = 0
+        if self.gray:
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame
+
+    def disconnect(self, error):
+        """Drop the connection, trying again after a backoff"""
+        self.close()
+        self.last_error = str(error)
+        self.reconnects += 1
+        self.backoff = min(STREAM_MAX_RETRY, self.backoff * 2 or STREAM_RETRY)
+        self.retry_at = time() + self.backoff
+        MONITOR_LOG.info("ERROR: Lost the stream from %s (%s), reconnecting in %.1fs", self.name, error, self.backoff)
+
+    def original(self):
+        """The JPEG the last frame was decoded from, None from RTSP"""
+        return self.jpeg
+
+    def stats(self):
+        """Frames and bytes read and reconnects since it was opened"""
+        return {'url': self.name, 'frames': self.frames, 'bytes': self.bytes, 'scale': self.scale,
+                'reconnects': self.reconnects, 'last_error': self.last_error}
+
+    def annotate(self, text):
+        """Network camera frames aren't annotated"""
+
+    def close(self):
+        """Close the connection"""
+        self.jpeg = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        self.response = None
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+
+def save_frame(filename, frame, original=None):
+    """Write a frame to disk, or the JPEG it was decoded from as it is"""
+    if original is None:
+        return cv2.imwrite(filename, frame)
+    with open(filename, 'wb') as image_file:
+        image_file.write(original)
+    return True
+
+
+class FrameGrabber(object):
+    """Reads frames on its own thread so frames never queue up behind a slow
+       check_state. Only the newest frame is kept, numbered and stamped with
+       the time it was captured, along with the JPEG it was decoded from if
+       the source kept it."""
+
+    def __init__(self, read, on_frame, original=None):
+        self.read = read
+        self.on_frame = on_frame
+        self.original = original
+        self.lock = threading.Lock()
+        self.latest = None
+        self.seq = 0
+        self.last_frame = 0
+        self.failures = 0
+        self.errors = 0
+        self.running = threading.Event()
+        self.wake = threading.Event()
+        self.interval = 0
+        self.thread = None
+
+    def start(self):
+        """Start reading frames"""
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name='frame-grabber')
+        self.thread.daemon = True
+        self.thread.start()
 
     def stop(self):
-        """Leave multicast group and stop listening"""
-        self.port.leaveGroup(SSDP_ADDR, interface=self.interface)
-        self.port.stopListening()
+        """Stop reading frames and wait for the thread to finish its read.
+           Returns False if it's stuck in a read that hasn't come back."""
+        self.running.clear()
+        self.wake.set()
+        stopped = True
+        if self.thread is not None:
+            self.thread.join(GRAB_JOIN_TIMEOUT)
+            stopped = not self.thread.is_alive()
+            self.thread = None
+        return stopped
 
+    def run(self):
+        """Read frames until stopped, telling the reactor about each one"""
+        while self.running.is_set():
+            try:
+                frame = self.read()
+            except Exception as error: # pylint: disable=broad-except
+                LOG.debug("Frame capture threw %s", error)
+                frame = None
+            if frame is None:
+                if not self.failures:
+                    LOG.info("ERROR: Frame capture failed.")
+                self.failures += 1
+                self.errors += 1
+                sleep(GRAB_RETRY)
+                continue
+            self.failures = 0
+            self.last_frame = time()
+            original = self.original() if self.original is not None else None
+            with self.lock:
+                self.seq += 1
+                self.latest = (self.seq, self.last_frame, frame, original)
+            reactor.callFromThread(self.on_frame) # pylint: disable=no-member
+            if self.interval:
+                self.wake.wait(self.interval)
+                self.wake.clear()
 
-class StatusServer(resource.Resource):
-    """HTTP server that serves the status of the camera to the
-       SmartThings hub"""
-    isLeaf = True
-    def __init__(self, device_target, subscription_list, camera_status, camera_image):
-        self.device_target = device_target
-        self.subscription_list = subscription_list
-        self.camera_status = camera_status
-        self.camera_image = camera_image
-        resource.Resource.__init__(self)
+    def pace(self, interval):
+        """Read a frame every interval seconds instead of as fast as they
+           come (0), starting right away"""
+        self.interval = interval
+        self.wake.set()
 
-    def render_SUBSCRIBE(self, request): # pylint: disable=invalid-name
-        """Handle subscribe requests from ST hub - hub wants to be notified
-           of status updates"""
-        headers = request.getAllHeaders()
-        LOG.info("SUBSCRIBE: %s", headers)
-        if b'callback' in headers:
-            cb_url = headers[b'callback'][1:-1].decode()
+    def take(self, after):
+        """The newest (seq, captured, frame, original) if it's newer than seq
+           after, otherwise None"""
+        with self.lock:
+            if self.latest is None or self.latest[0] <= after:
+                return None
+            return self.latest
 
-            if not cb_url in self.subscription_list:
-                self.subscription_list[cb_url] = {}
-                LOG.info('Added subscription %s', cb_url)
-            else:
-                LOG.info('Refreshed subscription %s', cb_url)
 
-            self.subscription_list[cb_url]['expiration'] = time() + 24 * 3600
+class LoadShedder(object):
+    """Compares how long after capture each frame has been acted on with the
+       latency target and, while we're behind, sheds work one step of
+       SHED_STEPS at a time - restoring it again once we've caught up"""
 
-        imageurl = self.camera_image['last_image']
-        if self.camera_status['last_state'] == 'inactive':
-            cmd = 'status-inactive'
-        else:
-            cmd = 'status-active'
-        msg = '<msg><cmd>%s</cmd><usn>uuid:%s::%s</usn><imageurl>%s</imageurl></msg>' % (cmd, UUID, self.device_target, imageurl)
-        return bytes(msg, 'utf-8')
+    def __init__(self, conf):
+        self.level = 0
+        self.latency = 0.0
+        self.changed = 0
+        self.counts = collections.Counter()
+        self.configure(conf)
 
-    def render_GET(self, request): # pylint: disable=invalid-name
-        """Handle polling requests from ST hub"""
-        LOG.info("GET: %s", request.path)
-        if request.path == b'/status':
-            imageurl = self.camera_image['last_image']
-            if self.camera_status['last_state'] == 'inactive':
-                cmd = 'status-inactive'
-            else:
-                cmd = 'status-active'
-            msg = '<msg><cmd>%s</cmd><usn>uuid:%s::%s</usn><imageurl>%s</imageurl></msg>' % (cmd, UUID, self.device_target, imageurl)
-            LOG.info("Polling request from %s for %s - returned %s (%s)",
-                     request.getClientIP(),
-                     request.path,
-                     cmd,
-                     imageurl)
-            return bytes(msg, 'utf-8')
+    def configure(self, conf):
+        """Pick up the latency target, safe to call while running"""
+        self.target = conf.get("latency_target", 0)
+        if not self.target:
+            self.level = 0
+
+    def shedding(self, step):
+        """True if step is currently being shed"""
+        return self.level > SHED_STEPS.index(step)
 
-        LOG.info("Received bogus request from %s for %s",
-                 request.getClientIP(),
-                 request.path)
-        return ""
+    def count(self, action):
+        """Note that some work was shed"""
+        self.counts[action] += 1
+
+    def record(self, latency):
+        """Fold a frame's capture-to-decision latency into the average and
+           shed or restore a step if it's been a while since the last change"""
+        self.latency = 0.8 * self.latency + 0.2 * latency
+        now = time()
+        if not self.target or now - self.changed < SHED_HOLD:
+            return
+        if self.latency > self.target and self.level < len(SHED_STEPS):
+            self.level += 1
+            self.changed = now
+            LOG.warning("Frames are %.2fs behind (target %.2fs), shedding %s",
+                        self.latency, self.target, SHED_STEPS[self.level - 1])
+        elif self.latency < self.target / 2 and self.level > 0:
+            self.level -= 1
+            self.changed = now
+            LOG.info("Frames are %.2fs behind, restoring %s", self.latency, SHED_STEPS[self.level])
+
+    def stats(self):
+        """Counters for the stats endpoint"""
+        stats = dict(self.counts)
+        stats.update({'target': self.target,
+                      'latency': round(self.latency, 3),
+                      'shedding': list(SHED_STEPS[:self.level])})
+        return stats
 
 
 class MonitorCamera(object):
     """Monitors camera status, generating notifications whenever its state changes"""
-    def __init__(self, device_target, subscription_list, camera_status, camera_image, conf): # pylint: disable=too-many-arguments
+    def __init__(self, device_target, subscriptions, camera_status, camera_image, conf, background_file, events=None, heatmap_file=None): # pylint: disable=too-many-arguments
         self.device_target = device_target
-        self.subscription_list = subscription_list
+        self.subscriptions = subscriptions
         self.camera_status = camera_status
         self.camera_image = camera_image
+        self.events = events
+        self.event = None
+        self.tracker = None
+        self.tripwires = None
+        self.classifier = None
+        self.holding = False
+        self.held_gaps = 0
 
-        self.avg = None
+        self.detector = MotionDetector(conf)
+        self.arming = ArmingSchedule(conf)
+        self.closing = None
+        self.shedder = LoadShedder(conf)
+        self.encoder = ImageEncoder(conf)
+        self.dedup = FrameDeduplicator(conf)
+        self.sheet = ContactSheet(conf)
+        self.offload = None
+        self.next_check = None
+        self.source = None
+        self.grabber = None
+        self.last_seq = 0
+        self.waiting = None
+        self.frames_dropped = 0
+        self.pending_writes = 0
+        self.pending_bytes = 0
+
+        # each buffer pool's use against its budget, and features given up
+        # while the process is over memory_limit
+        self.memory = MemoryGuard(conf)
+        self.memory.track('background', lambda: self.detector.avg.nbytes if self.detector.avg is not None else 0)
+        self.memory.track('heatmap', lambda: self.detector.heatmap.counts.nbytes if self.detector.heatmap.counts is not None else 0)
+        self.memory.track('contact_sheet', lambda: self.sheet.tiles.nbytes if self.sheet.tiles is not None else 0)
+        self.memory.track('pending_writes', lambda: self.pending_bytes)
+        self.memory.track('frame', lambda: self.grabber.latest[2].nbytes
+                          if self.grabber is not None and self.grabber.latest is not None else 0)
+        self.memory_check = LoopingCall(self.check_memory)
+        self.memory_check.start(MEMORY_CHECK_INTERVAL, now=False)
+        self.shutdown_triggers = [reactor.addSystemEventTrigger('before', 'shutdown', self.report_memory)] # pylint: disable=no-member
+
+        # the watchdog reopens the camera if it stops giving us frames
+        self.conf = conf
+        self.capture_state = 'starting'
+        self.opened = 0
+        self.recoveries = 0
+        self.backoff = 0
+        self.next_recovery = 0
+        self.watchdog = LoopingCall(self.check_capture)
+        self.watchdog.start(WATCHDOG_INTERVAL, now=False)
+
+        # arm and disarm as the schedule says
+        self.arming_check = LoopingCall(self.update_arming)
+        self.arming_check.start(ARMING_INTERVAL, now=False)
         self.polling_freq = 0
-        self.min_area = conf["min_area"]
+
+        # the background model is saved periodically and at shutdown so a
+        # restart doesn't have to learn the scene again
+        self.background_file = background_file
+        self.heatmap_file = heatmap_file
+        self.restore_background = True
+        self.snapshots = None
+        if conf.get("background_snapshot_interval", 300) > 0:
+            self.snapshots = LoopingCall(self.save_background)
+            self.snapshots.start(conf.get("background_snapshot_interval", 300), now=False)
+        self.shutdown_triggers.append(reactor.addSystemEventTrigger('before', 'shutdown', self.save_background, wait=True)) # pylint: disable=no-member
+        self.shutdown_triggers.append(reactor.addSystemEventTrigger('before', 'shutdown', self.end_event)) # pylint: disable=no-member
+
+        self.apply_conf(conf)
+
+    def apply_conf(self, conf):
+        """Pick up detector and storage settings, safe to call while running"""
+        self.conf = conf
+        self.capture_timeout = conf.get("capture_timeout", 10)
+        self.capture_max_failures = conf.get("capture_max_failures", 20)
+        self.capture_max_backoff = conf.get("capture_max_backoff", 60)
+        self.detector.configure(conf)
+        self.arming.configure(conf)
+        self.disarmed_mode = conf.get("disarmed_mode", "idle")
+        self.disarmed_interval = conf.get("disarmed_interval", 60)
+        if not self.arming.armed and self.grabber is not None:
+            self.grabber.pace(self.disarmed_interval)
+        self.shedder.configure(conf)
+        self.encoder.configure(conf)
+        self.dedup.configure(conf)
+        self.sheet.configure(conf)
+        self.memory.configure(conf)
+        address = conf.get("offload", "")
+        if self.offload is not None and self.offload.address != address:
+            self.offload.stop()
+            self.offload = None
+        if address and self.offload is None:
+            self.offload = OffloadClient(address, self.device_target, conf)
+            self.offload.start()
+        elif self.offload is not None:
+            self.offload.configure(conf)
+        if conf.get("tripwires"):
+            if self.tripwires is None:
+                self.tripwires = TripwireFilter(conf)
+            self.tripwires.configure(conf)
+        else:
+            self.tripwires = None
+        if conf.get("tracking", False):
+            if self.tracker is None:
+                self.tracker = CentroidTracker(conf)
+            self.tracker.configure(conf)
+        else:
+            self.tracker = None
+        self.track_trigger_count = conf.get("track_trigger_count", 1)
+        if conf.get("classifier") and not self.memory.degraded('classifier'):
+            if self.classifier is None:
+                self.classifier = ObjectClassifier(conf)
+            self.classifier.configure(conf)
+        elif self.classifier is not None:
+            self.classifier.close()
+            self.classifier = None
         self.draw_boxes = conf["draw_boxes"]
         self.basepath = conf["basepath"]
         self.s3bucket = conf["s3bucket"]
         self.s3folder = conf["s3folder"]
         self.baseimageurl = conf["baseimageurl"]
         self.fileext = conf["fileext"]
-        self.delta_thresh = conf["delta_thresh"]
+        # a network camera's own JPEGs are saved as they came, without boxes
+        self.save_original = saves_original(conf)
 
-        # Define the video settings
+        self.apply_resolution(conf)
+        self.apply_memory()
+
+    def apply_resolution(self, conf):
+        """The size frames are checked at"""
         self.width = conf["resolution"][0]
         self.height = conf["resolution"][1]
 
-        # initialize the camera and grab a reference to the raw camera capture
-        LOG.info("Initializing the video stream...")
-        self.camera = PiCamera()
-        self.camera.resolution = tuple(conf["resolution"])
-        self.camera.framerate = 30.0
-        self.camera.video_stabilization = True
-        self.rawCapture = PiRGBArray(self.camera, size=tuple(conf["resolution"]))
+    def apply_memory(self):
+        """Let go of the features the memory guard has given up"""
+        if self.memory.degraded('contact_sheet'):
+            self.sheet.release()
+        if self.memory.degraded('heatmap'):
+            self.detector.heatmap.release()
 
-        LOG.info("Warming up the camera...")
-        sleep(conf["camera_warmup_time"])
+    def check_memory(self):
+        """Give up a feature while we're over memory_limit, or take one back
+           once there's room"""
+        if not self.memory.check(time()):
+            return
+        MONITOR_LOG.warning("Resident memory %.1fMB against a limit of %.1fMB, giving up: %s",
+                            self.memory.rss / 1048576.0, self.memory.limit / 1048576.0,
+                            ', '.join(MEMORY_STEPS[:self.memory.level]) or 'nothing')
+        self.apply_conf(self.conf)
+        release_memory()
 
-        current_state = 'inactive'
-        reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
+    def report_memory(self):
+        """Log the peak resident memory at shutdown"""
+        self.memory.check(time())
+        MONITOR_LOG.info("Peak resident memory %.1fMB", self.memory.peak / 1048576.0)
 
-    def check_state(self, current_state):
-        self.current_state = current_state
-        notify = False
-        self.camera.capture(self.rawCapture, format="bgr", use_video_port=True)
+    def start(self, conf, timer):
+        """Open and warm up the camera on a worker thread, then start checking
+           frames. Returns a Deferred that fires once frames are being checked.
+           If the schedule says we're disarmed we are from the first frame."""
+        if not self.arming.wanted(time()):
+            if self.arming.armed:
+                self.disarm()
+            if self.disarmed_mode == 'closed':
+                # disarmed with the camera closed, arm() opens it
+                self.capture_state = 'disarmed'
+                return succeed(None)
+        self.capture_state = 'starting'
+        opened = deferToThread(self.open_camera, conf, timer)
+        opened.addCallback(self.camera_opened)
+        opened.addErrback(self.handle_open_error)
+        return opened
+
+    def camera_opened(self, _):
+        """The camera is open - start checking frames"""
+        self.capture_state = 'running'
+        self.opened = time()
+        self.schedule(self.camera_status['last_state'])
+
+    def stop(self):
+        """Stop checking frames"""
+        if self.next_check is not None and self.next_check.active():
+            self.next_check.cancel()
+        self.next_check = None
+        self.waiting = None
+
+    def close(self):
+        """Stop the timers, worker threads and shutdown hooks, for a camera
+           that's thrown away while the reactor carries on"""
+        self.stop()
+        for timer in (self.memory_check, self.watchdog, self.arming_check, self.snapshots):
+            if timer is not None and timer.running:
+                timer.stop()
+        for trigger in self.shutdown_triggers:
+            reactor.removeSystemEventTrigger(trigger) # pylint: disable=no-member
+        self.shutdown_triggers = []
+        if self.classifier is not None:
+            self.classifier.close()
+            self.classifier = None
+        if self.offload is not None:
+            self.offload.stop()
+            self.offload = None
 
-        # grab the raw NumPy array representing the image
+    def frame_arrived(self):
+        """The grabber has a new frame - check it if we're waiting for one"""
+        if self.waiting is not None:
+            current_state, self.waiting = self.waiting, None
+            self.check_state(current_state)
+
+    def schedule(self, current_state):
+        """Schedule the next check_state, replacing any that's pending"""
+        self.stop()
+        self.next_check = reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
+
+    def handle_open_error(self, failure): # pylint: disable=no-self-use
+        """The camera couldn't be opened - we keep serving status regardless
+           and the watchdog tries again"""
+        self.capture_state = 'failed'
+        MONITOR_LOG.error("ERROR: Unable to open the camera: %s", failure.getErrorMessage())
+
+    def open_camera(self, conf, timer):
+        """Initialize the camera and grab a reference to the raw camera capture.
+           Runs on a worker thread so the reactor keeps serving meanwhile."""
+        with timer.phase('camera modules'):
+            load_camera_modules(camera=not (conf.get("replay") or conf.get("stream")))
+
+        if self.detector.avg is None and self.restore_background:
+            with timer.phase('background'):
+                self.detector.restore(self.background_file, conf.get("background_max_age", 900))
+        if self.detector.heatmap.counts is None and self.heatmap_file:
+            with timer.phase('heatmap'):
+                self.detector.heatmap.restore(self.heatmap_file)
+
+        MONITOR_LOG.info("Initializing the video stream...")
+        with timer.phase('camera open'):
+            if conf.get("replay"):
+                self.source = ReplaySource(conf["replay"], conf.get("replay_fps", 0), capture_gray(conf))
+            elif conf.get("stream"):
+                self.source = NetworkSource(conf["stream"], self.width, capture_gray(conf),
+                                            conf.get("stream_timeout", STREAM_TIMEOUT))
+            else:
+                self.source = PiCameraSource(conf["resolution"], capture_gray(conf))
+
+        MONITOR_LOG.info("Warming up the camera...")
+        with timer.phase('camera warmup'):
+            sleep(conf["camera_warmup_time"])
+
+        self.last_seq = 0
+        self.grabber = FrameGrabber(self.source.read, self.frame_arrived, self.source.original)
+        if not self.arming.armed:
+            self.grabber.pace(self.disarmed_interval)
+        self.grabber.start()
+
+    def close_camera(self):
+        """Release the camera so it can be opened again, returning a Deferred
+           that fires once it's closed. The grabber and source are let go of
+           here on the reactor thread, so /health, /stats and check_state never
+           see them vanish half way through; stopping and closing them can
+           block, so that's done on a worker thread."""
+        grabber, self.grabber = self.grabber, None
+        source, self.source = self.source, None
+        return deferToThread(self.release_camera, grabber, source)
+
+    def release_camera(self, grabber, source):
+        """Stop the grabber and close the source. If the grabber is stuck in a
+           read, closing may hang too, so it's done on a throwaway thread."""
+        stuck = grabber is not None and not grabber.stop()
+        if source is None:
+            return
+        if stuck:
+            closer = threading.Thread(target=self.close_source, args=(source,), name='camera-close')
+            closer.daemon = True
+            closer.start()
+        else:
+            self.close_source(source)
+
+    def close_source(self, source): # pylint: disable=no-self-use
+        """Close a frame source, logging rather than raising if it fails"""
         try:
-            frame = self.rawCapture.array
-        except:
-            LOG.info("ERROR: Frame capture threw an error.")
-            reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
+            source.close()
+        except Exception as error: # pylint: disable=broad-except
+            MONITOR_LOG.info("ERROR: Closing the camera threw an error: %s", error)
+
+    def capture_problem(self):
+        """What's wrong with the camera, or None if frames are coming in (or
+           it's still being opened)"""
+        if self.capture_state == 'failed':
+            return 'The camera could not be opened'
+        if self.capture_state != 'running' or self.grabber is None:
+            return None
+        since = time() - (self.grabber.last_frame or self.opened)
+        if since > self.capture_timeout + self.grabber.interval:
+            return 'No frames for %.0fs' % since
+        if self.grabber.failures >= self.capture_max_failures:
+            return '%d frame captures failed in a row' % self.grabber.failures
+        return None
+
+    def check_capture(self):
+        """Watchdog - close and reopen the camera if frames have stopped
+           coming, waiting longer each time if it keeps failing. The servers,
+           subscriptions and background model carry on regardless."""
+        now = time()
+        problem = self.capture_problem()
+        if problem is None:
+            # once it's been running a while the next failure is retried quickly
+            if self.backoff and self.capture_state == 'running' and now - self.opened > self.capture_max_backoff:
+                self.backoff = 0
+            return
+        if now < self.next_recovery:
             return
 
-        timestamp = datetime.now()
+        self.recoveries += 1
+        self.backoff = min(self.capture_max_backoff, self.backoff * 2 or 1)
+        self.next_recovery = now + self.backoff
+        MONITOR_LOG.error("ERROR: %s, reopening the camera (attempt %d)", problem, self.recoveries)
+        self.stop()
+        self.capture_state = 'recovering'
+        timer = StartupTimer(now)
+        recovered = self.close_camera()
+        recovered.addBoth(lambda _: self.start(self.conf, timer))
+        recovered.addCallback(lambda _: self.capture_state == 'running' and timer.report('Camera recovery'))
 
-        # resize the frame and convert it to grayscale
-        try:
-            frame = imutils.resize(frame, width=self.width, height=self.height)
-        except AttributeError:
-            LOG.info("ERROR: Resizing the frame threw an error.")
-            reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
+    def health(self):
+        """Liveness (we're serving and watching the camera) and readiness
+           (frames are coming in) for the health endpoints"""
+        last_frame = self.grabber.last_frame if self.grabber is not None else 0
+        age = time() - last_frame if last_frame else None
+        timeout = self.capture_timeout + (self.grabber.interval if self.grabber is not None else 0)
+        return {'live': self.watchdog.running,
+                'ready': (self.capture_state == 'running' and age is not None and age <= timeout) or
+                         self.capture_state == 'disarmed',
+                'armed': self.arming.armed,
+                'capture': self.capture_state,
+                'last_frame_age': round(age, 2) if age is not None else None,
+                'capture_failures': self.grabber.failures if self.grabber is not None else 0,
+                'capture_errors': self.grabber.errors if self.grabber is not None else 0,
+                'recoveries': self.recoveries}
+
+    def save_background(self, wait=False):
+        """Snapshot the background model and heatmap and write them out on a
+           worker thread, or right away when we're shutting down"""
+        heatmap = self.detector.heatmap.snapshot() if self.heatmap_file else None
+        if heatmap is not None:
+            if wait:
+                write_background(self.heatmap_file, heatmap, 'heatmap')
+            else:
+                deferToThread(write_background, self.heatmap_file, heatmap, 'heatmap')
+        snapshot = self.detector.snapshot()
+        if snapshot is None:
+            return None
+        if wait:
+            write_background(self.background_file, snapshot)
+            return None
+        return deferToThread(write_background, self.background_file, snapshot)
+
+    def reopen_camera(self, conf):
+        """Close the camera and open it again with new settings. Closing waits
+           for the grabber, so like a recovery it's done on a worker thread.
+           The background model starts over since the frame size may have
+           changed, and the saved one is no better."""
+        MONITOR_LOG.info("Reopening the camera...")
+        self.conf = conf
+        self.apply_resolution(conf)
+        self.stop()
+        self.capture_state = 'starting'
+        self.detector.reset()
+        self.restore_background = False
+        timer = StartupTimer(time())
+        reopened = self.close_camera()
+        reopened.addBoth(lambda _: self.start(conf, timer))
+        reopened.addCallback(lambda _: timer.report('Camera reopen'))
+
+    def update_arming(self):
+        """Arm or disarm if the schedule or a request says so"""
+        armed = self.arming.wanted(time())
+        if armed and not self.arming.armed:
+            self.arm()
+        elif not armed and self.arming.armed:
+            self.disarm()
+
+    def arm(self):
+        """Start looking for motion again, with the background model we kept
+           while disarmed"""
+        MONITOR_LOG.info("Armed")
+        self.arming.change(True, time())
+        if self.capture_state == 'disarmed':
+            timer = StartupTimer(time())
+            closing, self.closing = self.closing or succeed(None), None
+            closing.addBoth(lambda _: self.start(self.conf, timer))
+            closing.addCallback(lambda _: timer.report('Camera arming'))
+        elif self.grabber is not None:
+            self.grabber.pace(0)
+
+    def disarm(self):
+        """Stop looking for motion. The HTTP and SSDP servers carry on, and
+           the camera is either closed or read every disarmed_interval seconds
+           just to keep the background model current."""
+        MONITOR_LOG.info("Disarmed, %s the camera", 'closing' if self.disarmed_mode == 'closed' else 'idling')
+        self.arming.change(False, time())
+        self.holding = False
+        if self.tracker is not None:
+            self.tracker = CentroidTracker(self.conf)
+        if self.camera_status['last_state'] == 'active':
+            MONITOR_LOG.info('State changed from active to inactive')
+            self.camera_status['last_state'] = 'inactive'
+            self.end_event()
+            self.notify_hubs()
+        self.save_background()
+        if self.disarmed_mode == 'closed':
+            self.stop()
+            self.capture_state = 'disarmed'
+            self.closing = self.close_camera()
+        elif self.grabber is not None:
+            self.grabber.pace(self.disarmed_interval)
+
+    def check_state(self, current_state):
+        self.current_state = current_state
+
+        # take the newest frame from the grabber, or wait for the next one
+        latest = self.grabber.take(self.last_seq) if self.grabber is not None else None
+        if latest is None:
+            self.waiting = current_state
+            return
+        seq, captured, frame, original = latest
+        if self.last_seq and seq > self.last_seq + 1:
+            self.frames_dropped += seq - self.last_seq - 1
+        self.last_seq = seq
+        timestamp = datetime.fromtimestamp(captured)
+
+        # when we're behind, a frame that's already older than the latency
+        # target isn't worth looking at - the next one will be fresher
+        if self.shedder.shedding('skip_stale') and time() - captured > self.shedder.target:
+            self.shedder.count('skip_stale')
+            self.schedule(current_state)
             return
 
+        # resize the frame if the camera didn't give us the right size
         try:
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            gray = cv2.GaussianBlur(gray, (21, 21), 0)
-        except:
-            LOG.info("ERROR: Color change or blur threw an error.")
-            reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
+            captured_bytes = frame.nbytes
+            if frame.shape[1] != self.width:
+                frame = imutils.resize(frame, width=self.width, height=self.height)
+        except AttributeError:
+            MONITOR_LOG.info("ERROR: Resizing the frame threw an error.")
+            self.schedule(current_state)
             return
+        self.memory.frame_seen(frame.shape, captured_bytes)
 
-        # if the average frame is None, initialize it
-        if self.avg is None:
-            LOG.info("Starting background model...")
-            try:
-                self.rawCapture.truncate(0)
-                self.avg = gray.copy().astype("float")
-            except:
-                LOG.info("ERROR: Truncate threw an error.")
-                reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
-                return
-        else:
-            # accumulate the weighted average between the current frame and
-            # previous frames, then compute the difference between the current
-            # frame and running average
+        # disarmed we only keep the background model current
+        if not self.arming.armed:
             try:
-                cv2.accumulateWeighted(gray, self.avg, 0.5)
-                frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg))
+                self.detector.follow(self.detector.prepare(frame))
             except:
-                LOG.info("ERROR: Weighted/diff.")
-                reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
-                return
+                MONITOR_LOG.info("ERROR: Updating the background model threw an error.")
+            self.schedule("inactive")
+            return
 
+        # with an aggregator on the LAN it looks for the motion, and we carry
+        # on from here once it answers
+        if self.offload is not None and self.offload.ready():
             try:
-                # threshold the delta image, dilate the thresholded image to fill
-                # in holes, then find contours on thresholded image
-                thresh = cv2.threshold(frameDelta, self.delta_thresh, 255, cv2.THRESH_BINARY)[1]
-                thresh = cv2.dilate(thresh, None, iterations=2)
-                cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                cnts = cnts[0] if imutils.is_cv2() else cnts[1]
+                gray, answer = self.offload.detect(frame, captured)
             except:
-                LOG.info("ERROR: Finding contours.")
-                reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
+                MONITOR_LOG.info("ERROR: Sending the frame to the aggregator.")
+                self.schedule(current_state)
                 return
+            answer.addCallbacks(self.decide, self.offload_failed,
+                                callbackArgs=(current_state, frame, timestamp, captured, gray, original),
+                                errbackArgs=(current_state,))
+            return
 
-            try:
-                # draw the text and timestamp on the frame
-                ts = timestamp.strftime("%A %d %B %Y %I:%M:%S%p")
-                self.camera.annotate_text = ts
-                #cv2.putText(frame, ts, (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
-            except:
-                LOG.info("ERROR: Annotating text.")
-                reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
-                return
+        # when we're still behind, look for motion in a half size frame
+        scale = 1
+        try:
+            analysed = frame
+            if self.shedder.shedding('low_resolution'):
+                self.shedder.count('low_resolution')
+                scale = 2
+                analysed = cv2.resize(frame, (frame.shape[1] // scale, frame.shape[0] // scale), interpolation=cv2.INTER_AREA)
+            gray = self.detector.prepare(analysed)
+        except:
+            MONITOR_LOG.info("ERROR: Color change or blur threw an error.")
+            self.schedule(current_state)
+            return
 
-            # loop over the contours
-            for c in cnts:
-                # if the contour is too small, ignore it
-                if cv2.contourArea(c) < self.min_area:
-                    try:
-                        self.rawCapture.truncate(0)
-                    except:
-                        LOG.info("ERROR: truncating after small contour.")
-                        reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
-                        return
+        try:
+            regions = self.detector.regions(self.detector.detect(gray, captured), scale)
+        except:
+            MONITOR_LOG.info("ERROR: Updating the background model or finding contours.")
+            self.schedule(current_state)
+            return
+        self.decide(regions, current_state, frame, timestamp, captured, gray, original)
+
+    def offload_failed(self, failure, current_state):
+        """The aggregator didn't answer - look for motion here until it's
+           back, starting a new background model as ours is out of date"""
+        MONITOR_LOG.error("ERROR: %s, detecting motion locally", failure.getErrorMessage())
+        self.detector.reset()
+        self.schedule(current_state)
+
+    def decide(self, regions, current_state, frame, timestamp, captured, gray, original=None): # pylint: disable=too-many-arguments
+        """Act on the regions that moved in a frame (None if it couldn't be
+           compared with the background model): follow them, change state,
+           save and upload the frame and tell the hubs. original is the JPEG
+           a network camera sent, saved as it is when we can."""
+        notify = False
+        uploading = None
+
+        # the first frame only seeds the background model
+        if regions is not None:
+            # tripwires only matter while motion is waiting to trigger
+            sharp = None
+            if self.tripwires is not None and regions and current_state == "inactive":
+                sharp = self.tripwires.prepare(frame)
+
+            # draw the text and timestamp on the frame, unless the camera
+            # was closed while the aggregator was looking at it
+            if self.source is not None:
+                try:
+                    ts = timestamp.strftime("%A %d %B %Y %I:%M:%S%p")
+                    self.source.annotate(ts)
+                    #cv2.putText(frame, ts, (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
+                except:
+                    MONITOR_LOG.info("ERROR: Annotating text.")
+                    self.schedule(current_state)
+                    return
 
+            # loop over the regions that moved
+            areas = []
+            boxes = []
+            # crops for the classifier are only needed until motion triggers
+            crops = [] if self.classifier is not None and current_state == "inactive" else None
+            for area, (x, y, w, h) in regions:
+                # if the region is too small, ignore it
+                if area < self.detector.min_area:
                     continue
 
-                if self.draw_boxes:
+                areas.append(area)
+                boxes.append((x, y, w, h))
+                if crops is not None:
+                    crops.append(self.classifier.crop(frame, (x, y, w, h)))
+
+                if self.draw_boxes and self.shedder.shedding('no_boxes'):
+                    self.shedder.count('no_boxes')
+                elif self.draw_boxes:
                     try:
-                        # compute the bounding box for the contour and draw it on the frame
-                        (x, y, w, h) = cv2.boundingRect(c)
+                        # draw the bounding box on the frame
                         cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
                     except:
-                        LOG.info("ERROR: Drawing boxes.")
-                        reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
+                        MONITOR_LOG.info("ERROR: Drawing boxes.")
+                        self.schedule(current_state)
                         return
 
-                # if we have a contour of the right size we're now actively detecting motion
-                if current_state == "inactive":
-                    current_state = "active"
-                    LOG.info('State changed from %s to %s', self.camera_status['last_state'], current_state)
-                    self.camera_status['last_state'] = current_state
-                    notify = True
+            # without tracking any contour of the right size means motion and
+            # no contours at all means it stopped. With tracking an object has
+            # to be followed for a few frames first, and it keeps us active
+            # while it pauses so it doesn't trigger a second notification.
+            triggered = bool(boxes)
+            moving = bool(regions)
+            if self.tracker is not None:
+                self.tracker.update(boxes, timestamp.timestamp())
+                triggered = len(self.tracker.confirmed()) >= self.track_trigger_count
+                if not moving and len(self.tracker) and current_state == "active":
+                    self.holding = True
+                    moving = True
+                elif regions and self.holding:
+                    self.holding = False
+                    self.held_gaps += 1
+
+            # with tripwires the motion only counts once something has
+            # crossed one, or headed the right way, in the last few seconds
+            crossings = None
+            if self.tripwires is not None:
+                self.tripwires.update(sharp, boxes, timestamp.timestamp())
+                if self.draw_boxes and not self.shedder.shedding('no_boxes'):
+                    self.tripwires.draw(frame)
+                if triggered and current_state == "inactive":
+                    crossings = self.tripwires.recent(timestamp.timestamp())
+                    triggered = bool(crossings)
 
-            # no contours found - we're now inactive
-            if not cnts and current_state == "active":
+            # with a classifier the motion only counts once a person or
+            # vehicle has been seen in it (or the classifier can't keep up)
+            classes = None
+            if triggered and current_state == "inactive" and self.classifier is not None:
+                classes = self.classifier.check(crops, time())
+                triggered = bool(classes)
+
+            # if we have enough motion of the right size we're now actively detecting motion
+            if triggered and current_state == "inactive":
+                current_state = "active"
+                MONITOR_LOG.info('State changed from %s to %s', self.camera_status['last_state'], current_state)
+                self.camera_status['last_state'] = current_state
+                self.start_event(timestamp, classes, crossings)
+                notify = True
+
+            # no motion left - we're now inactive
+            if not moving and current_state == "active":
+                self.holding = False
                 current_state = "inactive"
-                LOG.info('State changed from %s to %s', self.camera_status['last_state'], current_state)
+                MONITOR_LOG.info('State changed from %s to %s', self.camera_status['last_state'], current_state)
                 self.camera_status['last_state'] = current_state
+                self.end_event(timestamp)
                 notify = True
 
+            # frames that leave us inactive, with nothing being followed
+            # towards a trigger, show what noise looks like
+            quiet = current_state == "inactive" and not (self.tracker is not None and boxes)
+            self.detector.settle(quiet, captured, frame.shape[0] * frame.shape[1])
+
+            # a frame that looks just like one already kept for this event
+            # isn't written again
+            duplicate = current_state == "active" and self.dedup.duplicate(gray)
+            if duplicate:
+                self.update_event(areas, boxes, None)
+
             # write the frame image to disk
-            if current_state == "active":
+            if current_state == "active" and not duplicate:
                 try:
                     # write it locally first
                     filename = self.get_path(self.basepath, self.fileext, timestamp)
-                    LOG.info("Writing %s", filename)
-                    cv2.imwrite(filename, frame)
+                    MONITOR_LOG.info("Writing %s", filename)
+                    written = self.write_frame(filename, frame, keep=notify,
+                                           original=original if self.save_original else None)
                 except:
-                    LOG.info("ERROR: Writing local file.")
-                    reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
+                    MONITOR_LOG.info("ERROR: Writing local file.")
+                    self.schedule(current_state)
                     return
+                if written is not None:
+                    self.update_event(areas, boxes, filename)
+                self.sheet.add(frame, boxes, timestamp)
 
                 if notify:
-                    try:
-                        # Now write it to S3 so our device handler can get to it
-                        s3filename = self.get_path(self.s3folder, self.fileext, timestamp)
-                        LOG.info("Uploading %s to S3 in bucket %s with key %s", filename, self.s3bucket, s3filename)
-                        S3.meta.client.upload_file(filename, self.s3bucket, s3filename, ExtraArgs={'ACL': 'public-read', 'ContentType': 'image/jpeg'})
-                    except (BotoCoreError, ClientError) as error:
-                        LOG.error("ERROR: Unable to upload file, AWS returned an error.")
-                        LOG.info("%s", error)
-
-                    # This will be sent back to SmartThings
-                    imageurl = "/{}/{}".format(self.s3bucket, s3filename)
-                    LOG.info("Setting last_image to https://s3.amazonaws.com%s", imageurl)
-                    self.camera_image['last_image'] = imageurl
-
-            if notify:
+                    # Now write it to S3 so our device handler can get to it,
+                    # the hubs are notified once it's there
+                    s3filename = self.get_path(self.s3folder, self.encoder.extension(self.fileext), timestamp)
+                    uploading = self.upload_frame(written, filename, frame, s3filename)
+
+            if notify and uploading is None:
                 self.notify_hubs()
 
+        self.shedder.record(time() - captured)
+
         # Schedule next check
-        reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
-        try:
-            self.rawCapture.truncate(0)
-        except:
-            LOG.info("ERROR: Truncate threw an error.")
-            reactor.callLater(self.polling_freq, self.check_state, current_state) # pylint: disable=no-member
+        self.schedule(current_state)
+
+    def start_event(self, timestamp, classes=None, crossings=None):
+        """Motion started - begin recording an event"""
+        self.dedup.reset()
+        self.sheet.start()
+        self.event = {'start': timestamp.timestamp(),
+                      'classes': classes,
+                      'crossings': crossings,
+                      'end': None,
+                      'peak_area': 0,
+                      'boxes': [],
+                      'frames': 0,
+                      'duplicates': 0,
+                      'images': [],
+                      'uploads': [],
+                      'tracks': {}}
+
+    def update_event(self, areas, boxes, filename):
+        """Add a written frame (or with no filename, a duplicate that wasn't
+           written) to the current event, keeping the boxes from the frame
+           with the most motion"""
+        if self.event is None:
+            return
+        if filename is None:
+            self.event['duplicates'] += 1
+        else:
+            self.event['frames'] += 1
+            self.event['images'].append(filename)
+        if self.tracker is not None:
+            for track in self.tracker.confirmed():
+                self.event['tracks'][str(track['id'])] = self.tracker.summary(track)
+        if areas and max(areas) > self.event['peak_area']:
+            self.event['peak_area'] = max(areas)
+            self.event['boxes'] = [list(box) for box in boxes]
+
+    def record_upload(self, event, key, uploaded, encoding=None): # pylint: disable=no-self-use
+        """Note an upload made for an event, with the settings it was
+           encoded with if it was encoded for upload"""
+        if event is not None:
+            upload = {'key': key, 'status': 'ok' if uploaded else 'failed'}
+            if encoding is not None:
+                upload['encoding'] = encoding
+            event['uploads'].append(upload)
+
+    def write_frame(self, filename, frame, keep=False, original=None):
+        """Write a frame to disk - or the JPEG it came in, if given - on a
+           worker thread while we're shedding load. Returns a Deferred that
+           fires once it's written, or None if too many writes are queued
+           already and this one isn't one to keep."""
+        if not self.shedder.shedding('defer_writes'):
+            save_frame(filename, frame, original)
+            self.dedup.written(filename)
+            return succeed(filename)
+        self.shedder.count('defer_writes')
+        # frames waiting to be written count against the pending_writes
+        # budget, and aren't queued at all while we're short of memory
+        if self.memory.degraded('pending_writes'):
+            save_frame(filename, frame, original)
+            self.dedup.written(filename)
+            return succeed(filename)
+        size = frame.nbytes if original is None else len(original)
+        over = self.pending_bytes + size > self.memory.budget('pending_writes')
+        if (self.pending_writes >= MAX_PENDING_WRITES or over) and not keep:
+            self.shedder.count('writes_dropped')
+            return None
+        self.pending_writes += 1
+        self.pending_bytes += size
+        written = deferToThread(save_frame, filename, frame, original)
+        written.addBoth(self.write_done, filename, size)
+        return written
+
+    def write_done(self, result, filename, size):
+        """A deferred write finished"""
+        self.pending_writes -= 1
+        self.pending_bytes -= size
+        if isinstance(result, Failure):
+            MONITOR_LOG.error("ERROR: Writing local file %s: %s", filename, result.getErrorMessage())
+            return None
+        self.dedup.written(filename)
+        return filename
+
+    def upload_frame(self, written, filename, frame, key):
+        """Upload a frame to S3 on a worker thread - encoded to fit the upload
+           budget if there is one, otherwise the file once it's written - then
+           point last_image at it and notify the hubs"""
+        bucket = self.s3bucket
+        event = self.event
+        if self.encoder.enabled():
+            MONITOR_LOG.info("Uploading frame to S3 in bucket %s with key %s", bucket, key)
+            uploading = deferToThread(self.encode_and_upload, frame, bucket, key)
+        else:
+            MONITOR_LOG.info("Uploading %s to S3 in bucket %s with key %s", filename, bucket, key)
+            uploading = written.addCallback(lambda _: deferToThread(upload_to_s3, filename, bucket, key))
+            uploading.addCallback(lambda uploaded: (uploaded, None))
+        uploading.addErrback(self.handle_upload_error)
+        uploading.addCallback(self.finish_upload, event, bucket, key)
+        return uploading
+
+    def encode_and_upload(self, frame, bucket, key):
+        """Encode a frame to fit the budget and upload it, timing the upload
+           so the budget can follow the link. Runs on a worker thread."""
+        data, settings = self.encoder.encode(frame)
+        began = time()
+        uploaded = put_to_s3(data, bucket, key, self.encoder.content_type())
+        settings['upload_seconds'] = round(time() - began, 3)
+        if uploaded:
+            self.encoder.record(len(data), time() - began)
+        return uploaded, settings
+
+    def upload_sheet(self, sheet, bucket, key):
+        """Encode an event's contact sheet - to the upload budget if there is
+           one - and upload it. Runs on a worker thread."""
+        if self.encoder.enabled():
+            return self.encode_and_upload(sheet, bucket, key)
+        data = cv2.imencode('.jpg', sheet, [cv2.IMWRITE_JPEG_QUALITY, SHEET_QUALITY])[1].tobytes()
+        return put_to_s3(data, bucket, key), None
+
+    def finish_sheet(self, result, bucket, key):
+        """The contact sheet is uploaded (or failed) - if no new event has
+           started, show it on the hubs in place of the notify frame"""
+        uploaded, _ = result
+        if not uploaded:
+            self.sheet.failed += 1
+            return
+        self.sheet.uploaded += 1
+        if self.event is None:
+            imageurl = "/{}/{}".format(bucket, key)
+            MONITOR_LOG.info("Setting last_image to the contact sheet https://s3.amazonaws.com%s", imageurl)
+            self.camera_image['last_image'] = imageurl
+            self.notify_hubs()
+
+    def handle_upload_error(self, failure): # pylint: disable=no-self-use
+        """The upload blew up rather than failing cleanly"""
+        MONITOR_LOG.error("ERROR: Unable to upload file: %s", failure.getErrorMessage())
+        return False, None
+
+    def finish_upload(self, result, event, bucket, key):
+        """The upload is done (or failed) - tell the hubs"""
+        uploaded, encoding = result
+        self.record_upload(event, key, uploaded, encoding)
+
+        # This will be sent back to SmartThings
+        imageurl = "/{}/{}".format(bucket, key)
+        MONITOR_LOG.info("Setting last_image to https://s3.amazonaws.com%s", imageurl)
+        self.camera_image['last_image'] = imageurl
+        self.notify_hubs()
+
+    def end_event(self, timestamp=None):
+        """Motion stopped (or we're shutting down) - store the event"""
+        if self.event is None:
             return
+        event, self.event = self.event, None
+        event['end'] = (timestamp or datetime.now()).timestamp()
+
+        # one upload summing up the whole event
+        sheet = self.sheet.build()
+        if sheet is not None:
+            bucket = self.s3bucket
+            key = self.get_path(self.s3folder, '-sheet' + self.encoder.extension('.jpg'), datetime.fromtimestamp(event['start']))
+            event['sheet'] = key
+            MONITOR_LOG.info("Uploading the event's contact sheet to S3 in bucket %s with key %s", bucket, key)
+            uploading = deferToThread(self.upload_sheet, sheet, bucket, key)
+            uploading.addErrback(self.handle_upload_error)
+            uploading.addCallback(self.finish_sheet, bucket, key)
+        if self.events is not None:
+            self.events.append(event)
 
     def get_path(self, basepath, fileext, timestamp):
         # construct the file path
@@ -406,36 +4170,35 @@ class MonitorCamera(object):
         else:
             cmd = 'status-active'
 
-        if not self.subscription_list:
-            LOG.info('No current subscription list')
+        if not self.subscriptions:
+            MONITOR_LOG.info('No current subscription list')
 
-        for subscription in self.subscription_list:
-            LOG.info('Subscription: %s', subscription)
-            if self.subscription_list[subscription]['expiration'] > time():
-                try:
-                    LOG.info("Notifying hub %s", subscription)
-                    msg = '<msg><cmd>%s</cmd><usn>uuid:%s::%s</usn><imageurl>%s</imageurl></msg>' % (cmd, UUID, self.device_target, self.camera_image['last_image'])
-                    body = StringProducer(bytes(msg, 'utf-8'))
-                    agent = Agent(reactor)
-                    req = agent.request(
-                        b'POST',
-                        bytes(subscription, 'utf-8'),
-                        Headers({'CONTENT-LENGTH': [str(len(msg))]}),
-                        body)
-                    req.addCallback(self.handle_response)
-                    req.addErrback(self.handle_error)
-                except:
-                    LOG.info("ERROR: hub notification threw an error.")
-                    return
+        for subscription in self.subscriptions.callbacks():
+            MONITOR_LOG.info('Subscription: %s', subscription)
+            try:
+                MONITOR_LOG.info("Notifying hub %s", subscription)
+                msg = '<msg><cmd>%s</cmd><usn>uuid:%s::%s</usn><imageurl>%s</imageurl></msg>' % (cmd, UUID, self.device_target, self.camera_image['last_image'])
+                body = StringProducer(bytes(msg, 'utf-8'))
+                agent = Agent(reactor)
+                req = agent.request(
+                    b'POST',
+                    bytes(subscription, 'utf-8'),
+                    Headers({'CONTENT-LENGTH': [str(len(msg))]}),
+                    body)
+                req.addCallback(self.handle_response)
+                req.addErrback(self.handle_error)
+            except:
+                MONITOR_LOG.info("ERROR: hub notification threw an error.")
+                return
 
     def handle_response(self, response): # pylint: disable=no-self-use
         """Handle the SmartThings hub returning a status code to the POST.
            This is actually unexpected - it typically closes the connection
            for POST/PUT without giving a response code."""
         if response.code == 202:
-            LOG.info("Status update accepted")
+            MONITOR_LOG.info("Status update accepted")
         else:
-            LOG.error("Unexpected response code: %s", response.code)
+            MONITOR_LOG.error("Unexpected response code: %s", response.code)
 
     def handle_error(self, response): # pylint: disable=no-self-use
         """Handle errors generating performing the NOTIFY. There doesn't seem
@@ -443,9 +4206,189 @@ class MonitorCamera(object):
            doesn't generate a proper response code for POST or PUT, and if
            NOTIFY is used, it ignores the body."""
         if isinstance(response.value, ResponseFailed):
-            LOG.debug("Response failed (expected)")
+            MONITOR_LOG.debug("Response failed (expected)")
+        else:
+            MONITOR_LOG.error("Unexpected response: %s", response)
+
+
+class CameraService(object):
+    """Wires the SSDP server, HTTP server and camera monitor together and
+       applies config changes to them while running"""
+
+    def __init__(self, conf_path, conf, logs=None):
+        self.conf_path = conf_path
+        self.conf = conf
+        self.logs = logs
+        self.device_target = 'urn:schemas-upnp-org:device:RPi_Security_Camera:{}'.format(conf['device_index'])
+        self.subscriptions = None
+        self.events = None
+        self.camera_status = {'last_state': 'inactive'}
+        self.camera_image = {'last_image': conf["blankimage"]}
+        self.ssdp = None
+        self.status = None
+        self.listener = None
+        self.monitor = None
+        self.startup = StartupTimer()
+
+    def state_path(self, key, default):
+        """Where to keep a state file - the config setting key if there is
+           one, otherwise default next to the config file"""
+        return self.conf.get(key) or os.path.join(os.path.dirname(os.path.abspath(self.conf_path)), default)
+
+    def start(self):
+        """Start serving and monitoring"""
+        conf = self.conf
+        LOG.info('device_target set to %s', self.device_target)
+
+        self.subscriptions = SubscriptionRegistry(self.state_path("subscription_file", 'subscriptions.json'))
+        self.events = EventLog(self.state_path("events_file", 'events.jsonl'))
+
+        # SSDP server to handle discovery
+        with self.startup.phase('ssdp'):
+            self.ssdp = SSDPServer(status_port=conf["http_port"],
+                                   device_target=self.device_target,
+                                   announce_interval=conf.get("ssdp_announce_interval", 60),
+                                   rate_limit=conf.get("ssdp_rate_limit", 2))
+
+        # HTTP site to handle subscriptions/polling
+        with self.startup.phase('http'):
+            self.status = StatusServer(self.device_target, self.subscriptions, self.camera_status, self.camera_image,
+                                       service=self, admin_token=conf.get("admin_token"), events=self.events)
+            self.listener = reactor.listenTCP(conf["http_port"], server.Site(self.status)) # pylint: disable=no-member
+
+        LOG.info('Initialization complete, answering discovery %.2fs after launch', time() - LAUNCH_TIME)
+
+        # the S3 client and the camera are slow to set up, do them in parallel
+        # on worker threads while the reactor answers the hub
+        s3_ready = deferToThread(self.startup.timed, 's3 client', get_s3)
+
+        # Monitor camera state and send notifications on state change
+        self.monitor = MonitorCamera(device_target=self.device_target,
+                                     subscriptions=self.subscriptions,
+                                     camera_status=self.camera_status,
+                                     camera_image=self.camera_image,
+                                     conf=conf,
+                                     background_file=self.state_path("background_file", 'background.npz'),
+                                     events=self.events,
+                                     heatmap_file=self.state_path("heatmap_file", 'heatmap.npz'))
+        camera_ready = self.monitor.start(conf, self.startup)
+        DeferredList([s3_ready, camera_ready]).addCallback(lambda _: self.startup.report())
+
+        # let hubs restored from disk know we're back and what state we're in
+        reactor.callWhenRunning(self.monitor.notify_hubs) # pylint: disable=no-member
+
+    def health(self):
+        """Served on /health"""
+        if self.monitor is None:
+            return {'live': False, 'ready': False}
+        return self.monitor.health()
+
+    def heatmap(self, path):
+        """(content type, body) for the heatmap endpoints, or None if there's
+           no heatmap yet"""
+        heatmap = self.monitor.detector.heatmap
+        if path == '/heatmap.npy':
+            body, content_type = heatmap.raw(), b'application/octet-stream'
+        elif path == '/heatmap/mask.png':
+            body, content_type = heatmap.mask_image(), b'image/png'
         else:
-            LOG.error("Unexpected response: %s", response)
+            body, content_type = heatmap.image(self.monitor.detector.avg), b'image/png'
+        return None if body is None else (content_type, body)
+
+    def stats(self):
+        """Counters served on /stats"""
+        return {'uptime': time() - LAUNCH_TIME,
+                'state': self.camera_status['last_state'],
+                'subscriptions': len(self.subscriptions),
+                'events': len(self.events),
+                'ssdp_throttled': self.ssdp.throttled,
+                'detector': self.monitor.detector.stats(),
+                'tracks': len(self.monitor.tracker) if self.monitor.tracker is not None else None,
+                'tracking_held_gaps': self.monitor.held_gaps,
+                'frames_dropped': self.monitor.frames_dropped,
+                'capture': self.monitor.health(),
+                'latency': self.monitor.shedder.stats(),
+                'logging': self.logs.stats() if self.logs is not None else None,
+                'uploads': self.monitor.encoder.stats(),
+                'dedup': self.monitor.dedup.stats(),
+                'contact_sheets': self.monitor.sheet.stats(),
+                'offload': self.monitor.offload.stats() if self.monitor.offload is not None else None,
+                'arming': self.monitor.arming.stats(),
+                'tripwires': self.monitor.tripwires.stats() if self.monitor.tripwires is not None else None,
+                'classifier': self.monitor.classifier.stats() if self.monitor.classifier is not None else None,
+                'stream': self.monitor.source.stats() if isinstance(self.monitor.source, NetworkSource) else None,
+                'memory': self.monitor.memory.stats()}
+
+    def set_armed(self, armed):
+        """Arm (True), disarm (False) or follow the schedule again (None) right
+           away, for the admin endpoints"""
+        self.monitor.arming.request(armed, time())
+        self.monitor.update_arming()
+        return self.monitor.arming.stats()
+
+    def reload(self):
+        """Re-read the config file and apply whatever changed, rebuilding only
+           the affected components. Returns a summary of what was done."""
+        LOG.info('Reloading configuration from %s', self.conf_path)
+        try:
+            conf = load_conf(self.conf_path)
+        except (OSError, ValueError) as error:
+            LOG.error("ERROR: Configuration not reloaded: %s", error)
+            return {'errors': str(error)}
+
+        changed = sorted(key for key in set(conf) | set(self.conf)
+                         if key in CONF_SCHEMA and conf.get(key) != self.conf.get(key))
+        components = set()
+        restart = []
+        for key in changed:
+            component = CONF_SCHEMA[key][2]
+            if component is None:
+                # can't be changed live, keep running with the old value
+                restart.append(key)
+                if key in self.conf:
+                    conf[key] = self.conf[key]
+                else:
+                    conf.pop(key)
+            elif component:
+                components.add(component)
+        # whether frames are captured in gray can follow from other settings
+        if capture_gray(conf) != capture_gray(self.conf):
+            components.add('camera')
+
+        if 'http' in components:
+            self.status.admin_token = conf.get("admin_token")
+            if conf["http_port"] != self.conf["http_port"]:
+                try:
+                    listener = reactor.listenTCP(conf["http_port"], server.Site(self.status)) # pylint: disable=no-member
+                except CannotListenError as error:
+                    LOG.error("ERROR: Configuration not reloaded: %s", error)
+                    return {'errors': str(error)}
+                self.listener.stopListening()
+                self.listener = listener
+                # the port is part of the location we advertise
+                components.add('ssdp')
+
+        old_conf, self.conf = self.conf, conf
+        if 'logging' in components:
+            if self.logs is not None:
+                self.logs.configure(conf)
+            else:
+                LOG.setLevel(logging.DEBUG if conf["debug"] else logging.INFO)
+        if 'ssdp' in components:
+            self.ssdp.configure(status_port=conf["http_port"],
+                                announce_interval=conf.get("ssdp_announce_interval", 60),
+                                rate_limit=conf.get("ssdp_rate_limit", 2))
+        if 'detector' in components or 'storage' in components:
+            self.monitor.apply_conf(conf)
+            self.monitor.update_arming()
+        if 'storage' in components and self.camera_image['last_image'] == old_conf["blankimage"]:
+            self.camera_image['last_image'] = conf["blankimage"]
+        if 'camera' in components:
+            self.monitor.reopen_camera(conf)
+
+        result = {'changed': changed, 'rebuilt': sorted(components), 'restart_required': restart}
+        LOG.info('Configuration reloaded: %s', result)
+        return result
 
 
 def main():
@@ -458,34 +4401,30 @@ def main():
         return False
 
     # load the configuration
-    conf = json.load(open(args.conf))
-
-    # set log level
-    if conf["debug"]:
-        LOG.setLevel(logging.DEBUG)
-
-    device_target = 'urn:schemas-upnp-org:device:RPi_Security_Camera:{}'.format(conf['device_index'])
-    LOG.info('device_target set to %s', device_target)
-
-    subscription_list = {}
-    camera_status = {'last_state': 'inactive'}
-    camera_image = {'last_image': conf["blankimage"]}
+    begin = time()
+    try:
+        conf = load_conf(args.conf)
+    except ValueError as error:
+        LOG.error("Configuration file {} is invalid: {}".format(args.conf, error))
+        return False
 
-    # SSDP server to handle discovery
-    SSDPServer(status_port=conf["http_port"], device_target=device_target)
+    # log through a queue to a writer thread from here on
+    logs = LogWriter()
+    logs.configure(conf)
+    reactor.addSystemEventTrigger('after', 'shutdown', logs.stop) # pylint: disable=no-member
 
-    # HTTP site to handle subscriptions/polling
-    status_site = server.Site(StatusServer(device_target, subscription_list, camera_status, camera_image))
-    reactor.listenTCP(conf["http_port"], status_site) # pylint: disable=no-member
+    # uploads go to a local S3 stand-in when testing
+    global S3_ENDPOINT # pylint: disable=global-statement
+    S3_ENDPOINT = conf.get("s3_endpoint") or None
 
-    LOG.info('Initialization complete')
+    service = CameraService(args.conf, conf, logs)
+    service.startup.record('imports', LAUNCH_TIME, begin)
+    service.startup.record('config', begin, time())
+    service.start()
 
-    # Monitor camera state and send notifications on state change
-    MonitorCamera(device_target=device_target,
-                  subscription_list=subscription_list,
-                  camera_status=camera_status,
-                  camera_image=camera_image,
-                  conf=conf)
+    # kill -HUP reloads the configuration
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(service.reload)) # pylint: disable=no-member
 
     reactor.run() # pylint: disable=no-member
 
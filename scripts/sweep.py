@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+""" Offline re-analysis and parameter sweep for the SmartThings camera scripts
+
+Runs archived clips - video files, image sequences like frames/%04d.jpg or
+directories of frames - through the camera script's own MonitorCamera, so
+the resize, background model, tracking, tripwires, dedup and event logic
+are exactly what the camera runs. Every combination of the settings given
+with --set is tried, spread over a pool of processes, and for each one it
+reports the events, notifications, frames written, bytes that would have
+been uploaded and CPU time per checked frame. With --labels it also scores
+the events against ones marked by hand.
+
+    sweep.py --set 'delta_thresh=[5,8,12]' --set 'min_area=[500,1000]' clips/*.mp4
+
+Nothing is written, uploaded or sent to the hubs - frames are encoded in
+memory to measure them. Frames are checked every polling_freq seconds of
+clip time, as if the camera always kept up. The classifier and offload are
+turned off and the camera is always armed.
+
+Dependencies: python-twisted, cv2, numpy, imutils (for the camera script)
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+from datetime import datetime
+from time import process_time, time
+
+from twisted.internet.defer import maybeDeferred, succeed
+
+from aggregator import load_detector
+
+# setting up logging for this script
+_LEVEL = logging.INFO
+_FORMAT = "%(asctime)-15s [%(levelname)-8s] : %(lineno)d : %(name)s.%(funcName)s : %(message)s"
+logging.basicConfig(format=_FORMAT, level=_LEVEL)
+LOG = logging.getLogger()
+
+# clip times are counted from here, so timestamps are ordinary dates
+CLIP_EPOCH = 1000000000.0
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+# these need a running camera, hubs or another machine
+SWEEP_OVERRIDES = {'classifier': '', 'offload': '', 'arm_schedule': [], 'latency_target': 0,
+                   'background_snapshot_interval': 0}
+
+CAMERA = None
+REPLAY_CAMERA = None
+
+
+def parse_args(args):
+    """ Parse the arguments passed to this script """
+    here = os.path.dirname(os.path.abspath(__file__))
+    argp = argparse.ArgumentParser()
+    argp.add_argument('clips', nargs='+', help="video files, image sequences or directories of frames")
+    argp.add_argument('--conf', default=os.path.join(here, 'conf-mac.json'), help="camera config to start from")
+    argp.add_argument('--detector', default=os.path.join(here, 'smartthings-mac.py'),
+                      help="camera script to take the MonitorCamera from, either one (the Pi's needs picamera)")
+    argp.add_argument('--set', action='append', default=[], metavar='KEY=JSON',
+                      help="a setting to override, a JSON list sweeps its values (repeatable)")
+    argp.add_argument('--fps', type=float, default=10, help="frame rate of directories of frames, and of clips that don't say")
+    argp.add_argument('--labels', help='JSON file of {"clip name": [[start, end], ...]} seconds with real motion')
+    argp.add_argument('--slack', type=float, default=2, help="seconds an event may miss a label by and still match it")
+    argp.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="processes to run")
+    argp.add_argument('--json', help="also write the results to this file")
+    return argp.parse_args(args)
+
+
+def parse_grid(settings):
+    """Turn KEY=JSON settings into a list of override dicts, one for each
+       combination of the values given as lists"""
+    keys = []
+    choices = []
+    for setting in settings:
+        key, _, text = setting.partition('=')
+        try:
+            value = json.loads(text)
+        except ValueError:
+            value = text
+        keys.append(key)
+        choices.append(value if isinstance(value, list) else [value])
+    return [dict(zip(keys, combination)) for combination in itertools.product(*choices)]
+
+
+def read_frames(path, fps):
+    """Yield (seconds, frame) from a video, image sequence or directory of
+       frames"""
+    cv2 = CAMERA.cv2
+    if os.path.isdir(path):
+        names = sorted(name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+        for index, name in enumerate(names):
+            frame = cv2.imread(os.path.join(path, name))
+            if frame is not None:
+                yield index / fps, frame
+        return
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError('Unable to open %s' % path)
+    rate = capture.get(cv2.CAP_PROP_FPS) or fps
+    index = 0
+    try:
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                return
+            yield index / rate, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+class ClipFrame(object):
+    """Stands in for the FrameGrabber, holding the frame the sweep is on"""
+
+    def __init__(self):
+        self.latest = None
+
+    def take(self, after):
+        """The (seq, captured, frame, original) if it's newer than seq after"""
+        if self.latest is None or self.latest[0] <= after:
+            return None
+        return self.latest
+
+
+class ClipSource(object):
+    """Stands in for the camera, which the Pi script writes the timestamp
+       with"""
+
+    def annotate(self, text):
+        """Clip frames aren't annotated"""
+
+
+def make_replay_camera(camera):
+    """A MonitorCamera from the camera script that's fed frames by the sweep
+       and measures what it would have written and uploaded instead"""
+
+    class ReplayCamera(camera.MonitorCamera):
+        """MonitorCamera that counts instead of writing and uploading"""
+
+        def __init__(self, conf):
+            self.counts = collections.Counter()
+            self.cpu = 0.0
+            self.due = 0.0
+            self.state = 'inactive'
+            self.last_size = 0
+            # frames are stamped with their time in the clip, which is long
+            # past, so there's no real latency to shed work for
+            conf = dict(conf, latency_target=0)
+            super().__init__('sweep', camera.SubscriptionRegistry(), {'last_state': 'inactive'},
+                             {'last_image': ''}, conf, None, events=[])
+            self.source = ClipSource()
+            self.grabber = ClipFrame()
+
+        def feed(self, seconds, frame):
+            """Check a frame from the clip like the camera would"""
+            self.counts['checked'] += 1
+            # the frame is shared between the configs, and check_state draws
+            # on frames that are already the right size
+            self.grabber.latest = (self.counts['checked'], CLIP_EPOCH + seconds, frame.copy(), None)
+            began = process_time()
+            self.check_state(self.state)
+            self.cpu += process_time() - began
+            self.due = seconds + self.polling_freq
+
+        def finish(self, seconds):
+            """The clip is over - close any event still running, and let go of
+               the timers and shutdown hooks that would keep this camera alive
+               in the worker for good"""
+            self.end_event(datetime.fromtimestamp(CLIP_EPOCH + seconds))
+            self.close()
+
+        def schedule(self, current_state):
+            self.state = current_state
+
+        def write_frame(self, filename, frame, keep=False, original=None):
+            data = camera.cv2.imencode(self.fileext, frame)[1]
+            self.last_size = len(data)
+            self.counts['frames_written'] += 1
+            self.counts['bytes_written'] += self.last_size
+            return succeed(filename)
+
+        def upload_frame(self, written, filename, frame, key):
+            size = len(self.encoder.encode(frame)[0]) if self.encoder.enabled() else self.last_size
+            self.counts['uploads'] += 1
+            self.counts['upload_bytes'] += size
+            self.notify_hubs()
+            return succeed(None)
+
+        def upload_sheet(self, sheet, bucket, key):
+            if self.encoder.enabled():
+                data = self.encoder.encode(sheet)[0]
+            else:
+                data = camera.cv2.imencode('.jpg', sheet, [camera.cv2.IMWRITE_JPEG_QUALITY, camera.SHEET_QUALITY])[1]
+            self.counts['sheets'] += 1
+            self.counts['upload_bytes'] += len(data)
+            return True, None
+
+        def notify_hubs(self):
+            self.counts['notifications'] += 1
+
+    return ReplayCamera
+
+
+def init_worker(detector):
+    """Load the camera script once per process. Its worker thread calls run
+       in line, and OpenCV gets one thread so the CPU times are per frame."""
+    global CAMERA, REPLAY_CAMERA # pylint: disable=global-statement
+    logging.getLogger().setLevel(logging.WARNING)
+    CAMERA = load_detector(detector)
+    CAMERA.deferToThread = maybeDeferred
+    CAMERA.cv2.setNumThreads(1)
+    REPLAY_CAMERA = make_replay_camera(CAMERA)
+
+
+def run_job(job):
+    """Run one clip through cameras for some of the configs, decoding it
+       once for all of them"""
+    clip, fps, confs = job
+    cameras = {index: REPLAY_CAMERA(conf) for index, conf in confs}
+    seconds = 0.0
+    for seconds, frame in read_frames(clip, fps):
+        for monitor in cameras.values():
+            if seconds >= monitor.due:
+                monitor.feed(seconds, frame)
+    results = []
+    for index, monitor in cameras.items():
+        monitor.finish(seconds)
+        events = [[round(event['start'] - CLIP_EPOCH, 2), round(event['end'] - CLIP_EPOCH, 2)] for event in monitor.events]
+        duplicates = sum(event['duplicates'] for event in monitor.events)
+        results.append((index, clip, seconds, dict(monitor.counts, cpu=monitor.cpu, duplicates=duplicates), events))
+    return results
+
+
+def score(events, labels, slack):
+    """Compare a clip's events with its labels. Returns the labels caught by
+       an event and the events that match no label."""
+    def overlaps(event, label):
+        return event[0] <= label[1] + slack and event[1] >= label[0] - slack
+    caught = sum(1 for label in labels if any(overlaps(event, label) for event in events))
+    false = sum(1 for event in events if not any(overlaps(event, label) for label in labels))
+    return caught, false
+
+
+def summarise(grid, results, labels, slack):
+    """Add up each config's results over the clips"""
+    summaries = []
+    for index, overrides in enumerate(grid):
+        counts = collections.Counter()
+        cpu = 0.0
+        events = {}
+        for result_index, clip, seconds, clip_counts, clip_events in results:
+            if result_index != index:
+                continue
+            cpu += clip_counts.pop('cpu')
+            counts.update(clip_counts)
+            counts['seconds'] += seconds
+            events[clip] = clip_events
+        summary = {'settings': overrides,
+                   'events': sum(len(clip_events) for clip_events in events.values()),
+                   'notifications': counts['notifications'],
+                   'frames_written': counts['frames_written'],
+                   'duplicates': counts['duplicates'],
+                   'bytes_written': counts['bytes_written'],
+                   'upload_bytes': counts['upload_bytes'],
+                   'frames_checked': counts['checked'],
+                   'cpu_ms_per_frame': round(1000 * cpu / counts['checked'], 2) if counts['checked'] else 0.0,
+                   'cpu_seconds': round(cpu, 2),
+                   'clip_events': events}
+        if labels is not None:
+            caught = false = total = 0
+            for clip, clip_events in events.items():
+                clip_labels = labels.get(os.path.basename(os.path.normpath(clip)), [])
+                clip_caught, clip_false = score(clip_events, clip_labels, slack)
+                caught += clip_caught
+                false += clip_false
+                total += len(clip_labels)
+            summary.update({'labels': total,
+                            'missed': total - caught,
+                            'false_events': false,
+                            'recall': round(caught / float(total), 3) if total else None,
+                            'precision': round(1 - false / float(summary['events']), 3) if summary['events'] else None})
+        summaries.append(summary)
+    return summaries
+
+
+def report(args, summaries):
+    """Print a table with a row per config"""
+    keys = sorted({key for summary in summaries for key in summary['settings']})
+    columns = ['events', 'notifications', 'frames_written', 'duplicates', 'upload_bytes', 'cpu_ms_per_frame']
+    if args.labels:
+        columns += ['missed', 'false_events', 'recall', 'precision']
+    rows = [[json.dumps(summary['settings'].get(key)) for key in keys] +
+            [str(summary[column]) for column in columns] for summary in summaries]
+    header = keys + columns
+    widths = [max(len(cell) for cell in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(summaries, json_file, indent=4)
+
+
+def main():
+    """Main function to handle use from command line"""
+    args = parse_args(sys.argv[1:])
+
+    with open(args.conf) as conf_file:
+        base = json.load(conf_file)
+    labels = None
+    if args.labels:
+        with open(args.labels) as labels_file:
+            labels = json.load(labels_file)
+
+    # check every combination before starting any of them
+    init_worker(args.detector)
+    logging.getLogger().setLevel(_LEVEL)
+    grid = parse_grid(args.set)
+    confs = []
+    for overrides in grid:
+        conf = dict(base, **overrides)
+        conf.update(SWEEP_OVERRIDES)
+        errors = CAMERA.validate_conf(conf)
+        if errors:
+            LOG.error("Settings %s: %s", json.dumps(overrides), '; '.join(errors))
+            return False
+        confs.append(conf)
+
+    # a job is a clip and some of the configs, split so every worker has
+    # something to do even with only a few clips
+    chunks = min(len(confs), max(1, -(-args.workers // len(args.clips))))
+    jobs = [(clip, args.fps, [(index, confs[index]) for index in range(chunk, len(confs), chunks)])
+            for clip in args.clips for chunk in range(chunks)]
+    LOG.info("Running %d clips through %d configs as %d jobs on %d workers",
+             len(args.clips), len(confs), len(jobs), args.workers)
+
+    began = time()
+    results = []
+    with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args.detector,)) as pool:
+        for done, job_results in enumerate(pool.imap_unordered(run_job, jobs), 1):
+            results.extend(job_results)
+            LOG.info("%d of %d jobs done after %.1fs", done, len(jobs), time() - began)
+
+    report(args, summarise(grid, results, labels, args.slack))
+    return True
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Loads the camera scripts, whose names aren't importable, as modules"""
+
+import importlib.util
+import json
+import os
+
+SCRIPTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NAMES = ('mac', 'pi')
+_LOADED = {}
+
+
+def load(name):
+    """smartthings-<name>.py as a module, with cv2 and numpy loaded (but not
+       picamera, so the Pi script loads anywhere)"""
+    if name not in _LOADED:
+        path = os.path.join(SCRIPTS, 'smartthings-%s.py' % name)
+        spec = importlib.util.spec_from_file_location('smartthings_' + name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if name == 'pi':
+            module.load_camera_modules(camera=False)
+        else:
+            module.load_camera_modules()
+        _LOADED[name] = module
+    return _LOADED[name]
+
+
+def scripts():
+    """Both camera scripts, as (name, module)"""
+    return [(name, load(name)) for name in NAMES]
+
+
+def sample_conf(name='conf-mac.json'):
+    """One of the sample configs"""
+    with open(os.path.join(SCRIPTS, name)) as conf_file:
+        return json.load(conf_file)
+
+
+def monitor(camera, conf, background_file=None):
+    """A MonitorCamera that hasn't been started, with no hubs and no event
+       log. close() it when done."""
+    return camera.MonitorCamera('test', camera.SubscriptionRegistry(), {'last_state': 'inactive'},
+                                {'last_image': ''}, conf, background_file)
@@ -0,0 +1,113 @@
+"""ArmingSchedule windows, requests and time kept in each mode"""
+
+import time
+import unittest
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+from twisted.internet.defer import Deferred
+
+from camera_scripts import monitor, sample_conf, scripts
+
+NIGHTS = [{"start": "22:30", "end": "07:00", "days": ["mon", "tue", "wed", "thu", "fri"]}]
+
+
+def at(day, clock):
+    """A datetime in the week of Monday 2026-01-05, day 0 being Monday"""
+    hours, minutes = clock.split(':')
+    return datetime(2026, 1, 5 + day, int(hours), int(minutes))
+
+
+def stamp(day, clock):
+    """at() as a unix time"""
+    return time.mktime(at(day, clock).timetuple())
+
+
+class ArmingScheduleTest(unittest.TestCase):
+
+    def test_no_schedule(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                schedule = camera.ArmingSchedule({})
+                self.assertTrue(schedule.scheduled(at(6, '03:00')))
+
+    def test_window_past_midnight(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                schedule = camera.ArmingSchedule({"arm_schedule": NIGHTS})
+                checks = [(0, '22:29', False), (0, '22:30', True), (1, '06:59', True), (1, '07:00', False),
+                          # Friday night runs into Saturday morning, but Saturday night isn't armed
+                          (4, '23:00', True), (5, '06:00', True), (5, '23:00', False), (6, '06:00', False),
+                          # Sunday night isn't armed, so Monday morning isn't either
+                          (0, '06:00', False)]
+                self.assertEqual([(day, clock, schedule.scheduled(at(day, clock))) for day, clock, _ in checks],
+                                 checks)
+
+    def test_day_and_all_day_windows(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                schedule = camera.ArmingSchedule({"arm_schedule": [{"start": "09:00", "end": "17:00"},
+                                                                   {"start": "00:00", "end": "00:00",
+                                                                    "days": ["sun"]}]})
+                self.assertTrue(schedule.scheduled(at(2, '12:00')))
+                self.assertFalse(schedule.scheduled(at(2, '17:00')))
+                self.assertFalse(schedule.scheduled(at(2, '08:59')))
+                self.assertTrue(schedule.scheduled(at(6, '03:00')))
+
+    def test_request_holds_until_the_schedule_changes(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                schedule = camera.ArmingSchedule({"arm_schedule": NIGHTS})
+                self.assertFalse(schedule.wanted(stamp(0, '12:00')))
+                schedule.request(True, stamp(0, '12:00'))
+                self.assertTrue(schedule.wanted(stamp(0, '18:00')))
+                self.assertEqual(schedule.stats()['by'], 'request')
+                # the schedule arms at 22:30 anyway and takes over again
+                self.assertTrue(schedule.wanted(stamp(0, '23:00')))
+                self.assertIsNone(schedule.override)
+                self.assertFalse(schedule.wanted(stamp(1, '08:00')))
+
+                schedule.request(False, stamp(1, '23:00'))
+                self.assertFalse(schedule.wanted(stamp(2, '01:00')))
+                self.assertFalse(schedule.wanted(stamp(2, '08:00')))
+                self.assertIsNone(schedule.override)
+                schedule.request(None, stamp(2, '08:00'))
+                self.assertTrue(schedule.wanted(stamp(2, '23:00')))
+
+    def test_durations(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                schedule = camera.ArmingSchedule({})
+                schedule.since = time.time() - 300
+                schedule.change(False, schedule.since + 100)
+                stats = schedule.stats()
+                self.assertFalse(stats['armed'])
+                self.assertEqual(stats['changes'], 1)
+                self.assertEqual(stats['armed_seconds'], 100)
+                self.assertAlmostEqual(stats['disarmed_seconds'], 200, delta=1)
+                self.assertAlmostEqual(stats['armed_fraction'], 0.333, delta=0.01)
+
+
+class StartDisarmedTest(unittest.TestCase):
+
+    def test_starts_disarmed_outside_the_schedule(self):
+        later = datetime.now() + timedelta(hours=2)
+        window = {"start": later.strftime('%H:%M'), "end": (later + timedelta(minutes=1)).strftime('%H:%M')}
+        for name, camera in scripts():
+            for mode in ('idle', 'closed'):
+                with self.subTest(name, mode=mode):
+                    conf = dict(sample_conf(), arm_schedule=[window], disarmed_mode=mode)
+                    with mock.patch.object(camera, 'deferToThread', return_value=Deferred()) as opening:
+                        camera_monitor = monitor(camera, conf)
+                        self.addCleanup(camera_monitor.close)
+                        camera_monitor.start(conf, camera.StartupTimer(time.time()))
+                    self.assertFalse(camera_monitor.arming.armed)
+                    # idle still opens the camera, to keep the background model current
+                    self.assertEqual(camera_monitor.capture_state, 'starting' if mode == 'idle' else 'disarmed')
+                    self.assertEqual(any(call[0][0] == camera_monitor.open_camera for call in opening.call_args_list),
+                                     mode == 'idle')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+"""Saving the background model and restoring it at startup"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from unittest import mock
+
+import numpy as np
+
+from twisted.internet.defer import maybeDeferred
+
+from camera_scripts import monitor, sample_conf, scripts
+
+FRAME = (180, 320)
+
+
+def detector(camera, **settings):
+    """A MotionDetector with the required settings and any others"""
+    conf = {"delta_thresh": 5, "min_area": 100}
+    conf.update(settings)
+    return camera.MotionDetector(conf)
+
+
+def scene():
+    """A frame with something in it"""
+    frame = np.full(FRAME + (3,), 60, np.uint8)
+    frame[40:120, 100:200] = 180
+    return frame
+
+
+class RestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'background.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def save(self, camera, motion, **meta):
+        """Write motion's background model out, with any meta overridden"""
+        model, saved = motion.snapshot()
+        saved.update(meta)
+        camera.write_background(self.path, (model, saved))
+
+    def learned(self, camera, **settings):
+        motion = detector(camera, **settings)
+        motion.detect(motion.prepare(scene()))
+        motion.detect(motion.prepare(scene()))
+        return motion
+
+    def test_round_trip(self):
+        for name, camera in scripts():
+            for low_memory in (False, True):
+                with self.subTest(name, low_memory=low_memory):
+                    motion = self.learned(camera)
+                    self.save(camera, motion)
+                    restored = detector(camera, low_memory=low_memory)
+                    self.assertTrue(restored.restore(self.path, 900))
+                    self.assertEqual(restored.avg.dtype, np.float32 if low_memory else np.float64)
+                    # fixed point to 1/256 of a grey level
+                    self.assertLessEqual(np.abs(restored.avg - motion.avg).max(), 1 / camera.BACKGROUND_SCALE)
+                    # and it's used straight away, with no frame to seed it
+                    self.assertEqual(len(restored.detect(restored.prepare(scene()))), 0)
+
+    def test_stale(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.save(camera, self.learned(camera), saved=time.time() - 1000)
+                restored = detector(camera)
+                self.assertFalse(restored.restore(self.path, 900))
+                self.assertIsNone(restored.avg)
+                self.assertTrue(restored.restore(self.path, 1200))
+
+    def test_built_differently(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.save(camera, self.learned(camera, blur_size=11))
+                self.assertFalse(detector(camera).restore(self.path, 900))
+                # a model that doesn't match its own header
+                self.save(camera, self.learned(camera), shape=[90, 160])
+                self.assertFalse(detector(camera).restore(self.path, 900))
+
+    def test_other_frame_size(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.save(camera, self.learned(camera))
+                restored = detector(camera)
+                self.assertTrue(restored.restore(self.path, 900))
+                # frames of another size seed a new model instead
+                bigger = np.full((360, 640, 3), 60, np.uint8)
+                self.assertIsNone(restored.detect(restored.prepare(bigger)))
+                self.assertEqual(restored.avg.shape, (360, 640))
+
+    def test_missing_or_unreadable(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.assertFalse(detector(camera).restore(self.path, 900))
+                with open(self.path, 'w') as saved:
+                    json.dump({}, saved)
+                self.assertFalse(detector(camera).restore(self.path, 900))
+
+
+class ReopenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'background.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_reopen_starts_a_new_model(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                motion = detector(camera)
+                motion.detect(motion.prepare(np.full((360, 640, 3), 60, np.uint8)))
+                camera.write_background(self.path, motion.snapshot())
+                conf = dict(sample_conf(), replay='clip.avi', camera_warmup_time=0, background_snapshot_interval=0)
+                camera_monitor = monitor(camera, conf, self.path)
+                self.addCleanup(camera_monitor.close)
+                # open the camera there and then, with a stand-in clip
+                with mock.patch.object(camera, 'deferToThread', maybeDeferred), \
+                        mock.patch.object(camera, 'ReplaySource'), mock.patch.object(camera, 'FrameGrabber'):
+                    camera_monitor.start(conf, camera.StartupTimer(time.time()))
+                    self.assertEqual(camera_monitor.detector.avg.shape, (360, 640))
+                    camera_monitor.reopen_camera(dict(conf, resolution=[320, 180]))
+                self.assertEqual(camera_monitor.capture_state, 'running')
+                self.assertIsNone(camera_monitor.detector.avg)
+
+
+if __name__ == '__main__':
+    unittest.main()
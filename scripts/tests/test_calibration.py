@@ -0,0 +1,102 @@
+"""NoiseCalibrator and the statistics it's built on"""
+
+import unittest
+
+import numpy as np
+
+from camera_scripts import scripts
+
+FRAME = (360, 640)
+PIXELS = FRAME[0] * FRAME[1]
+
+
+def square(side):
+    """A contour enclosing side x side pixels"""
+    return np.array([[[0, 0]], [[side, 0]], [[side, side]], [[0, side]]], np.int32)
+
+
+def noise(rng, sigma):
+    """Absolute frame differences of gaussian noise"""
+    return np.clip(np.abs(rng.normal(0, sigma, FRAME)), 0, 255).astype(np.uint8)
+
+
+class NoiseCalibratorTest(unittest.TestCase):
+
+    def calibrator(self, camera, **settings):
+        conf = {"delta_thresh": 5, "min_area": 5000, "calibrate": True, "calibrate_frames": 20}
+        conf.update(settings)
+        return camera.NoiseCalibrator(conf)
+
+    def feed(self, calibrator, rng, sigma, side, quiet=True, frames=20):
+        calibrated = None
+        for _ in range(frames):
+            self.assertTrue(calibrator.sampling(0))
+            calibrator.sample(noise(rng, sigma), [square(side)])
+            calibrated = calibrator.keep(quiet, 0, PIXELS) or calibrated
+        return calibrated
+
+    def test_normal_tail(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.assertAlmostEqual(camera.normal_tail(0.3173), 1.0, places=3)
+                self.assertAlmostEqual(camera.normal_tail(0.05), 1.96, places=2)
+
+    def test_hist_percentile(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                hist = np.zeros(256, np.float32)
+                hist[10] = 50
+                hist[20] = 50
+                self.assertEqual(camera.hist_percentile(hist, 0.25), 10.5)
+                self.assertEqual(camera.hist_percentile(hist, 0.75), 20.5)
+                self.assertIsInstance(camera.hist_percentile(hist, 0.5), float)
+
+    def test_thresholds_follow_the_noise(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                rng = np.random.RandomState(1)
+                calibrator = self.calibrator(camera)
+                self.assertEqual(calibrator.thresholds(), (5, 5000))
+                delta_thresh, min_area = self.feed(calibrator, rng, sigma=4, side=40)
+                # 0.1% of gaussian noise is past 3.3 sigmas
+                self.assertTrue(12 <= delta_thresh <= 15, delta_thresh)
+                # the biggest blob times the margin, below the configured value
+                self.assertEqual(min_area, int(40 * 40 * 1.5))
+
+    def test_min_area_bounds(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                rng = np.random.RandomState(2)
+                calibrator = self.calibrator(camera)
+                _, min_area = self.feed(calibrator, rng, sigma=1, side=1)
+                self.assertEqual(min_area, int(camera.CALIBRATE_MIN_AREA * PIXELS))
+                calibrator.next_window = 0
+                _, min_area = self.feed(calibrator, rng, sigma=1, side=300)
+                self.assertEqual(min_area, int(camera.CALIBRATE_MAX_AREA * PIXELS))
+
+    def test_delta_thresh_floor(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                rng = np.random.RandomState(3)
+                calibrator = self.calibrator(camera, delta_thresh=25)
+                delta_thresh, _ = self.feed(calibrator, rng, sigma=2, side=40)
+                self.assertEqual(delta_thresh, 25)
+
+    def test_busy_frames_are_not_counted(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                rng = np.random.RandomState(4)
+                calibrator = self.calibrator(camera)
+                self.assertIsNone(self.feed(calibrator, rng, sigma=4, side=40, quiet=False))
+                self.assertEqual(calibrator.stats()['collected'], 0)
+                self.assertEqual(calibrator.thresholds(), (5, 5000))
+
+    def test_disabled(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                calibrator = self.calibrator(camera, calibrate=False)
+                self.assertFalse(calibrator.sampling(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
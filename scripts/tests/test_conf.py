@@ -0,0 +1,125 @@
+"""validate_conf and load_conf"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from camera_scripts import sample_conf, scripts
+
+
+SAMPLES = {'mac': 'conf-mac.json', 'pi': 'conf-pizero.json'}
+
+
+class ValidateConfTest(unittest.TestCase):
+
+    def test_sample_configs(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.assertEqual(camera.validate_conf(sample_conf(SAMPLES[name])), [])
+
+    def test_missing_and_mistyped(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                conf = sample_conf()
+                del conf["http_port"]
+                conf["delta_thresh"] = "5"
+                # a bool isn't a number, even though it's an int to isinstance
+                conf["min_area"] = True
+                self.assertEqual(camera.validate_conf(conf), ['delta_thresh should be int or float',
+                                                               'http_port is missing',
+                                                               'min_area should be int or float'])
+
+    def test_ranges(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                conf = sample_conf()
+                checks = [({"resolution": [640]}, 'resolution should be [width, height]'),
+                          ({"http_port": 70000}, 'http_port should be between 1 and 65535'),
+                          ({"delta_thresh": 0}, 'delta_thresh should be between 1 and 255'),
+                          ({"blur_size": 20}, 'blur_size should be a positive odd number'),
+                          ({"min_area": -1}, 'min_area should not be negative'),
+                          ({"lighting_threshold": 1.5}, 'lighting_threshold should be a fraction of the frame '
+                                                        'between 0 and 1'),
+                          ({"offload": "aggregator"}, 'offload should be the aggregator\'s "host:port"'),
+                          ({"disarmed_mode": "off"}, 'disarmed_mode should be "idle" or "closed"')]
+                for change, error in checks:
+                    self.assertEqual(camera.validate_conf(dict(conf, **change)), [error])
+
+    def test_rule_lists(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                conf = sample_conf()
+                self.assertEqual(camera.validate_conf(dict(conf, tripwires=[{"name": "gate", "direction": "up"}],
+                                                           arm_schedule=[{"start": "22:30", "end": "07:00"}])), [])
+                errors = camera.validate_conf(dict(conf, tripwires=[{"name": "gate"}],
+                                                   arm_schedule=[{"start": "25:00", "end": "07:00"}]))
+                self.assertEqual(len(errors), 2)
+                self.assertTrue(errors[0].startswith('tripwires entries should be like'))
+                self.assertTrue(errors[1].startswith('arm_schedule entries should be like'))
+
+
+class LoadConfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, conf):
+        path = os.path.join(self.dir, 'conf.json')
+        with open(path, 'w') as conf_file:
+            json.dump(conf, conf_file)
+        return path
+
+    def test_load(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.assertEqual(camera.load_conf(self.write(sample_conf())), sample_conf())
+                with self.assertRaisesRegex(ValueError, 'should be a JSON object'):
+                    camera.load_conf(self.write([]))
+                with self.assertRaisesRegex(ValueError, 'http_port should be between 1 and 65535'):
+                    camera.load_conf(self.write(dict(sample_conf(), http_port=0)))
+
+
+class ReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reload(self, camera, conf, changes):
+        """Reload a running service's config with changes, returning the
+           summary and the camera monitor it was applied to"""
+        path = os.path.join(self.dir, 'conf.json')
+        service = camera.CameraService(path, conf)
+        service.monitor, service.ssdp, service.status = mock.Mock(), mock.Mock(), mock.Mock()
+        with open(path, 'w') as conf_file:
+            json.dump(dict(conf, **changes), conf_file)
+        return service.reload(), service.monitor
+
+    def test_capture_mode_follows_other_settings(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                # low_memory captures a network camera in gray, until
+                # something kept needs colour
+                conf = dict(sample_conf(), low_memory=True, stream='http://camera/video.mjpg')
+                del conf["capture_gray"]
+                self.assertTrue(camera.capture_gray(conf))
+                result, monitor = self.reload(camera, conf, {"contact_sheet": True})
+                self.assertIn('camera', result['rebuilt'])
+                monitor.reopen_camera.assert_called_once()
+
+                result, monitor = self.reload(camera, conf, {"min_area": 900})
+                self.assertEqual(result['rebuilt'], ['detector'])
+                monitor.reopen_camera.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
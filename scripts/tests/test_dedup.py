@@ -0,0 +1,39 @@
+"""FrameDeduplicator"""
+
+import unittest
+
+import numpy as np
+
+from camera_scripts import scripts
+
+
+def gradient(flip=False):
+    """A gray frame getting brighter to the right, or the left if flipped"""
+    row = np.linspace(0, 255, 320).astype(np.uint8)
+    return np.tile(row[::-1] if flip else row, (180, 1))
+
+
+class FrameDeduplicatorTest(unittest.TestCase):
+
+    def test_off_by_default(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                dedup = camera.FrameDeduplicator({})
+                self.assertFalse(dedup.duplicate(gradient()))
+                self.assertFalse(dedup.duplicate(gradient()))
+                self.assertEqual(dedup.checked, 0)
+
+    def test_repeats_within_an_event(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                dedup = camera.FrameDeduplicator({"dedup": True})
+                self.assertFalse(dedup.duplicate(gradient()))
+                self.assertTrue(dedup.duplicate(gradient()))
+                self.assertFalse(dedup.duplicate(gradient(flip=True)))
+                self.assertEqual(dedup.duplicates, 1)
+                dedup.reset()
+                self.assertFalse(dedup.duplicate(gradient()))
+
+
+if __name__ == '__main__':
+    unittest.main()
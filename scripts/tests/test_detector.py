@@ -0,0 +1,84 @@
+"""MotionDetector's optional stages"""
+
+import unittest
+
+import numpy as np
+
+from camera_scripts import scripts
+
+FRAME = (180, 320)
+
+
+def detector(camera, **settings):
+    """A MotionDetector with the required settings and any others"""
+    conf = {"delta_thresh": 5, "min_area": 100}
+    conf.update(settings)
+    return camera.MotionDetector(conf)
+
+
+def frames(motion, *levels):
+    """Feed flat gray frames at each level, returning what the last one found"""
+    found = None
+    for now, level in enumerate(levels):
+        found = motion.detect(np.full(FRAME, level, np.uint8), now)
+    return found
+
+
+class LightingTest(unittest.TestCase):
+
+    def test_off_by_default(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                motion = detector(camera)
+                found = frames(motion, 40, 40, 200)
+                self.assertEqual(len(found), 1)
+                self.assertEqual(motion.lighting_changes, 0)
+
+    def test_whole_frame_change_settles(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                motion = detector(camera, lighting_threshold=0.5, lighting_settle_time=2)
+                self.assertIsNone(frames(motion, 40, 40, 200))
+                self.assertEqual(motion.lighting_changes, 1)
+                # still settling, then the re-seeded model is quiet
+                self.assertIsNone(motion.detect(np.full(FRAME, 200, np.uint8), 3))
+                self.assertEqual(len(motion.detect(np.full(FRAME, 200, np.uint8), 5)), 0)
+
+
+class HeatmapTest(unittest.TestCase):
+
+    def test_off_by_default(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                motion = detector(camera)
+                frames(motion, 40, 40, 200)
+                self.assertFalse(motion.heatmap.enabled)
+                self.assertIsNone(motion.heatmap.activity())
+
+    def test_counts_moving_blocks(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                motion = detector(camera, heatmap=True, heatmap_block=20)
+                frames(motion, 40, 40, 200)
+                activity = motion.heatmap.activity()
+                self.assertEqual(activity.shape, (9, 16))
+                self.assertTrue((activity > 0).all())
+
+
+class FollowTest(unittest.TestCase):
+
+    def test_only_the_background_model(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                motion = detector(camera, heatmap=True, calibrate=True, calibrate_frames=5)
+                for level in (40, 200, 40, 200):
+                    motion.follow(np.full(FRAME, level, np.uint8))
+                self.assertEqual(motion.avg.shape, FRAME)
+                self.assertAlmostEqual(float(motion.avg[0, 0]), 140)
+                self.assertIsNone(motion.heatmap.activity())
+                self.assertIsNone(motion.calibration.pending)
+                self.assertEqual(motion.calibration.stats()['collected'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""ImageEncoder's search for the best upload that fits the byte budget"""
+
+import unittest
+
+import numpy as np
+
+from camera_scripts import scripts
+
+WIDTH, HEIGHT = 640, 480
+
+
+def frame():
+    """A noisy colour frame, which takes some squeezing to fit a budget"""
+    rng = np.random.RandomState(2)
+    gradient = np.linspace(0, 255, WIDTH)[None, :, None]
+    return np.clip(gradient + rng.randint(-40, 40, (HEIGHT, WIDTH, 3)), 0, 255).astype(np.uint8)
+
+
+class ImageEncoderTest(unittest.TestCase):
+
+    def encode(self, camera, **conf):
+        encoder = camera.ImageEncoder(conf)
+        data, settings = encoder.encode(frame())
+        self.assertEqual(len(data), settings['bytes'])
+        self.assertGreaterEqual(settings['quality'], encoder.min_quality)
+        self.assertLessEqual(settings['quality'], encoder.max_quality)
+        self.assertGreaterEqual(settings['width'], encoder.min_width)
+        self.assertLessEqual(settings['width'], WIDTH)
+        decoded = camera.cv2.imdecode(np.frombuffer(data, np.uint8), camera.cv2.IMREAD_COLOR)
+        self.assertEqual(decoded.shape[:2], (settings['height'], settings['width']))
+        return encoder, data, settings
+
+    def test_fits_at_best_quality(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                _, _, settings = self.encode(camera, upload_max_bytes=1000000)
+                self.assertEqual((settings['quality'], settings['width']), (90, WIDTH))
+                self.assertFalse(settings['over_budget'])
+
+    def test_quality_search(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                encoder, data, settings = self.encode(camera, upload_max_bytes=60000)
+                self.assertLessEqual(len(data), 60000)
+                self.assertEqual(settings['width'], WIDTH)
+                self.assertLess(settings['quality'], 90)
+                # the highest quality that fits
+                self.assertGreater(len(encoder.encode_at(frame(), settings['quality'] + 1)), 60000)
+
+    def test_downscales_when_the_lowest_quality_is_too_big(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                encoder, data, settings = self.encode(camera, upload_max_bytes=20000)
+                self.assertLessEqual(len(data), 20000)
+                self.assertLess(settings['width'], WIDTH)
+                self.assertEqual(settings['height'], settings['width'] * HEIGHT // WIDTH)
+                self.assertFalse(settings['over_budget'])
+                self.assertEqual(encoder.over_budget, 0)
+
+    def test_sends_it_anyway_at_the_smallest_allowed(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                encoder, data, settings = self.encode(camera, upload_max_bytes=1000, upload_min_width=320)
+                self.assertGreater(len(data), 1000)
+                self.assertEqual(settings['quality'], encoder.min_quality)
+                # one more step would have gone under upload_min_width
+                self.assertLess(settings['width'] * camera.UPLOAD_SCALE_STEP, 320)
+                self.assertTrue(settings['over_budget'])
+                self.assertEqual(encoder.over_budget, 1)
+
+    def test_budget_follows_throughput(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                encoder = camera.ImageEncoder({"upload_max_bytes": 200000, "upload_target_seconds": 2})
+                self.assertEqual(encoder.budget(), 200000)
+                encoder.record(50000, 1.0)
+                self.assertEqual(encoder.budget(), 100000)
+                # never below the floor, however slow uploads get
+                encoder.throughput = 1000
+                self.assertEqual(encoder.budget(), camera.MIN_UPLOAD_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
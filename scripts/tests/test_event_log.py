@@ -0,0 +1,82 @@
+"""EventLog paging and index recovery"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from camera_scripts import scripts
+
+
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_log(self, name, camera, starts):
+        log = camera.EventLog(os.path.join(self.dir, name + '.jsonl'))
+        for start in starts:
+            log.append({'start': start, 'end': start + 1})
+        return log
+
+    def read_page(self, log, offset, size):
+        with open(log.path, 'rb') as events:
+            events.seek(offset)
+            return [json.loads(line) for line in events.read(size).splitlines()]
+
+    def page_through(self, log, limit):
+        """Follow next pages like a client would, returns the ids seen"""
+        ids = []
+        since, skip = 0, 0
+        for _ in range(100):
+            offset, size, _, next_page = log.query(since, float('inf'), limit, skip)
+            ids += [event['id'] for event in self.read_page(log, offset, size)]
+            if next_page is None:
+                return ids
+            since, skip = next_page
+        self.fail('paging never finished')
+
+    def test_range(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                log = self.make_log(name, camera, [10, 20, 30, 40])
+                offset, size, count, next_page = log.query(20, 40, 10)
+                self.assertEqual(count, 2)
+                self.assertIsNone(next_page)
+                self.assertEqual([event['start'] for event in self.read_page(log, offset, size)], [20, 30])
+
+    def test_pages_with_shared_starts(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                # more events share a start than fit on a page, as after the
+                # clock steps back
+                log = self.make_log(name, camera, [10, 20, 20, 20, 20, 20, 30])
+                for limit in (1, 2, 3, 10):
+                    self.assertEqual(self.page_through(log, limit), list(range(1, 8)))
+
+    def test_clock_step_keeps_index_sorted(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                log = self.make_log(name, camera, [30, 10, 20])
+                self.assertEqual(log.starts, [30, 30, 30])
+                self.assertEqual(self.page_through(log, 2), [1, 2, 3])
+
+    def test_rebuilds_index(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                path = self.make_log(name, camera, [10, 20]).path
+                # killed part way through writing the next event
+                with open(path, 'ab') as events:
+                    events.write(b'{"start": 3')
+                os.remove(path + '.idx')
+                log = camera.EventLog(path)
+                self.assertEqual(log.starts, [10, 20])
+                self.assertEqual(log.size, os.path.getsize(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""Reading a JPEG's size and decoding it at a reduced scale"""
+
+import unittest
+
+import numpy as np
+
+from camera_scripts import scripts
+
+
+def encode(camera, width, height, *params):
+    """A colour JPEG of that size"""
+    frame = np.random.RandomState(1).randint(0, 255, (height, width, 3)).astype(np.uint8)
+    return camera.cv2.imencode('.jpg', frame, list(params))[1].tobytes()
+
+
+class JpegSizeTest(unittest.TestCase):
+
+    def test_size(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                data = encode(camera, 1280, 720)
+                self.assertEqual(camera.jpeg_size(data), (1280, 720))
+                progressive = encode(camera, 640, 480, camera.cv2.IMWRITE_JPEG_PROGRESSIVE, 1)
+                self.assertEqual(camera.jpeg_size(progressive), (640, 480))
+                # fill bytes are allowed before a marker
+                self.assertEqual(camera.jpeg_size(data[:2] + b'\xff\xff' + data[2:]), (1280, 720))
+
+    def test_no_size(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                data = encode(camera, 320, 240)
+                self.assertIsNone(camera.jpeg_size(b''))
+                self.assertIsNone(camera.jpeg_size(b'\xff\xd8not a jpeg at all'))
+                # cut off before the frame header
+                self.assertIsNone(camera.jpeg_size(data[:20]))
+
+
+class JpegScaleTest(unittest.TestCase):
+
+    def test_scale(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                data = encode(camera, 1280, 720)
+                self.assertEqual([camera.jpeg_scale(data, width) for width in (100, 160, 161, 320, 640, 641, 1280, 1920)],
+                                 [8, 8, 4, 4, 2, 1, 1, 1])
+                self.assertEqual(camera.jpeg_scale(b'garbage', 100), 1)
+
+    def test_decode(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                data = encode(camera, 1280, 720)
+                self.assertEqual(camera.decode_jpeg(data).shape, (720, 1280, 3))
+                self.assertEqual(camera.decode_jpeg(data, 4).shape, (180, 320, 3))
+                self.assertEqual(camera.decode_jpeg(data, 8, gray=True).shape, (90, 160))
+                self.assertEqual(camera.decode_jpeg(data, camera.jpeg_scale(data, 500)).shape, (360, 640, 3))
+                self.assertIsNone(camera.decode_jpeg(b'garbage'))
+
+
+if __name__ == '__main__':
+    unittest.main()
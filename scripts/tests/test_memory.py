@@ -0,0 +1,131 @@
+"""Memory budgets, the gray capture they imply and the MemoryGuard"""
+
+import unittest
+
+from unittest import mock
+
+from camera_scripts import sample_conf, scripts
+
+MB = 1024 * 1024
+
+
+def make_conf(**settings):
+    conf = {"resolution": [640, 360], "fileext": ".jpg"}
+    conf.update(settings)
+    return conf
+
+
+class MemoryBudgetTest(unittest.TestCase):
+
+    def test_frame_sized_budgets(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                budgets = camera.memory_budgets(make_conf())
+                self.assertEqual(budgets['background'], 640 * 360 * 8)
+                self.assertEqual(budgets['heatmap'], 22 * 40 * 4)
+                self.assertEqual(budgets['frame'], 640 * 360 * 3)
+                self.assertEqual(budgets['pending_writes'], camera.MEMORY_BUDGETS['pending_writes'])
+
+    def test_low_memory_budgets(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                budgets = camera.memory_budgets(make_conf(low_memory=True, capture_gray=True,
+                                                          memory_budgets={'frame': 1000}))
+                self.assertEqual(budgets['background'], 640 * 360 * 4)
+                self.assertEqual(budgets['contact_sheet'], camera.LOW_MEMORY_BUDGETS['contact_sheet'])
+                self.assertEqual(budgets['frame'], 1000)
+
+    def test_budget_names_are_checked(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                conf = sample_conf()
+                self.assertEqual(camera.validate_conf(dict(conf, memory_budgets={'heatmap': 4096})), [])
+                errors = camera.validate_conf(dict(conf, memory_budgets={'tiles': 4096}))
+                self.assertEqual(len(errors), 1)
+                self.assertIn('memory_budgets', errors[0])
+
+    def test_capture_gray(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                stream = make_conf(low_memory=True, stream='http://camera/video.mjpg')
+                self.assertTrue(camera.capture_gray(stream))
+                # something kept is made from the frames, so colour matters
+                self.assertFalse(camera.capture_gray(dict(stream, contact_sheet=True)))
+                self.assertFalse(camera.capture_gray(dict(stream, upload_max_bytes=80000)))
+                self.assertFalse(camera.capture_gray(dict(stream, stream_save_original=False)))
+                self.assertFalse(camera.capture_gray(dict(stream, fileext='.png')))
+                self.assertFalse(camera.capture_gray(make_conf(low_memory=True)))
+                self.assertFalse(camera.capture_gray(dict(stream, low_memory=False)))
+                # set either way, it's what it says
+                self.assertFalse(camera.capture_gray(dict(stream, capture_gray=False)))
+                self.assertTrue(camera.capture_gray(make_conf(capture_gray=True)))
+
+
+class MemoryGuardTest(unittest.TestCase):
+
+    def check(self, camera, guard, rss, now):
+        with mock.patch.object(camera, 'memory_usage', return_value=(rss * MB, rss * MB)):
+            return guard.check(now)
+
+    def test_gives_up_and_takes_back_steps(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                guard = camera.MemoryGuard(make_conf(memory_limit=100))
+                self.assertFalse(self.check(camera, guard, 90, 0))
+                # one step per check while over the limit
+                for level, step in enumerate(camera.MEMORY_STEPS, 1):
+                    self.assertTrue(self.check(camera, guard, 120, level))
+                    self.assertEqual(guard.level, level)
+                    self.assertTrue(guard.degraded(step))
+                self.assertFalse(self.check(camera, guard, 120, 10))
+                # under the limit but not by enough
+                self.assertFalse(self.check(camera, guard, 90, 100))
+                # well under, but not for long enough yet
+                self.assertFalse(self.check(camera, guard, 50, 4 + camera.MEMORY_HOLD - 1))
+                self.assertTrue(self.check(camera, guard, 50, 4 + camera.MEMORY_HOLD))
+                self.assertFalse(guard.degraded(camera.MEMORY_STEPS[-1]))
+                self.assertTrue(guard.degraded(camera.MEMORY_STEPS[-2]))
+
+    def test_no_limit(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                guard = camera.MemoryGuard(make_conf())
+                self.assertFalse(self.check(camera, guard, 10000, 0))
+                self.assertEqual(guard.level, 0)
+
+    def test_pools_over_budget(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                guard = camera.MemoryGuard(make_conf())
+                used = {'frame': 1280 * 720 * 3, 'background': 0}
+                guard.track('frame', lambda: used['frame'])
+                guard.track('background', lambda: used['background'])
+                self.check(camera, guard, 10, 0)
+                self.assertEqual(guard.stats()['over_budget'], ['frame'])
+                used['frame'] = 640 * 360 * 3
+                self.check(camera, guard, 10, 1)
+                self.assertEqual(guard.stats()['over_budget'], [])
+                self.assertEqual(guard.stats()['pools']['frame'], {'used': 640 * 360 * 3, 'budget': 640 * 360 * 3})
+
+    def test_budgets_follow_the_frames_seen(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                # a 4:3 camera with a 16:9 resolution keeps its own aspect ratio
+                guard = camera.MemoryGuard(make_conf(heatmap_block=16))
+                used = {'frame': 640 * 480 * 3, 'background': 640 * 480 * 8, 'heatmap': 30 * 40 * 4}
+                for pool in used:
+                    guard.track(pool, lambda pool=pool: used[pool])
+                self.check(camera, guard, 10, 0)
+                self.assertEqual(guard.stats()['over_budget'], ['background', 'frame', 'heatmap'])
+                guard.frame_seen((480, 640, 3), 640 * 480 * 3)
+                self.check(camera, guard, 10, 1)
+                self.assertEqual(guard.stats()['over_budget'], [])
+                self.assertEqual(guard.budget('background'), 640 * 480 * 8)
+                # and keep following them through a reload
+                guard.configure(make_conf(low_memory=True))
+                self.assertEqual(guard.budget('background'), 640 * 480 * 4)
+                self.assertEqual(guard.budget('frame'), 640 * 480 * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
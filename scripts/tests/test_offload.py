@@ -0,0 +1,79 @@
+"""The offload messages between a camera and the aggregator"""
+
+import importlib.util
+import os
+import time
+import unittest
+
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+from camera_scripts import SCRIPTS, monitor, sample_conf, scripts
+
+FRAME = (180, 320)
+
+
+def load_aggregator():
+    """aggregator.py as a module"""
+    spec = importlib.util.spec_from_file_location('aggregator', os.path.join(SCRIPTS, 'aggregator.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def jpeg(camera, level):
+    """A flat gray frame as the JPEG a camera sends"""
+    return camera.cv2.imencode('.jpg', np.full(FRAME, level, np.uint8))[1].tobytes()
+
+
+class OffloadTest(unittest.TestCase):
+
+    def test_frame_carries_capture_time(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                client = camera.OffloadClient('localhost:8090', 'porch', {})
+                client.conn = mock.Mock()
+                gray, answer = client.detect(np.zeros(FRAME + (3,), np.uint8), 1234.5)
+                header, payload = camera.parse_offload_message(client.conn.sendString.call_args[0][0])
+                self.assertEqual(header, {'type': 'frame', 'seq': 1, 'captured': 1234.5})
+                self.assertEqual(gray.shape, FRAME)
+                self.assertTrue(payload)
+                client.received(camera.offload_message({'type': 'result', 'seq': 1, 'regions': []}))
+                self.assertEqual(answer.result, [])
+
+    def test_aggregator_detects_at_capture_time(self):
+        aggregator = load_aggregator()
+        for name, camera in scripts():
+            with self.subTest(name):
+                session = aggregator.CameraSession()
+                session.factory = SimpleNamespace(camera=camera)
+                session.detector = camera.MotionDetector({"delta_thresh": 5, "min_area": 100,
+                                                          "lighting_threshold": 0.5,
+                                                          "lighting_settle_time": 2})
+                self.assertIsNone(session.detect(jpeg(camera, 40), 100.0))
+                self.assertIsNone(session.detect(jpeg(camera, 200), 101.0))
+                self.assertEqual(session.detector.settle_until, 103.0)
+
+    def test_answer_after_the_camera_closed(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                camera_monitor = monitor(camera, sample_conf())
+                self.addCleanup(camera_monitor.close)
+                camera_monitor.source = None
+                with mock.patch.multiple(camera_monitor, schedule=mock.DEFAULT, write_frame=mock.DEFAULT,
+                                         upload_frame=mock.DEFAULT, notify_hubs=mock.DEFAULT) as patched, \
+                        mock.patch.object(camera, 'MONITOR_LOG') as log:
+                    camera_monitor.decide([(5000, (10, 10, 100, 50))], 'inactive', np.zeros(FRAME + (3,), np.uint8),
+                                          datetime.now(), time.time(), np.zeros(FRAME, np.uint8))
+                    camera_monitor.offload_failed(mock.Mock(getErrorMessage=lambda: 'gone'), 'active')
+                # the motion still counts, with nothing to annotate
+                self.assertEqual(camera_monitor.camera_status['last_state'], 'active')
+                patched['schedule'].assert_called_with('active')
+                log.error.assert_called_once_with("ERROR: %s, detecting motion locally", 'gone')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""LoadShedder's order of shedding and restoring work"""
+
+import unittest
+
+from unittest import mock
+
+from camera_scripts import scripts
+
+
+class LoadShedderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+
+    def shedder(self, camera, **conf):
+        patch = mock.patch.object(camera, 'time', lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return camera.LoadShedder(conf)
+
+    def settle(self, shedder, latency, times=1):
+        """Frames this far behind until the average follows, then wait out
+           the hold so the next frame can change the level again"""
+        for _ in range(times):
+            for _ in range(30):
+                shedder.record(latency)
+            self.now += 1.0
+
+    def test_off_without_target(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                shedder = self.shedder(camera)
+                self.settle(shedder, 5, 10)
+                self.assertEqual(shedder.stats()['shedding'], [])
+                self.assertFalse(any(shedder.shedding(step) for step in camera.SHED_STEPS))
+
+    def test_sheds_in_order_one_step_a_hold(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                shedder = self.shedder(camera, latency_target=0.5)
+                shed = []
+                for _ in camera.SHED_STEPS:
+                    self.settle(shedder, 2)
+                    shed.append(shedder.stats()['shedding'])
+                self.assertEqual(shed, [list(camera.SHED_STEPS[:level]) for level in range(1, len(camera.SHED_STEPS) + 1)])
+                self.assertTrue(shedder.shedding('defer_writes'))
+                # there's nothing more to shed
+                self.settle(shedder, 2, 5)
+                self.assertEqual(shedder.level, len(camera.SHED_STEPS))
+
+    def test_restores_last_shed_first(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                shedder = self.shedder(camera, latency_target=0.5)
+                self.settle(shedder, 2, len(camera.SHED_STEPS))
+                # between half the target and the target holds steady
+                self.settle(shedder, 0.4, 3)
+                self.assertEqual(shedder.level, len(camera.SHED_STEPS))
+                restored = []
+                for _ in camera.SHED_STEPS:
+                    self.settle(shedder, 0.1)
+                    restored.append(shedder.stats()['shedding'])
+                self.assertEqual(restored, [list(camera.SHED_STEPS[:level]) for level in range(len(camera.SHED_STEPS) - 1, -1, -1)])
+
+    def test_turning_off_restores_everything(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                shedder = self.shedder(camera, latency_target=0.5)
+                self.settle(shedder, 2, 3)
+                shedder.configure({"latency_target": 0})
+                self.assertEqual(shedder.level, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
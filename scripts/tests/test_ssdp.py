@@ -0,0 +1,118 @@
+"""Answering M-SEARCH discovery requests, and the local address in the answer"""
+
+import unittest
+
+from unittest import mock
+
+from camera_scripts import scripts
+
+TARGET = 'urn:schemas-upnp-org:device:Camera:1'
+SEARCH = ('M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\n'
+          'MX: 2\r\nST: %s\r\n\r\n' % TARGET).encode()
+
+
+class LocalIPCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+
+    def cache(self, camera, addresses):
+        """A LocalIPCache looking addresses up in turn"""
+        for patch in (mock.patch.object(camera, 'time', lambda: self.now),
+                      mock.patch.object(camera, 'determine_ip_for_host', side_effect=addresses)):
+            self.addCleanup(patch.stop)
+            lookup = patch.start()
+        return camera.LocalIPCache(ttl=300), lookup
+
+    def test_one_lookup_per_network(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                cache, lookup = self.cache(camera, ['192.168.1.5', '10.0.0.5'])
+                self.assertEqual(cache.get('192.168.1.20'), '192.168.1.5')
+                self.assertEqual(cache.get('192.168.1.21'), '192.168.1.5')
+                self.assertEqual(cache.get('10.0.0.1'), '10.0.0.5')
+                self.assertEqual(lookup.call_count, 2)
+
+    def test_refreshes_when_the_address_changes(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                cache, lookup = self.cache(camera, ['192.168.1.5', '192.168.1.6', '192.168.1.7'])
+                self.assertEqual(cache.get('192.168.1.20'), '192.168.1.5')
+                self.now += 299
+                self.assertEqual(cache.get('192.168.1.20'), '192.168.1.5')
+                # once it expires the new address is picked up
+                self.now += 2
+                self.assertEqual(cache.get('192.168.1.20'), '192.168.1.6')
+                # and straight away after a clear, as on a reload
+                cache.clear()
+                self.assertEqual(cache.get('192.168.1.20'), '192.168.1.7')
+                self.assertEqual(lookup.call_count, 3)
+
+
+class SSDPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+
+    def server(self, camera, rate_limit=0, addresses=None):
+        """An SSDPServer on a stand-in multicast port"""
+        for patch in (mock.patch.object(camera, 'time', lambda: self.now),
+                      mock.patch.object(camera, 'reactor'),
+                      mock.patch.object(camera, 'determine_ip_for_host',
+                                        side_effect=addresses, return_value='192.168.1.5')):
+            self.addCleanup(patch.stop)
+            patch.start()
+        return camera.SSDPServer(status_port=5000, device_target=TARGET, rate_limit=rate_limit)
+
+    def answered(self, server, host, times=1):
+        """How many of that many searches from host were answered"""
+        before = server.port.write.call_count
+        for _ in range(times):
+            server.datagramReceived(SEARCH, (host, 1900))
+        return server.port.write.call_count - before
+
+    def test_reply(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                server = self.server(camera)
+                self.assertEqual(self.answered(server, '192.168.1.20'), 1)
+                reply, address = server.port.write.call_args[0]
+                self.assertEqual(address, ('192.168.1.20', 1900))
+                self.assertIn(b'LOCATION:http://192.168.1.5:5000/status\r\n', reply)
+                self.assertIn(('ST:%s\r\n' % TARGET).encode(), reply)
+                # other targets, and anything but M-SEARCH, aren't answered
+                server.datagramReceived(SEARCH.replace(b'Camera', b'Light'), ('192.168.1.20', 1900))
+                server.datagramReceived(b'NOTIFY * HTTP/1.1\r\n\r\n', ('192.168.1.20', 1900))
+                self.assertEqual(server.port.write.call_count, 1)
+
+    def test_rate_limit_per_source(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                server = self.server(camera, rate_limit=1)
+                self.assertEqual(self.answered(server, '192.168.1.20', 8), camera.SSDP_BURST)
+                self.assertEqual(server.throttled, 8 - camera.SSDP_BURST)
+                # another host still gets its answers
+                self.assertEqual(self.answered(server, '192.168.1.21', 2), 2)
+                # and the first gets one more for each second it waits
+                self.now += 2
+                self.assertEqual(self.answered(server, '192.168.1.20', 3), 2)
+
+    def test_no_rate_limit(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                server = self.server(camera)
+                self.assertEqual(self.answered(server, '192.168.1.20', 20), 20)
+                self.assertEqual(server.throttled, 0)
+
+    def test_reply_follows_the_address(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                server = self.server(camera, addresses=['192.168.1.5', '192.168.1.6'])
+                self.answered(server, '192.168.1.20')
+                self.now += camera.IP_CACHE_TTL + 1
+                self.answered(server, '192.168.1.20')
+                self.assertIn(b'LOCATION:http://192.168.1.6:5000/status\r\n', server.port.write.call_args[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""SubscriptionRegistry expiry and persistence"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from camera_scripts import scripts
+
+
+class SubscriptionRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.now = 1000.0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def clock(self, camera):
+        """Stop the registry's clock at self.now and its timers from
+           reaching the reactor"""
+        patches = [mock.patch.object(camera, 'time', lambda: self.now),
+                   mock.patch.object(camera.reactor, 'callLater')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        return camera.reactor.callLater
+
+    def test_subscribe_refreshes_callback(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.clock(camera)
+                registry = camera.SubscriptionRegistry()
+                sid = registry.subscribe('http://hub/a', 10)
+                self.assertEqual(registry.subscribe('http://hub/a', 20), sid)
+                self.assertEqual(len(registry), 1)
+                self.assertEqual(registry.subscriptions[sid]['expiration'], 1020.0)
+
+    def test_expire_skips_renewed_and_removed(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                call_later = self.clock(camera)
+                self.now = 1000.0
+                registry = camera.SubscriptionRegistry()
+                first = registry.subscribe('http://hub/a', 10)
+                second = registry.subscribe('http://hub/b', 20)
+                third = registry.subscribe('http://hub/c', 5)
+                self.assertTrue(registry.renew(first, 30))
+                self.assertTrue(registry.unsubscribe(third))
+                self.assertFalse(registry.renew(third, 30))
+                # one timer, for the earliest entry still in the heap
+                self.assertEqual(call_later.call_args[0], (5.0, registry.expire))
+
+                self.now = 1025.0
+                registry.expire()
+                self.assertEqual(registry.callbacks(), ['http://hub/a'])
+                self.assertNotIn(second, registry.subscriptions)
+                self.assertEqual(call_later.call_args[0], (5.0, registry.expire))
+
+                self.now = 1030.0
+                registry.expire()
+                self.assertEqual(len(registry), 0)
+                self.assertEqual(registry.expiry, [])
+
+    def test_stale_entries_are_compacted(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.clock(camera)
+                registry = camera.SubscriptionRegistry()
+                sid = registry.subscribe('http://hub/a', 10)
+                for timeout in range(100):
+                    registry.renew(sid, timeout)
+                self.assertLessEqual(len(registry.expiry), 2 + 16)
+
+    def test_saved_and_restored(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.clock(camera)
+                path = os.path.join(self.dir, name + '.json')
+                self.now = 1000.0
+                registry = camera.SubscriptionRegistry(path)
+                kept = registry.subscribe('http://hub/a', 60)
+                registry.subscribe('http://hub/b', 10)
+                gone = registry.subscribe('http://hub/c', 60)
+                registry.unsubscribe(gone)
+
+                # b expired while we were down
+                self.now = 1030.0
+                restored = camera.SubscriptionRegistry(path)
+                self.assertEqual(list(restored.subscriptions), [kept])
+                self.assertEqual(restored.subscriptions[kept],
+                                 {'callback': 'http://hub/a', 'expiration': 1060.0})
+                self.assertEqual(restored.expiry, [(1060.0, kept)])
+
+    def test_unreadable_file(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.clock(camera)
+                path = os.path.join(self.dir, name + '.json')
+                with open(path, 'w') as saved:
+                    saved.write('{not json')
+                self.assertEqual(len(camera.SubscriptionRegistry(path)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
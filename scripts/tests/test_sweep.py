@@ -0,0 +1,46 @@
+"""Running clips through either camera script's MonitorCamera"""
+
+import sys
+import unittest
+
+from unittest import mock
+
+import numpy as np
+
+from twisted.internet.defer import maybeDeferred
+
+from camera_scripts import SCRIPTS, sample_conf, scripts
+
+sys.path.insert(0, SCRIPTS)
+import sweep # pylint: disable=wrong-import-position
+
+
+def clip():
+    """Ten quiet seconds at 10fps with a box crossing the middle of them"""
+    for index in range(100):
+        frame = np.full((360, 640, 3), 80, np.uint8)
+        if 40 <= index < 60:
+            x = 100 + (index - 40) * 20
+            frame[100:260, x:x + 120] = 220
+        yield index / 10.0, frame
+
+
+class SweepTest(unittest.TestCase):
+
+    def test_events_from_either_script(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                conf = dict(sample_conf(), **sweep.SWEEP_OVERRIDES)
+                with mock.patch.object(camera, 'deferToThread', maybeDeferred):
+                    replay = sweep.make_replay_camera(camera)(conf)
+                    for seconds, frame in clip():
+                        if seconds >= replay.due:
+                            replay.feed(seconds, frame)
+                    replay.finish(10)
+                self.assertEqual(len(replay.events), 1)
+                self.assertGreater(replay.counts['frames_written'], 0)
+                self.assertEqual(replay.counts['notifications'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
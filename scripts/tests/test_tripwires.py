@@ -0,0 +1,101 @@
+"""Tripwire rules and the geometry TripwireFilter matches them with"""
+
+import unittest
+
+import numpy as np
+
+from camera_scripts import scripts
+
+# a wire across y=100 from x=0 to x=200
+WIRE = {"name": "gate", "line": [[0, 100], [200, 100]]}
+
+
+def points(*coordinates):
+    """Float32 (x, y) points"""
+    return np.array(coordinates, np.float32).reshape(-1, 2)
+
+
+class ParseTripwireTest(unittest.TestCase):
+
+    def test_parse(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                self.assertEqual(camera.parse_tripwire(dict(WIRE, direction="up"), 0),
+                                 {'name': 'gate', 'line': ((0.0, 100.0), (200.0, 100.0)), 'direction': (0, -1)})
+                self.assertEqual(camera.parse_tripwire({"direction": "left"}, 2),
+                                 {'name': 'tripwire 3', 'line': None, 'direction': (-1, 0)})
+                self.assertIsNone(camera.parse_tripwire(WIRE, 0)['direction'])
+
+    def test_bad_rules(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                for rule in ({}, {"direction": "any"}, {"line": [[5, 5], [5, 5]]}):
+                    self.assertRaises(ValueError, camera.parse_tripwire, rule, 0)
+                self.assertRaises(KeyError, camera.parse_tripwire, {"direction": "north"}, 0)
+                self.assertRaises(ValueError, camera.parse_tripwire, {"line": [[0, 0]]}, 0)
+
+
+class MatchesTest(unittest.TestCase):
+
+    def matches(self, camera, rule, start, end, owners=None):
+        tripwires = camera.TripwireFilter({"tripwire_min_motion": 2})
+        owners = np.zeros(len(start), int) if owners is None else np.array(owners)
+        return tripwires.matches(camera.parse_tripwire(rule, 0), start, end, owners)
+
+    def test_line_crossing(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                start, end = points((50, 110), (60, 112)), points((50, 90), (62, 95))
+                self.assertTrue(self.matches(camera, WIRE, start, end))
+                self.assertTrue(self.matches(camera, WIRE, end, start))
+                # one point isn't enough to call it a crossing
+                self.assertFalse(self.matches(camera, WIRE, start[:1], end[:1]))
+                # moving up to the wire but not over it
+                self.assertFalse(self.matches(camera, WIRE, start, points((50, 101), (60, 104))))
+                # past the end of the wire
+                self.assertFalse(self.matches(camera, WIRE, start + (250, 0), end + (250, 0)))
+
+    def test_line_direction(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                start, end = points((50, 110), (60, 112)), points((50, 90), (62, 95))
+                self.assertTrue(self.matches(camera, dict(WIRE, direction="up"), start, end))
+                self.assertFalse(self.matches(camera, dict(WIRE, direction="down"), start, end))
+                self.assertTrue(self.matches(camera, dict(WIRE, direction="down"), end, start))
+
+    def test_direction_only(self):
+        for name, camera in scripts():
+            with self.subTest(name):
+                rule = {"direction": "right"}
+                start = points((10, 10), (12, 14), (15, 11), (300, 300), (305, 302))
+                right = start + (8, 1)
+                self.assertTrue(self.matches(camera, rule, start, right, [0, 0, 0, 1, 1]))
+                # too slow, or more sideways than right
+                self.assertFalse(self.matches(camera, rule, start, start + (1, 0)))
+                self.assertFalse(self.matches(camera, rule, start, start + (4, 6)))
+                # most of a box has to move, not a couple of points in a big one
+                owners = [0, 0, 0, 0, 0]
+                end = np.vstack([right[:2], start[2:]])
+                self.assertFalse(self.matches(camera, rule, start, end, owners))
+
+
+class UpdateTest(unittest.TestCase):
+
+    def test_follows_points_over_the_wire(self):
+        rng = np.random.RandomState(3)
+        texture = (rng.rand(40, 40) * 255).astype(np.uint8)
+        for name, camera in scripts():
+            with self.subTest(name):
+                tripwires = camera.TripwireFilter({"tripwires": [dict(WIRE, direction="up")]})
+                for now, top in enumerate((95, 88, 80)):
+                    gray = np.zeros((240, 320), np.uint8)
+                    gray[top:top + 40, 60:100] = texture
+                    tripwires.update(gray, [(60, top, 40, 40)], now)
+                self.assertEqual(tripwires.recent(2), ['gate'])
+                self.assertEqual(tripwires.recent(10), [])
+                tripwires.update(None, [], 3)
+                self.assertIsNone(tripwires.previous)
+
+
+if __name__ == '__main__':
+    unittest.main()